@@ -0,0 +1,155 @@
+from rbtools.api.concurrency import DEFAULT_MAX_WORKERS, ThreadPool
+from rbtools.api.resource import ResourceBase, ResourceListBase, RootResource
+
+
+class AsyncServerInterface(object):
+    """ Makes requests to a ReviewBoard server without blocking the caller.
+
+    Requests are run on a pool of worker threads which share the wrapped
+    ServerInterface, and its persistent connections.  Every method which
+    makes a request returns a Future.  Callers can wait for the result with
+    Future.result(), or have it delivered with Future.add_done_callback(),
+    so that a single thread can keep many requests in flight at once.
+    How many actually run at once is governed by the ServerInterface's
+    AdaptiveLimiter.
+    """
+    def __init__(self, server_interface, max_workers=DEFAULT_MAX_WORKERS):
+        self.server_interface = server_interface
+        self._pool = ThreadPool(max_workers, server_interface.limiter)
+
+    def submit(self, func, *args, **kwargs):
+        """ Runs func on a worker thread, returning a Future for its result.
+        """
+        return self._pool.submit(func, *args, **kwargs)
+
+    def get(self, url, accept=None):
+        """ Make an HTTP GET on the specified url.
+        """
+        return self.submit(self.server_interface.get, url, accept)
+
+    def delete(self, url, accept=None):
+        """ Make an HTTP DELETE on the specified url.
+        """
+        return self.submit(self.server_interface.delete, url, accept)
+
+    def post(self, url, fields, files=None, accept=None):
+        """ Make an HTTP POST on the specified url.
+        """
+        return self.submit(self.server_interface.post, url, fields, files,
+                           accept)
+
+    def put(self, url, fields, files=None, accept=None):
+        """ Make an HTTP PUT on the specified url.
+        """
+        return self.submit(self.server_interface.put, url, fields, files,
+                           accept)
+
+    def get_root(self, url):
+        """ Loads the root resource at url.
+
+        Returns:
+            A Future for the AsyncResourceList wrapping the RootResource.
+        """
+        return self.submit(
+            lambda: wrap_resource(self,
+                                  RootResource(self.server_interface, url)))
+
+    def close(self):
+        """ Stops the worker threads once all pending requests have finished.
+        """
+        self._pool.shutdown()
+
+
+class AsyncResource(object):
+    """ Wraps a resource so that its requests don't block the caller.
+
+    Methods which make requests return a Future instead of their usual
+    result.  Resources in those results are wrapped as well.  Everything
+    else, such as get_field() and get_links(), is passed through to the
+    wrapped resource, which is available as self.resource.
+    """
+    def __init__(self, async_interface, resource):
+        self.async_interface = async_interface
+        self.resource = resource
+
+    def __getattr__(self, name):
+        return getattr(self.resource, name)
+
+    def __str__(self):
+        return str(self.resource)
+
+    def refresh(self):
+        """ Refreshes the resource.  The Future's result is this wrapper.
+        """
+        return self._call_returning_self(self.resource.refresh)
+
+    def save(self):
+        """ Saves the resource.  The Future's result is this wrapper.
+        """
+        return self._call_returning_self(self.resource.save)
+
+    def delete(self):
+        """ Deletes the resource.  The Future's result is this wrapper.
+        """
+        return self._call_returning_self(self.resource.delete)
+
+    def get_or_create(self, link):
+        """ Gets, or creates and gets, the resource specified by link.
+        """
+        return self._call(self.resource.get_or_create, link)
+
+    def _call(self, func, *args):
+        return self.async_interface.submit(
+            lambda: wrap_resource(self.async_interface, func(*args)))
+
+    def _call_returning_self(self, func):
+        def call():
+            func()
+            return self
+
+        return self.async_interface.submit(call)
+
+
+class AsyncResourceList(AsyncResource):
+    """ Wraps a resource list so that its requests don't block the caller.
+    """
+    def get(self, field_id):
+        """ Gets the child resource specified by field_id.
+        """
+        return self._call(self.resource.get, field_id)
+
+    def get_many(self, field_ids):
+        """ Gets the child resources specified by field_ids.
+
+        Returns:
+            A list of Futures, one for each of field_ids in the same order.
+        """
+        return [self.get(field_id) for field_id in field_ids]
+
+    def __iter__(self):
+        for rsc in self.resource:
+            yield wrap_resource(self.async_interface, rsc)
+
+    def __len__(self):
+        return len(self.resource)
+
+    def __getitem__(self, position):
+        rscs = self.resource[position]
+
+        if isinstance(rscs, list):
+            return [wrap_resource(self.async_interface, rsc) for rsc in rscs]
+        else:
+            return wrap_resource(self.async_interface, rscs)
+
+
+def wrap_resource(async_interface, resource):
+    """ Wraps resource in the matching AsyncResource class.
+
+    Anything which is not a resource is returned unchanged.
+    """
+    if isinstance(resource, ResourceListBase):
+        return AsyncResourceList(async_interface, resource)
+    elif isinstance(resource, ResourceBase):
+        return AsyncResource(async_interface, resource)
+    else:
+        return resource
@@ -0,0 +1,491 @@
+import getpass
+import os
+import threading
+import time
+from urlparse import urlparse
+
+from rbtools.api.concurrency import Future
+from rbtools.api.fileutils import lock_file, replace_file, unlock_file
+
+try:
+    from json import dumps as json_dumps, loads as json_loads
+except ImportError:
+    from simplejson import dumps as json_dumps, loads as json_loads
+
+
+# How long, in seconds, each kind of metadata resource is cached on disk.
+DEFAULT_METADATA_TTLS = {
+    'root': 24 * 60 * 60,
+    'info': 24 * 60 * 60,
+    'repositories': 60 * 60,
+}
+
+# The directory in the user's home directory where the metadata cache is
+# kept by default.
+DEFAULT_CACHE_DIR = '.rbtools-cache'
+
+# How long, in seconds, a retrieved resource is remembered in memory, and
+# how many are remembered at most.  Changes made by other clients show up
+# once this time has passed.
+DEFAULT_MEMO_TTL = 60
+DEFAULT_MEMO_SIZE = 256
+
+# How many responses are kept along with their validators at most.
+DEFAULT_VALIDATOR_CACHE_SIZE = 256
+
+
+class CachedResponse(object):
+    """ A response body cached along with the validators the server sent.
+    """
+    def __init__(self, url, resource_string, data, etag=None,
+                 last_modified=None):
+        self.url = url
+        self.resource_string = resource_string
+        self.data = data
+        self.etag = etag
+        self.last_modified = last_modified
+
+    def get_request_headers(self):
+        """ Returns the headers which make a request for url conditional.
+        """
+        headers = {}
+
+        if self.etag:
+            headers['If-None-Match'] = self.etag
+
+        if self.last_modified:
+            headers['If-Modified-Since'] = self.last_modified
+
+        return headers
+
+
+class ValidatorCache(object):
+    """ Caches parsed responses keyed by url, along with their validators.
+
+    Responses are only cached if the server sent an ETag or Last-Modified
+    header with them.  Those validators are sent back with the next request
+    for the same url, and if the server answers 304 Not Modified then the
+    cached resource string and already parsed data are reused.  At most
+    max_size responses are kept, forgetting the least recently used first.
+    """
+    def __init__(self, max_size=DEFAULT_VALIDATOR_CACHE_SIZE):
+        self.max_size = max_size
+        self._entries = {}
+        self._uses = 0
+        self._lock = threading.Lock()
+
+    def get(self, url):
+        """ Returns the CachedResponse for url, or None.
+        """
+        self._lock.acquire()
+
+        try:
+            response = self._entries.get(url, (None, None))[0]
+
+            if response is not None:
+                self._entries[url] = (response, self._use())
+
+            return response
+        finally:
+            self._lock.release()
+
+    def set(self, url, resource_string, data, etag=None, last_modified=None):
+        """ Caches the response for url if it has any validators.
+        """
+        self._lock.acquire()
+
+        try:
+            if etag or last_modified:
+                response = CachedResponse(url, resource_string, data, etag,
+                                          last_modified)
+                self._entries[url] = (response, self._use())
+                self._evict()
+            else:
+                self._entries.pop(url, None)
+        finally:
+            self._lock.release()
+
+    def invalidate(self, url):
+        """ Removes any cached response for url.
+        """
+        self._lock.acquire()
+
+        try:
+            self._entries.pop(url, None)
+        finally:
+            self._lock.release()
+
+    def clear(self):
+        """ Removes every cached response.
+        """
+        self._lock.acquire()
+
+        try:
+            self._entries = {}
+        finally:
+            self._lock.release()
+
+    def _use(self):
+        self._uses += 1
+        return self._uses
+
+    def _evict(self):
+        while len(self._entries) > self.max_size:
+            oldest = min(self._entries.items(), key=lambda item: item[1][1])
+            del self._entries[oldest[0]]
+
+
+class RequestMemo(object):
+    """ Remembers the resources retrieved during one run of a command.
+
+    A command often retrieves the same url several times, for example the
+    root or a review request it has already looked at.  The first retrieval
+    of a url is remembered in memory, and later ones are answered from it
+    without going to the server.  If several threads ask for a url at once,
+    only one of them retrieves it and the others wait for its result.
+
+    Nothing is written to disk.  Whenever a url is changed on the server,
+    invalidate() should be called so that it, and the resources above and
+    below it, are retrieved again.  Changes made by anything else are only
+    noticed once ttl seconds have passed, so that a long-lived process
+    doesn't keep serving stale resources.  At most max_size resources are
+    remembered, forgetting the oldest first.
+    """
+    def __init__(self, ttl=DEFAULT_MEMO_TTL, max_size=DEFAULT_MEMO_SIZE):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def get(self, url, fetch, *args, **kwargs):
+        """ Returns the remembered result for url.
+
+        If url hasn't been retrieved yet, fetch is called with the remaining
+        arguments to retrieve it, unless another thread already is, in which
+        case that thread's result is waited for.  Failures aren't
+        remembered, so the next call tries again.
+        """
+        self._lock.acquire()
+
+        try:
+            now = time.time()
+            future, stored = self._entries.get(url, (None, None))
+
+            if (future is not None and future.done() and
+                now - stored > self.ttl):
+                future = None
+
+            owner = future is None
+
+            if owner:
+                future = Future()
+                self._entries[url] = (future, now)
+                self._evict()
+        finally:
+            self._lock.release()
+
+        if owner:
+            future.run(fetch, *args, **kwargs)
+
+            if future.exception() is not None:
+                self._remove(url, future)
+
+        return future.result()
+
+    def invalidate(self, url):
+        """ Forgets url, along with the resources above and below it.
+
+        A change to a resource can show up in the resources linking to it,
+        such as a list holding it, and in those below it, so they are all
+        forgotten.  A retrieval of any of them which is still running isn't
+        remembered either.
+        """
+        path = _strip_query(url)
+
+        self._lock.acquire()
+
+        try:
+            for key in self._entries.keys():
+                other = _strip_query(key)
+
+                if other.startswith(path) or path.startswith(other):
+                    del self._entries[key]
+        finally:
+            self._lock.release()
+
+    def clear(self):
+        """ Forgets every url.
+        """
+        self._lock.acquire()
+
+        try:
+            self._entries = {}
+        finally:
+            self._lock.release()
+
+    def _remove(self, url, future):
+        self._lock.acquire()
+
+        try:
+            if self._entries.get(url, (None,))[0] is future:
+                del self._entries[url]
+        finally:
+            self._lock.release()
+
+    def _evict(self):
+        while len(self._entries) > self.max_size:
+            oldest = min(self._entries.items(), key=lambda item: item[1][1])
+            del self._entries[oldest[0]]
+
+
+class MetadataCache(object):
+    """ Caches slow-changing API resources on disk between runs.
+
+    The root resource (with its links and uri_templates), the server info
+    and the repository list rarely change, but every command would otherwise
+    retrieve them again before doing any real work.  Their response bodies
+    are kept in a JSON file, keyed by url, and each is reused until its
+    kind's time to live runs out.
+
+    Data derived from a resource, such as an index built from it, can be
+    kept under the resource's url followed by a "#" and a name.  It's
+    invalidated along with the resource.
+
+    Different users can see different resources, such as only the
+    repositories they have access to, so each entry is also keyed by the
+    username.  Invalidating a url removes the entries of every user.
+
+    The file is read under a shared lock, and updated under an exclusive
+    lock by replacing it atomically, so several processes can share it.
+    """
+    def __init__(self, path=None, ttls=None, username=None):
+        """
+        Parameters:
+            path     - the path of the cache file.  Defaults to the path
+                       returned by get_default_metadata_cache_path().
+            ttls     - a dict mapping the kinds of resource returned by
+                       get_metadata_kind() to how many seconds they are
+                       cached for.  Defaults to DEFAULT_METADATA_TTLS.
+            username - the name of the user the resources are retrieved
+                       as.  Defaults to the name of the local user.
+        """
+        self.path = path or get_default_metadata_cache_path()
+        self.username = username or _get_local_username()
+        self.ttls = dict(DEFAULT_METADATA_TTLS)
+
+        if ttls:
+            self.ttls.update(ttls)
+
+        self._entries = None
+        self._lock = threading.Lock()
+
+    def get(self, url, kind=None):
+        """ Returns the cached (resource_string, data) for url, or None.
+
+        None is returned if url isn't a cacheable kind of resource, or its
+        cached copy has expired.  The kind of resource is worked out from
+        url unless it's given.
+        """
+        ttl = self.ttls.get(kind or get_metadata_kind(url))
+
+        if not ttl:
+            return None
+
+        self._lock.acquire()
+
+        try:
+            entry = self._get_entries().get(self._make_key(url))
+        finally:
+            self._lock.release()
+
+        if not entry or time.time() - entry['time'] > ttl:
+            return None
+
+        resource_string = entry['body']
+        return resource_string, json_loads(resource_string)
+
+    def set(self, url, resource_string, kind=None):
+        """ Caches the response body for url, if it's a cacheable kind.
+        """
+        if self.ttls.get(kind or get_metadata_kind(url)):
+            self._update(self._make_key(url), {
+                'time': time.time(),
+                'body': resource_string,
+            })
+
+    def invalidate(self, url):
+        """ Removes any cached response for url, and any data derived from
+        it.
+        """
+        self._lock.acquire()
+
+        try:
+            if not _get_keys(self._get_entries(), url):
+                return
+        finally:
+            self._lock.release()
+
+        self._update(url, None)
+
+    def clear(self):
+        """ Removes every cached response.
+        """
+        self._lock.acquire()
+
+        try:
+            if os.path.exists(self.path):
+                lock = lock_file(self.path)
+
+                try:
+                    os.remove(self.path)
+                finally:
+                    unlock_file(lock)
+
+            self._entries = {}
+        finally:
+            self._lock.release()
+
+    def _make_key(self, url):
+        # URLs never contain spaces, so the url is everything after the
+        # last one, even if the username has spaces.
+        return '%s %s' % (self.username, url)
+
+    def _get_entries(self):
+        if self._entries is None:
+            try:
+                lock = lock_file(self.path, shared=True)
+            except (IOError, OSError):
+                # The cache can't be used, so behave as if it's empty.
+                self._entries = {}
+                return self._entries
+
+            try:
+                self._entries = self._read()
+            finally:
+                unlock_file(lock)
+
+        return self._entries
+
+    def _read(self):
+        try:
+            f = open(self.path, 'r')
+
+            try:
+                entries = json_loads(f.read())
+            finally:
+                f.close()
+        except (IOError, ValueError):
+            # A missing or unreadable cache is treated as empty.
+            return {}
+
+        if not isinstance(entries, dict):
+            return {}
+
+        return entries
+
+    def _update(self, key, entry):
+        """ Stores entry under key, or if entry is None, removes every
+        user's entries for key, which is then a url.
+
+        The file is read again under the lock, so that entries stored by
+        other processes since it was first read aren't lost.
+        """
+        self._lock.acquire()
+
+        try:
+            entries = self._get_entries()
+
+            try:
+                directory = os.path.dirname(os.path.abspath(self.path))
+
+                if not os.path.isdir(directory):
+                    os.makedirs(directory)
+
+                lock = lock_file(self.path)
+
+                try:
+                    entries = self._read()
+                    self._store(entries, key, entry)
+                    replace_file(self.path,
+                                 lambda path: self._write(path, entries))
+                finally:
+                    unlock_file(lock)
+            except (IOError, OSError):
+                # Caching is only an optimization, so carry on without
+                # writing the file.
+                self._store(entries, key, entry)
+
+            self._entries = entries
+        finally:
+            self._lock.release()
+
+    def _store(self, entries, key, entry):
+        if entry is None:
+            for url_key in _get_keys(entries, key):
+                del entries[url_key]
+        else:
+            entries[key] = entry
+
+    def _write(self, path, entries):
+        f = open(path, 'w')
+
+        try:
+            f.write(json_dumps(entries))
+        finally:
+            f.close()
+
+
+def get_default_metadata_cache_path():
+    """ Returns the path of the current user's metadata cache file.
+
+    The cache is kept in DEFAULT_CACHE_DIR in the user's home directory,
+    rather than alongside a cookie file which may be in a shared directory.
+    """
+    return os.path.join(os.path.expanduser('~'), DEFAULT_CACHE_DIR,
+                        'metadata')
+
+
+def _get_local_username():
+    try:
+        return getpass.getuser()
+    except (ImportError, KeyError):
+        return ''
+
+
+def _get_keys(entries, url):
+    """ Returns the keys in entries for url, for url with a query, and for
+    the data derived from url, for every user.
+    """
+    keys = []
+
+    for key in entries:
+        key_url = key.rsplit(' ', 1)[-1]
+
+        if (key_url == url or key_url.startswith(url + '#') or
+            key_url.startswith(url + '?')):
+            keys.append(key)
+
+    return keys
+
+
+def _strip_query(url):
+    return url.split('?', 1)[0]
+
+
+def get_metadata_kind(url):
+    """ Returns the kind of metadata resource at url, or None.
+
+    The kinds are "root" for the API root, "info" for the server info and
+    "repositories" for the repository list.
+    """
+    path = urlparse(url)[2]
+
+    if path.endswith('/api/'):
+        return 'root'
+
+    parts = [part for part in path.split('/') if part]
+
+    if parts and parts[-1] in ('info', 'repositories'):
+        return parts[-1]
+
+    return None
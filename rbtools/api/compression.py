@@ -0,0 +1,157 @@
+import gzip
+import socket
+import tempfile
+import urllib2
+import zlib
+
+
+CHUNK_SIZE = 64 * 1024
+
+# Request bodies smaller than this aren't worth compressing.
+MIN_COMPRESSED_BODY_SIZE = 4 * 1024
+
+
+class DecompressingReader(object):
+    """ Decompresses a gzip or deflate encoded response body as it is read.
+    """
+    def __init__(self, fp, encoding):
+        self.fp = fp
+        self.encoding = encoding
+        self._decompressor = None
+        self._buffer = ''
+        self._eof = False
+
+    def recv(self, size=-1):
+        chunks = []
+        length = 0
+
+        if self._buffer:
+            chunks.append(self._buffer)
+            length = len(self._buffer)
+            self._buffer = ''
+
+        while not self._eof and (size < 0 or length < size):
+            data = self.fp.read(CHUNK_SIZE)
+
+            if data:
+                data = self._decompress(data)
+            else:
+                self._eof = True
+
+                if self._decompressor:
+                    data = self._decompressor.flush()
+
+            chunks.append(data)
+            length += len(data)
+
+        data = ''.join(chunks)
+
+        if size >= 0:
+            self._buffer = data[size:]
+            data = data[:size]
+
+        return data
+
+    read = recv
+
+    def close(self):
+        self.fp.close()
+
+    def _decompress(self, data):
+        if self._decompressor is None:
+            if self.encoding == 'gzip':
+                self._decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            else:
+                # "deflate" is meant to be zlib wrapped, but some servers
+                # send raw deflate data instead.
+                try:
+                    self._decompressor = zlib.decompressobj()
+                    return self._decompressor.decompress(data)
+                except zlib.error:
+                    self._decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+
+        return self._decompressor.decompress(data)
+
+
+class CompressionHandler(urllib2.BaseHandler):
+    """ Negotiates compressed transfers with the server.
+
+    Every request advertises that gzip and deflate encoded responses are
+    accepted, and encoded responses are decompressed as they are read.
+
+    Servers can advertise that they accept gzip encoded request bodies by
+    sending an Accept-Encoding header in their responses.  Once one has,
+    server_accepts_gzip is set, unless reject_gzip() has been called because
+    the server turned a compressed body down anyway.
+    """
+    def __init__(self):
+        self.server_accepts_gzip = False
+        self._gzip_rejected = False
+
+    def reject_gzip(self):
+        """ Stops compressed request bodies from being used.
+        """
+        self.server_accepts_gzip = False
+        self._gzip_rejected = True
+
+    def http_request(self, req):
+        if not req.has_header('Accept-encoding'):
+            req.add_unredirected_header('Accept-encoding', 'gzip, deflate')
+
+        return req
+
+    def http_response(self, req, response):
+        info = response.info()
+
+        if (not self._gzip_rejected and
+            'gzip' in (info.getheader('Accept-Encoding') or '').lower()):
+            self.server_accepts_gzip = True
+
+        encoding = (info.getheader('Content-Encoding') or '').strip().lower()
+
+        if encoding in ('gzip', 'x-gzip', 'deflate'):
+            if encoding == 'x-gzip':
+                encoding = 'gzip'
+
+            # The headers now describe the decompressed body.
+            del info['Content-Encoding']
+            del info['Content-Length']
+
+            fp = socket._fileobject(DecompressingReader(response, encoding),
+                                    close=True)
+            decompressed = urllib2.addinfourl(fp, info, response.geturl())
+            decompressed.code = response.code
+            decompressed.msg = response.msg
+            response = decompressed
+
+        return response
+
+    https_request = http_request
+    https_response = http_response
+
+
+def gzip_body(body):
+    """ Compresses a request body with gzip.
+
+    The body, which must have a read() method, is compressed in pieces into
+    a temporary file, so it's never held in memory all at once.
+
+    Returns:
+        A (fp, length) tuple, holding the compressed body's file and length.
+    """
+    spool = tempfile.TemporaryFile()
+    gz = gzip.GzipFile(fileobj=spool, mode='wb')
+
+    while True:
+        chunk = body.read(CHUNK_SIZE)
+
+        if not chunk:
+            break
+
+        gz.write(chunk)
+
+    gz.close()
+    length = spool.tell()
+    spool.seek(0)
+
+    return spool, length
@@ -0,0 +1,368 @@
+import Queue
+import sys
+import threading
+import time
+
+from rbtools.api.errors import FutureTimeoutError
+
+
+DEFAULT_MAX_WORKERS = 8
+
+# The adaptive limiter starts out allowing this many calls at once.
+DEFAULT_INITIAL_CONCURRENCY = 2
+
+# Responses with these statuses mean the server is overloaded.
+OVERLOAD_STATUSES = (429, 503)
+
+# A call taking this many times longer than the fastest call seen means
+# the server is starting to struggle.
+LATENCY_TOLERANCE = 2.0
+
+# Latencies are never compared against less than this many seconds, so that
+# jitter in very fast calls isn't taken for the server slowing down.
+MIN_BASE_LATENCY = 0.05
+
+# How much the limit is cut by when the server is struggling.
+BACKOFF_FACTOR = 0.5
+
+
+class Future(object):
+    """ The result of a call which is running in the background.
+    """
+    def __init__(self):
+        self._event = threading.Event()
+        self._result = None
+        self._exc_info = None
+        self._callbacks = []
+        self._lock = threading.Lock()
+
+    def done(self):
+        """ Returns true if the call has finished.
+        """
+        return self._event.isSet()
+
+    def result(self, timeout=None):
+        """ Returns the result of the call, waiting for it if necessary.
+
+        If the call raised an exception, that exception is raised again here.
+        If timeout seconds pass before the call finishes, a
+        FutureTimeoutError is raised.
+        """
+        self._event.wait(timeout)
+
+        if not self._event.isSet():
+            raise FutureTimeoutError('The call did not finish in time.')
+
+        if self._exc_info:
+            raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+
+        return self._result
+
+    def exception(self, timeout=None):
+        """ Returns the exception raised by the call, or None.
+        """
+        try:
+            self.result(timeout)
+        except FutureTimeoutError:
+            raise
+        except Exception, e:
+            return e
+
+        return None
+
+    def add_done_callback(self, callback):
+        """ Arranges for callback to be called with this future once done.
+
+        If the call has already finished, callback is called right away.
+        Otherwise it is called on the thread which finishes the call, after
+        any waiters in result() have been woken, so they may return before
+        the callback has run.
+        """
+        self._lock.acquire()
+
+        try:
+            if not self._event.isSet():
+                self._callbacks.append(callback)
+                return
+        finally:
+            self._lock.release()
+
+        callback(self)
+
+    def set_result(self, result):
+        self._result = result
+        self._finish()
+
+    def set_exc_info(self, exc_info):
+        self._exc_info = exc_info
+        self._finish()
+
+    def _finish(self):
+        self._lock.acquire()
+
+        try:
+            self._event.set()
+            callbacks = self._callbacks
+            self._callbacks = []
+        finally:
+            self._lock.release()
+
+        for callback in callbacks:
+            callback(self)
+
+    def run(self, func, *args, **kwargs):
+        """ Calls func, storing its result or exception in this future.
+        """
+        try:
+            result = func(*args, **kwargs)
+        except:
+            self.set_exc_info(sys.exc_info())
+        else:
+            self.set_result(result)
+
+
+def run_in_background(func, *args, **kwargs):
+    """ Calls func on a new daemon thread.
+
+    Returns:
+        A Future for the result of the call.
+    """
+    future = Future()
+    thread = threading.Thread(target=future.run, args=(func,) + args,
+                              kwargs=kwargs)
+    thread.setDaemon(True)
+    thread.start()
+    return future
+
+
+class AdaptiveLimiter(object):
+    """ Limits how many calls to a server run at once, and how often.
+
+    The number of calls allowed at once adapts to how the server is coping,
+    using additive increase and multiplicative decrease (AIMD).  Every call
+    which finishes about as quickly as the fastest call seen raises the
+    limit a little, growing it by about one for each limit's worth of
+    calls.  A call which fails with one of OVERLOAD_STATUSES, or takes more
+    than LATENCY_TOLERANCE times as long as the fastest call, cuts the limit
+    by BACKOFF_FACTOR.  Only calls started since the last cut can cut it
+    again, so a burst of failures from one overload only counts once.
+
+    Calls can also be limited to a steady rate with a token bucket, which
+    allows bursts of up to burst calls.
+    """
+    def __init__(self, max_concurrency=DEFAULT_MAX_WORKERS,
+                 initial_concurrency=DEFAULT_INITIAL_CONCURRENCY,
+                 min_concurrency=1, rate=None, burst=None):
+        """
+        Parameters:
+            max_concurrency     - the most calls ever allowed at once.
+            initial_concurrency - how many calls are allowed at once to
+                                  start with.
+            min_concurrency     - the fewest calls allowed at once, however
+                                  much the server struggles.
+            rate                - the most calls to start per second, or None
+                                  for no limit.
+            burst               - how many calls can be started at once
+                                  without regard to rate.  Defaults to one
+                                  second's worth.
+        """
+        self.max_concurrency = max_concurrency
+        self.min_concurrency = min_concurrency
+        self.limit = float(max(min_concurrency,
+                               min(initial_concurrency, max_concurrency)))
+        self.rate = rate
+        self.burst = burst or max(1, rate or 1)
+        self._in_flight = 0
+        self._min_latency = None
+        self._last_decrease = 0
+        self._tokens = float(self.burst)
+        self._last_refill = time.time()
+        self._condition = threading.Condition()
+        self._local = threading.local()
+
+    def call(self, func, *args, **kwargs):
+        """ Calls func once the limits allow, returning its result.
+
+        A call made from within another call on the same thread runs
+        straight away under the outer call's slot, since waiting for a
+        second slot while holding one could wait forever.
+        """
+        if getattr(self._local, 'holding', False):
+            return func(*args, **kwargs)
+
+        start = self.acquire()
+        self._local.holding = True
+
+        try:
+            result = func(*args, **kwargs)
+        except:
+            self._local.holding = False
+            code = getattr(sys.exc_info()[1], 'code', None)
+            self.release(start, failed=True,
+                         overloaded=code in OVERLOAD_STATUSES)
+            raise
+
+        self._local.holding = False
+        self.release(start)
+        return result
+
+    def acquire(self):
+        """ Waits until another call is allowed to start.
+
+        Returns:
+            The time the call started, to be passed to release().
+        """
+        self._condition.acquire()
+
+        try:
+            while self._in_flight >= int(self.limit):
+                self._condition.wait()
+
+            self._in_flight += 1
+        finally:
+            self._condition.release()
+
+        if self.rate:
+            self._take_token()
+
+        return time.time()
+
+    def release(self, start, failed=False, overloaded=False):
+        """ Records that a call which started at start has finished.
+
+        Parameters:
+            start      - the time returned by acquire().
+            failed     - whether the call failed.  The latency of a failed
+                         call isn't used.
+            overloaded - whether the call failed because the server was
+                         overloaded.
+        """
+        latency = time.time() - start
+
+        self._condition.acquire()
+
+        try:
+            self._in_flight -= 1
+
+            if overloaded:
+                self._decrease(start)
+            elif not failed:
+                if self._min_latency is None or latency < self._min_latency:
+                    self._min_latency = latency
+
+                base_latency = max(self._min_latency, MIN_BASE_LATENCY)
+
+                if latency > base_latency * LATENCY_TOLERANCE:
+                    self._decrease(start)
+                else:
+                    self.limit = min(self.max_concurrency,
+                                     self.limit + 1 / self.limit)
+
+            self._condition.notifyAll()
+        finally:
+            self._condition.release()
+
+    def _decrease(self, start):
+        if start >= self._last_decrease:
+            self.limit = max(self.min_concurrency,
+                             self.limit * BACKOFF_FACTOR)
+            self._last_decrease = time.time()
+
+    def _take_token(self):
+        while True:
+            self._condition.acquire()
+
+            try:
+                now = time.time()
+                self._tokens = min(self.burst,
+                                   self._tokens +
+                                   (now - self._last_refill) * self.rate)
+                self._last_refill = now
+
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+
+                delay = (1 - self._tokens) / self.rate
+            finally:
+                self._condition.release()
+
+            time.sleep(delay)
+
+
+class ThreadPool(object):
+    """ A bounded pool of worker threads which run submitted calls.
+
+    Worker threads are started as calls are submitted, up to max_workers of
+    them.  Calls beyond that wait in a queue for a free worker.  If a
+    limiter is given, each call is also made through its AdaptiveLimiter,
+    which may allow fewer calls than max_workers to run at once.
+    """
+    def __init__(self, max_workers=DEFAULT_MAX_WORKERS, limiter=None):
+        self.max_workers = max_workers
+        self.limiter = limiter
+        self._queue = Queue.Queue()
+        self._threads = []
+        self._lock = threading.Lock()
+
+    def submit(self, func, *args, **kwargs):
+        """ Queues a call to func to be run by a worker thread.
+
+        Returns:
+            A Future for the result of the call.
+        """
+        future = Future()
+        self._queue.put((future, func, args, kwargs))
+
+        self._lock.acquire()
+
+        try:
+            if len(self._threads) < self.max_workers:
+                thread = threading.Thread(target=self._work)
+                thread.setDaemon(True)
+                thread.start()
+                self._threads.append(thread)
+        finally:
+            self._lock.release()
+
+        return future
+
+    def map(self, func, items):
+        """ Calls func once for each of items, using the worker threads.
+
+        Returns:
+            A list of Futures for the results, in the same order as items.
+        """
+        return [self.submit(func, item) for item in items]
+
+    def shutdown(self, wait=True):
+        """ Stops the worker threads once all queued calls have finished.
+        """
+        self._lock.acquire()
+
+        try:
+            threads = self._threads
+            self._threads = []
+        finally:
+            self._lock.release()
+
+        for thread in threads:
+            self._queue.put(None)
+
+        if wait:
+            for thread in threads:
+                thread.join()
+
+    def _work(self):
+        while True:
+            work = self._queue.get()
+
+            if work is None:
+                break
+
+            future, func, args, kwargs = work
+
+            if self.limiter:
+                future.run(self.limiter.call, func, *args, **kwargs)
+            else:
+                future.run(func, *args, **kwargs)
@@ -0,0 +1,176 @@
+import atexit
+import cookielib
+import os
+import threading
+import weakref
+
+from rbtools.api.fileutils import lock_file, replace_file, unlock_file
+
+
+DEFAULT_FLUSH_DELAY = 30
+
+# Servers which give cookies a Max-Age send a slightly later expiry time
+# with each response.  Changes to the expiry smaller than this many seconds
+# aren't worth writing out.
+EXPIRES_SLACK = 60
+
+# Every jar which may still have cookies to write out at exit.  The set is
+# weak, so it doesn't keep jars which are no longer used alive.
+_open_jars = weakref.WeakSet()
+
+
+class PersistentCookieJar(cookielib.MozillaCookieJar):
+    """ A cookie jar which only writes to disk when its cookies change.
+
+    Cookies are loaded from the cookie file once and kept in memory.  Setting
+    a cookie which is already held with the same value doesn't mark the jar
+    as changed, so the common case of the server repeating the session
+    cookie costs nothing.  Changed cookies are written back once flush_delay
+    seconds after the first change, and again when the process exits.
+
+    The cookie file is written to a temporary file which then replaces it,
+    while holding a lock on a companion ".lock" file, so that several
+    processes sharing the cookie file can never leave it half written.
+    """
+    def __init__(self, filename, flush_delay=DEFAULT_FLUSH_DELAY):
+        """
+        Parameters:
+            filename    - the path of the cookie file, or None to keep the
+                          cookies in memory only
+            flush_delay - how many seconds to wait after a change before
+                          writing the cookies out.  If None, changes are only
+                          written by flush() and at exit.
+        """
+        cookielib.MozillaCookieJar.__init__(self, filename)
+        self.flush_delay = flush_delay
+        self.dirty = False
+        self._timer = None
+        self._flush_lock = threading.Lock()
+        self._loading = False
+
+        if filename and os.path.isfile(filename):
+            self._locked_load()
+
+        _open_jars.add(self)
+
+    def set_cookie(self, cookie):
+        if not self._holds_same_cookie(cookie):
+            cookielib.MozillaCookieJar.set_cookie(self, cookie)
+
+            # load() adds the cookies it reads through set_cookie(), but
+            # they're already in the file.
+            if not self._loading:
+                self._mark_dirty()
+
+    def clear(self, domain=None, path=None, name=None):
+        cookielib.MozillaCookieJar.clear(self, domain, path, name)
+        self._mark_dirty()
+
+    def has_valid_cookie(self, host, path, name):
+        """ Returns true if an unexpired cookie called name is held for the
+        given host and path.
+        """
+        try:
+            return not self._cookies[host][path][name].is_expired()
+        except KeyError:
+            return False
+
+    def flush(self):
+        """ Writes the cookies to the cookie file if they have changed.
+
+        Returns:
+            True if the cookie file was written.
+        """
+        self._flush_lock.acquire()
+
+        try:
+            if self._timer:
+                self._timer.cancel()
+                self._timer = None
+
+            if not self.dirty or not self.filename:
+                return False
+
+            self.dirty = False
+        finally:
+            self._flush_lock.release()
+
+        try:
+            self._locked_save()
+        except (IOError, OSError):
+            self.dirty = True
+            raise
+
+        return True
+
+    def _flush_quietly(self):
+        # Used at exit and from the timer, where there's no caller to
+        # report a failure to.  The cookies stay dirty, so a later flush
+        # can try again.
+        try:
+            self.flush()
+        except (IOError, OSError):
+            pass
+
+    def _holds_same_cookie(self, cookie):
+        try:
+            held = self._cookies[cookie.domain][cookie.path][cookie.name]
+        except KeyError:
+            return False
+
+        return (held.value == cookie.value and
+                held.secure == cookie.secure and
+                _same_expiry(held.expires, cookie.expires))
+
+    def _mark_dirty(self):
+        self._flush_lock.acquire()
+
+        try:
+            self.dirty = True
+
+            if self.flush_delay is not None and self._timer is None:
+                self._timer = threading.Timer(self.flush_delay,
+                                              self._flush_quietly)
+                self._timer.setDaemon(True)
+                self._timer.start()
+        finally:
+            self._flush_lock.release()
+
+    def _locked_load(self):
+        lock = lock_file(self.filename, shared=True)
+
+        self._loading = True
+
+        try:
+            try:
+                self.load(ignore_expires=True)
+            except IOError:
+                # An unreadable cookie file just means logging in again.
+                # It's replaced the next time the cookies are written.
+                pass
+        finally:
+            self._loading = False
+            unlock_file(lock)
+
+    def _locked_save(self):
+        lock = lock_file(self.filename)
+
+        try:
+            replace_file(self.filename, self.save)
+        finally:
+            unlock_file(lock)
+
+
+def _same_expiry(expires, other_expires):
+    if expires is None or other_expires is None:
+        return expires == other_expires
+
+    return abs(expires - other_expires) < EXPIRES_SLACK
+
+
+def _flush_open_jars():
+    for jar in list(_open_jars):
+        jar._flush_quietly()
+
+
+atexit.register(_flush_open_jars)
@@ -16,6 +16,15 @@ class ServerInterfaceError(Exception):
         return self.msg
 
 
+class ConcurrencyError(Exception):
+    def __init__(self, msg, *args, **kwargs):
+        Exception.__init__(self, *args, **kwargs)
+        self.msg = msg
+
+    def __str__(self):
+        return self.msg
+
+
 class ChildResourceUncreatableError(ResourceError):
     pass
 
@@ -50,3 +59,11 @@ class InvalidRequestMethodError(ServerInterfaceError):
 
 class AuthenticationFailedError(ServerInterfaceError):
     pass
+
+
+class RequestTimeoutError(ServerInterfaceError):
+    pass
+
+
+class FutureTimeoutError(ConcurrencyError):
+    pass
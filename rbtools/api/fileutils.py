@@ -0,0 +1,69 @@
+import os
+import tempfile
+
+try:
+    import fcntl
+except ImportError:
+    # File locking isn't available on Windows.  Files are still replaced
+    # atomically, but concurrent writers aren't serialized.
+    fcntl = None
+
+
+def lock_file(path, shared=False):
+    """ Takes a lock on a companion ".lock" file for path.
+
+    Parameters:
+        path   - the path of the file to be locked.
+        shared - if true, a shared lock for reading is taken rather than an
+                 exclusive lock for writing.
+
+    Returns:
+        The lock, which should be passed to unlock_file() once done.
+    """
+    if fcntl is None:
+        return None
+
+    lock = open(path + '.lock', 'a')
+
+    if shared:
+        fcntl.flock(lock.fileno(), fcntl.LOCK_SH)
+    else:
+        fcntl.flock(lock.fileno(), fcntl.LOCK_EX)
+
+    return lock
+
+
+def unlock_file(lock):
+    """ Releases a lock taken by lock_file().
+    """
+    if lock is not None:
+        fcntl.flock(lock.fileno(), fcntl.LOCK_UN)
+        lock.close()
+
+
+def replace_file(path, write):
+    """ Atomically replaces the file at path.
+
+    write is called with the path of a temporary file in the same directory,
+    which it should write the new contents to.  That file then replaces the
+    one at path, so readers never see a partially written file.  The caller
+    should hold an exclusive lock_file() lock on path.
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, temp_path = tempfile.mkstemp(prefix='.%s-' % os.path.basename(path),
+                                     dir=directory)
+    os.close(fd)
+
+    try:
+        write(temp_path)
+
+        if os.name == 'nt' and os.path.exists(path):
+            # Windows won't rename over an existing file.
+            os.remove(path)
+
+        os.rename(temp_path, path)
+    except:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+        raise
@@ -0,0 +1,230 @@
+import mimetools
+import os
+import shutil
+import tempfile
+import urllib2
+
+try:
+    from cStringIO import StringIO
+except ImportError:
+    from StringIO import StringIO
+
+
+CHUNK_SIZE = 64 * 1024
+
+
+class MultipartBody(object):
+    """ A multipart/form-data request body which is read as it is sent.
+
+    Rather than building the whole body as one string, the body is kept as a
+    sequence of parts which are read one after another.  File contents can be
+    given as strings, open file objects, paths to local files, or iterables
+    of strings (such as generators), so that large files never have to be
+    held in memory.  The length of the body is computed up front so that a
+    Content-Length header can be sent.
+
+    File objects which can't seek (such as stdin) and iterables are first
+    spooled to a temporary file in CHUNK_SIZE pieces, since their length
+    can't be known otherwise.
+    """
+    def __init__(self, fields=None, files=None, boundary=None):
+        """
+        Parameters:
+            fields   - the fields to be encoded.  This should be a dict in a
+                       key:value format
+            files    - the files to be encoded.  This should be a dict in a
+                       key:dict format, where each dict has a filename key
+                       and either a content key (holding a string, file
+                       object or iterable of strings) or a path key (holding
+                       the path to a local file).
+            boundary - the boundary to use between parts.  By default, a
+                       unique boundary is chosen.
+        """
+        self.boundary = boundary or mimetools.choose_boundary()
+        self.content_type = \
+            'multipart/form-data; boundary=%s' % self.boundary
+        self._parts = []
+        self._index = 0
+        self._current = None
+
+        fields = fields or {}
+        files = files or {}
+
+        for key in fields:
+            self._parts.append(_StringPart(
+                '--%s\r\n'
+                'Content-Disposition: form-data; name="%s"\r\n'
+                '\r\n' % (self.boundary, key)))
+            self._parts.append(_StringPart(fields[key]))
+            self._parts.append(_StringPart('\r\n'))
+
+        for key in files:
+            self._parts.append(_StringPart(
+                '--%s\r\n'
+                'Content-Disposition: form-data; name="%s"; '
+                'filename="%s"\r\n'
+                '\r\n' % (self.boundary, key, files[key]['filename'])))
+
+            if 'path' in files[key]:
+                self._parts.append(_PathPart(files[key]['path']))
+            else:
+                self._parts.append(_make_part(files[key]['content']))
+
+            self._parts.append(_StringPart('\r\n'))
+
+        self._parts.append(_StringPart('--%s--\r\n\r\n' % self.boundary))
+        self._length = sum([part.length for part in self._parts])
+
+    def __len__(self):
+        return self._length
+
+    def read(self, size=-1):
+        """ Reads up to size bytes of the body, or all of it if size < 0.
+        """
+        chunks = []
+
+        while self._index < len(self._parts) and size != 0:
+            if self._current is None:
+                self._current = self._parts[self._index].open()
+
+            data = self._current.read(size)
+
+            if data:
+                chunks.append(data)
+
+                if size > 0:
+                    size -= len(data)
+            else:
+                self._parts[self._index].close(self._current)
+                self._current = None
+                self._index += 1
+
+        return ''.join(chunks)
+
+    def seek(self, offset, whence=0):
+        """ Rewinds the body so that it can be sent again.
+
+        Only seeking to the start of the body is supported.
+        """
+        if offset != 0 or whence != 0:
+            raise IOError('MultipartBody can only seek to the start.')
+
+        self.close()
+        self._index = 0
+
+    def close(self):
+        """ Closes any file opened to read the current part.
+        """
+        if self._current is not None:
+            self._parts[self._index].close(self._current)
+            self._current = None
+
+    def getvalue(self):
+        """ Returns the whole body as a string.
+        """
+        self.seek(0)
+        value = self.read()
+        self.seek(0)
+        return value
+
+
+class RewindBodyProcessor(urllib2.BaseHandler):
+    """ Rewinds streamed request bodies before each attempt at a request.
+
+    urllib2 sends the same request again after an authentication challenge,
+    by which point a streamed body, such as a MultipartBody, has already
+    been read.
+    """
+    def http_request(self, req):
+        if hasattr(req.get_data(), 'seek'):
+            req.get_data().seek(0)
+
+        return req
+
+    https_request = http_request
+
+
+class _StringPart(object):
+    def __init__(self, data):
+        if isinstance(data, unicode):
+            data = data.encode('utf-8')
+
+        self.data = data
+        self.length = len(data)
+
+    def open(self):
+        return StringIO(self.data)
+
+    def close(self, fp):
+        pass
+
+
+class _FilePart(object):
+    def __init__(self, fp, start, length):
+        self.fp = fp
+        self.start = start
+        self.length = length
+
+    def open(self):
+        self.fp.seek(self.start)
+        return _BoundedReader(self.fp, self.length)
+
+    def close(self, fp):
+        pass
+
+
+class _PathPart(object):
+    def __init__(self, path):
+        self.path = path
+        self.length = os.path.getsize(path)
+
+    def open(self):
+        return _BoundedReader(open(self.path, 'rb'), self.length)
+
+    def close(self, fp):
+        fp.fp.close()
+
+
+class _BoundedReader(object):
+    """ Reads at most length bytes from a file object.
+    """
+    def __init__(self, fp, length):
+        self.fp = fp
+        self.remaining = length
+
+    def read(self, size=-1):
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+
+        data = self.fp.read(min(size, CHUNK_SIZE))
+        self.remaining -= len(data)
+        return data
+
+
+def _make_part(content):
+    """ Returns the part which reads content.
+    """
+    if isinstance(content, basestring):
+        return _StringPart(content)
+
+    if hasattr(content, 'read'):
+        try:
+            start = content.tell()
+            content.seek(0, os.SEEK_END)
+            length = content.tell() - start
+            content.seek(start)
+            return _FilePart(content, start, length)
+        except (AttributeError, IOError, OSError):
+            # The file can't seek, so spool it below.
+            pass
+
+    spool = tempfile.TemporaryFile()
+
+    if hasattr(content, 'read'):
+        shutil.copyfileobj(content, spool, CHUNK_SIZE)
+    else:
+        for chunk in content:
+            spool.write(chunk)
+
+    length = spool.tell()
+    return _FilePart(spool, 0, length)
@@ -0,0 +1,252 @@
+import httplib
+import Queue
+import random
+import socket
+import threading
+import time
+import urllib2
+
+from rbtools.api.concurrency import run_in_background
+from rbtools.api.errors import RequestTimeoutError
+
+
+# How long, in seconds, a single attempt at a request may wait on the
+# server before giving up.
+DEFAULT_TIMEOUT = 60
+
+DEFAULT_MAX_RETRIES = 3
+
+# The delay before the first retry, in seconds.  It doubles with each retry,
+# up to DEFAULT_MAX_BACKOFF.
+DEFAULT_BACKOFF = 0.5
+DEFAULT_MAX_BACKOFF = 8
+
+# Only these methods are retried, since repeating them has no further
+# effect on the server.
+IDEMPOTENT_METHODS = ('GET', 'PUT', 'DELETE')
+
+# Responses with these statuses are likely to succeed if retried.
+RETRYABLE_STATUSES = (500, 502, 503, 504)
+
+# How many GET latencies are remembered, and how many are needed before
+# hedging starts.
+LATENCY_SAMPLES = 100
+MIN_HEDGE_SAMPLES = 20
+
+
+class LatencyTracker(object):
+    """ Tracks the latencies of recent requests.
+    """
+    def __init__(self, max_samples=LATENCY_SAMPLES):
+        self.max_samples = max_samples
+        self._samples = []
+        self._lock = threading.Lock()
+
+    def record(self, latency):
+        """ Records the latency, in seconds, of a request.
+        """
+        self._lock.acquire()
+
+        try:
+            self._samples.append(latency)
+            del self._samples[:-self.max_samples]
+        finally:
+            self._lock.release()
+
+    def get_percentile(self, percentile, min_samples=1):
+        """ Returns the given percentile of the recent latencies.
+
+        Returns None if fewer than min_samples latencies have been recorded.
+        """
+        self._lock.acquire()
+
+        try:
+            samples = sorted(self._samples)
+        finally:
+            self._lock.release()
+
+        if not samples or len(samples) < min_samples:
+            return None
+
+        index = int(round(percentile / 100.0 * (len(samples) - 1)))
+        return samples[index]
+
+
+class RequestPolicy(object):
+    """ Decides how long requests may take and how failures are retried.
+
+    Each attempt at a request is given a timeout, and a whole call can be
+    given a deadline, so that a hung connection can't stall the caller
+    forever.  Requests using IDEMPOTENT_METHODS which fail with a connection
+    error or one of RETRYABLE_STATUSES are retried, after an exponentially
+    growing, jittered delay.
+
+    If hedge_percentile is set, a GET which has taken longer than that
+    percentile of recent GETs is sent a second time, and whichever copy
+    finishes first is used.  This trims the slowest requests, at the cost
+    of occasionally making a request twice.
+    """
+    def __init__(self, timeout=DEFAULT_TIMEOUT, deadline=None,
+                 max_retries=DEFAULT_MAX_RETRIES, backoff=DEFAULT_BACKOFF,
+                 max_backoff=DEFAULT_MAX_BACKOFF, hedge_percentile=None):
+        """
+        Parameters:
+            timeout          - how long, in seconds, a single attempt may
+                               wait on the server, or None to wait forever.
+            deadline         - how long, in seconds, a call may take in
+                               total, including retries, or None for no
+                               limit.  This can be overridden for each call.
+            max_retries      - how many times a failed request is retried.
+            backoff          - the delay, in seconds, before the first retry.
+            max_backoff      - the longest delay, in seconds, between
+                               retries.
+            hedge_percentile - the percentile of recent GET latencies after
+                               which a GET is sent a second time, such as 95.
+                               If None, GETs aren't hedged.
+        """
+        self.timeout = timeout
+        self.deadline = deadline
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.hedge_percentile = hedge_percentile
+        self.latencies = LatencyTracker()
+
+    def call(self, method, attempt, deadline=None):
+        """ Makes a request according to the policy.
+
+        Parameters:
+            method   - the HTTP method of the request.
+            attempt  - a function which makes one attempt at the request.
+                       It's passed the timeout for the attempt, and returns
+                       the result of the request.
+            deadline - how long, in seconds, the call may take in total.
+                       Defaults to the policy's deadline.
+
+        Returns:
+            The result of the first successful attempt.
+        """
+        if deadline is None:
+            deadline = self.deadline
+
+        if deadline is not None:
+            end = time.time() + deadline
+        else:
+            end = None
+
+        retries = 0
+
+        while True:
+            timeout = self._get_timeout(end)
+
+            try:
+                if method == 'GET':
+                    return self._call_get(attempt, timeout)
+                else:
+                    return attempt(timeout)
+            except Exception, e:
+                if retries >= self.max_retries or \
+                   not self._should_retry(method, e):
+                    if _is_timeout(e):
+                        raise RequestTimeoutError(
+                            'The server did not respond in time.')
+
+                    raise
+
+                delay = min(self.max_backoff, self.backoff * 2 ** retries)
+                delay *= random.uniform(0.5, 1)
+
+                if end is not None and time.time() + delay >= end:
+                    raise RequestTimeoutError(
+                        'The request did not succeed before its deadline.')
+
+                if isinstance(e, urllib2.HTTPError):
+                    # Let the connection go back to the pool.
+                    e.close()
+
+                time.sleep(delay)
+                retries += 1
+
+    def _get_timeout(self, end):
+        if end is None:
+            return self.timeout
+
+        remaining = end - time.time()
+
+        if remaining <= 0:
+            raise RequestTimeoutError(
+                'The request did not succeed before its deadline.')
+
+        if self.timeout is None:
+            return remaining
+
+        return min(self.timeout, remaining)
+
+    def _should_retry(self, method, e):
+        if method not in IDEMPOTENT_METHODS:
+            return False
+
+        if isinstance(e, urllib2.HTTPError):
+            return e.code in RETRYABLE_STATUSES
+
+        return isinstance(e, (urllib2.URLError, socket.error,
+                              httplib.HTTPException))
+
+    def _call_get(self, attempt, timeout):
+        """ Makes one attempt at a GET, hedging it if it's slow.
+        """
+        start = time.time()
+        hedge_delay = None
+
+        if self.hedge_percentile is not None:
+            hedge_delay = self.latencies.get_percentile(
+                self.hedge_percentile, MIN_HEDGE_SAMPLES)
+
+        if hedge_delay is None or (timeout is not None and
+                                   hedge_delay >= timeout):
+            result = attempt(timeout)
+        else:
+            result = self._hedge(attempt, timeout, hedge_delay)
+
+        self.latencies.record(time.time() - start)
+        return result
+
+    def _hedge(self, attempt, timeout, hedge_delay):
+        finished = Queue.Queue()
+        futures = [run_in_background(attempt, timeout)]
+        futures[0].add_done_callback(finished.put)
+
+        try:
+            future = finished.get(True, hedge_delay)
+        except Queue.Empty:
+            futures.append(run_in_background(attempt, timeout))
+            futures[1].add_done_callback(finished.put)
+            future = finished.get()
+
+            if future.exception() is not None:
+                # The first copy to finish failed, so go with the other.
+                future = finished.get()
+
+        for other in futures:
+            if other is not future:
+                other.add_done_callback(_close_result)
+
+        return future.result()
+
+
+def _close_result(future):
+    """ Closes the response of a hedged request which lost the race.
+    """
+    if future.exception() is None:
+        result = future.result()
+
+        if hasattr(result, 'close'):
+            result.close()
+
+
+def _is_timeout(e):
+    if isinstance(e, urllib2.URLError) and \
+       not isinstance(e, urllib2.HTTPError):
+        e = e.reason
+
+    return isinstance(e, socket.timeout)
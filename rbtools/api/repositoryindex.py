@@ -0,0 +1,70 @@
+class RepositoryIndex(object):
+    """ Looks up a server's repositories without scanning the whole list.
+
+    The index is built from the repositories' payloads, as dicts, and maps
+    each repository's path and mirror path, and the UUID of each Subversion
+    repository, to the repositories which have it.  The UUIDs come from the
+    repositories' info, which is stored in each payload's 'info' key.
+
+    The dicts are plain JSON data, so the index can be saved and restored
+    with get_repositories() and the constructor.
+    """
+    def __init__(self, repositories):
+        """
+        Parameters:
+            repositories - the payloads of the server's repositories, as
+                           dicts, in the order the server lists them.
+        """
+        self.repositories = repositories
+        self._by_path = {}
+        self._by_uuid = {}
+
+        for repository in repositories:
+            for key in ('path', 'mirror_path'):
+                path = repository.get(key)
+
+                if path:
+                    self._by_path.setdefault(path, repository)
+
+            info = repository.get('info')
+
+            if info and info.get('uuid'):
+                self._by_uuid.setdefault(info['uuid'], []).append(repository)
+
+    def get_repositories(self):
+        """ Returns the payloads of every repository in the index.
+        """
+        return self.repositories
+
+    def get_by_path(self, paths):
+        """ Finds the repository with one of the given paths.
+
+        Parameters:
+            paths - the path to look up, or a list of alternative paths
+                    (aliases) for the same repository.  Both repository paths
+                    and mirror paths are matched.
+
+        Returns:
+            The payload of the matching repository, or None.  If several of
+            the paths match, the repository listed first by the server is
+            returned.
+        """
+        if isinstance(paths, basestring):
+            paths = [paths]
+
+        found = [self._by_path[path] for path in paths
+                 if path in self._by_path]
+
+        if not found:
+            return None
+
+        return min(found, key=self.repositories.index)
+
+    def get_by_uuid(self, uuid):
+        """ Returns the payloads of the Subversion repositories with uuid.
+
+        Several repositories on the server can share a UUID, for example when
+        they point to different directories in the same repository.  They're
+        returned in the order the server lists them.
+        """
+        return self._by_uuid.get(uuid, [])
@@ -1,15 +1,22 @@
+import os
 import re
+import time
+import urllib
 import urllib2
 
 import serverinterface
+from concurrency import DEFAULT_MAX_WORKERS, ThreadPool, run_in_background
 from errors import *
+from repositoryindex import RepositoryIndex
 
 try:
-    from json import loads as json_loads
+    from json import dumps as json_dumps, loads as json_loads
 except ImportError:
-    from simplejson import loads as json_loads
+    from simplejson import dumps as json_dumps, loads as json_loads
 
 
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+
 RESOURCE = 'Resource'
 RESOURCE_LIST = 'Resource List'
 ROOT_RESOURCE = 'Root Resource'
@@ -27,10 +34,15 @@ class ResourceBase(object):
         self.resource_string = None
         self.data = {}
         self._queryable = False
+        self._query = {}
 
     def __str__(self):
         if self.resource_string:
             return self.resource_string
+        elif self._queryable:
+            # Resources populated from their parent list's payload have no
+            # response body of their own.
+            return json_dumps(self.data)
         else:
             return "Unloaded Resource."
 
@@ -168,6 +180,66 @@ class ResourceBase(object):
         """
         return self.server_interface.get(self.url, accept)
 
+    def download_file(self, destination, accept='*/*',
+                      chunk_size=DOWNLOAD_CHUNK_SIZE, progress=None):
+        """ Streams the file located at the current path to destination.
+
+        This is like get_file(), except that the response is written out in
+        chunk_size pieces as it arrives instead of being returned as one
+        string, so memory use stays the same no matter how large the file is.
+
+        Parameters:
+            destination - the path to write the file to, or a file object to
+                          write it into.
+            accept      - the mime type to request.
+            chunk_size  - the number of bytes to read and write at a time.
+            progress    - an optional function which is called after each
+                          chunk with the number of bytes written so far and
+                          the number of seconds elapsed.
+
+        Returns:
+            A (bytes_written, seconds_elapsed) tuple.
+
+        If the download fails part way through, a file created at the
+        destination path is removed before the error is raised.
+        """
+        start = time.time()
+        bytes_written = 0
+        response = self.server_interface.get_stream(self.url, accept)
+
+        try:
+            if isinstance(destination, basestring):
+                fp = open(destination, 'wb')
+            else:
+                fp = destination
+
+            try:
+                try:
+                    while True:
+                        chunk = response.read(chunk_size)
+
+                        if not chunk:
+                            break
+
+                        fp.write(chunk)
+                        bytes_written += len(chunk)
+
+                        if progress:
+                            progress(bytes_written, time.time() - start)
+                finally:
+                    if fp is not destination:
+                        fp.close()
+            except:
+                if fp is not destination and os.path.exists(destination):
+                    # Don't leave a partially written file behind.
+                    os.remove(destination)
+
+                raise
+        finally:
+            response.close()
+
+        return bytes_written, time.time() - start
+
     def _load(self):
         """ Loads and populates data from the server.
 
@@ -175,19 +247,94 @@ class ResourceBase(object):
         Once complete, the data received is loaded into this resource's data
         dictionary and it is verified that the request was successful.
         """
-        self.resource_string = self.server_interface.get(self.url)
-        self.data = json_loads(self.resource_string)
+        self._populate(*self._fetch(_add_query(self.url, **self._query)))
+
+    def _populate(self, resource_string, data):
+        """ Populates the resource from an already retrieved response.
+
+        Parameters:
+            resource_string - the raw response body for this resource.
+            data            - the parsed response body for this resource.
+        """
+        self.resource_string = resource_string
+        self.data = data
         self._queryable = True
 
         if not self.is_ok():
             raise RequestFailedError(
                 'The resource requested could not be retrieved.')
 
+    def _fetch(self, url):
+        """ Retrieves and parses the resource at url.
+
+        Each url is only retrieved once per run: later calls, including ones
+        made while it's still being retrieved, get the result remembered by
+        the server interface's request memo, until the url is changed.
+
+        Returns:
+            A (resource_string, data) tuple.
+        """
+        return self.server_interface.request_memo.get(url, self._retrieve,
+                                                      url)
+
+    def _retrieve(self, url):
+        """ Retrieves and parses the resource at url from the server.
+
+        Slow-changing resources, such as the root, are returned from the
+        server interface's on-disk metadata cache while they're fresh.
+        Otherwise, this makes a conditional HTTP GET to the server using any
+        validators cached from a previous retrieval of the url.  If the
+        server reports that the resource has not been modified, the cached
+        resource string and data are returned without being downloaded or
+        parsed again.
+
+        Returns:
+            A (resource_string, data) tuple.
+        """
+        metadata = self.server_interface.metadata_cache.get(url)
+
+        if metadata:
+            return metadata
+
+        cache = self.server_interface.validator_cache
+        cached = cache.get(url)
+        resource_string, info = \
+            self.server_interface.get_conditional(url, cached)
+
+        if resource_string is None:
+            return cached.resource_string, cached.data
+
+        data = json_loads(resource_string)
+        cache.set(url, resource_string, data, info.getheader('ETag'),
+                  info.getheader('Last-Modified'))
+
+        if data.get('stat') == 'ok':
+            self.server_interface.metadata_cache.set(url, resource_string)
+
+        return resource_string, data
+
     def refresh(self):
         """ Refreshes the resource from the server.
+
+        Any copy of the resource remembered in memory or in the on-disk
+        metadata cache is discarded, so that it's always retrieved from the
+        server.
         """
+        self.server_interface.request_memo.invalidate(self.url)
+        self.server_interface.metadata_cache.invalidate(self.url)
         self._load()
 
+    def _set_query(self, expand=None, only_fields=None, only_links=None):
+        """ Sets what the server should include when this is retrieved.
+
+        See _add_query() for the parameters.
+        """
+        self._query = {
+            'expand': expand,
+            'only_fields': only_fields,
+            'only_links': only_links,
+        }
+
     def query_resource_type(self, resource_url):
         """ Queries the url and returns its resource type
 
@@ -202,14 +349,42 @@ class ResourceBase(object):
         else:
             # HTTP GET the resource to find out if it is a resource list
             # or a resource
-            resp = self.server_interface.get(resource_url)
-            data_list = json_loads(resp)
+            resp, data_list = self._fetch(resource_url)
 
             if _is_resource_list(data_list):
                 return RESOURCE_LIST
             else:
                 return RESOURCE
 
+    def _get_resource(self, url, resource_string=None, data=None,
+                      expand=None, only_fields=None, only_links=None):
+        """ Returns the loaded resource at url.
+
+        The resource is retrieved with a single GET, and that response is
+        used both to determine the type of the resource and to populate it.
+        If resource_string and data are given they are used instead of
+        retrieving the resource.  See _add_query() for the other parameters.
+
+        Returns:
+            A Resource, ResourceList or RootResource, depending on the type of
+            the resource at url.
+        """
+        if re.search('(api/)$', url):
+            return RootResource(self.server_interface, url)
+
+        if data is None:
+            resource_string, data = self._fetch(
+                _add_query(url, expand, only_fields, only_links))
+
+        if _is_resource_list(data):
+            return ResourceList(self.server_interface, url, resource_string,
+                                data, expand, only_fields, only_links)
+        else:
+            rsc = Resource(self.server_interface, url, expand, only_fields,
+                           only_links)
+            rsc._populate(resource_string, data)
+            return rsc
+
 
 class Resource(ResourceBase):
     """ An object which specifically deals with resources.
@@ -225,10 +400,15 @@ class Resource(ResourceBase):
         If on the other hand the resource is "got" then it already exists on
         the server.  In this case, after being instantiated _load() should be
         called on the resource to perform a GET to the server.
+
+        A "got" resource can be retrieved with its links expanded, or with
+        only some of its fields or links.  See _add_query().
     """
-    def __init__(self, server_interface, url):
+    def __init__(self, server_interface, url, expand=None, only_fields=None,
+                 only_links=None):
         super(Resource, self).__init__(server_interface)
         self.url = url
+        self._set_query(expand, only_fields, only_links)
         self.resource_type = RESOURCE
         self.updates = {}
         self.file_updates = {}
@@ -290,10 +470,10 @@ class Resource(ResourceBase):
         # future calls will go to the right place.
         self.url = self.get_link('self')
 
-    def _load(self):
-        """ Loads the resource from the server.
+    def _populate(self, resource_string, data):
+        """ Populates the resource from an already retrieved response.
         """
-        super(Resource, self)._load()
+        super(Resource, self)._populate(resource_string, data)
         self._determine_resource_name()
 
     def get_field(self, key_list):
@@ -375,44 +555,94 @@ class Resource(ResourceBase):
                 pass
             else:
                 raise e
+        else:
+            # If the post returned the resource at url itself, there is no
+            # need to retrieve it again.
+            try:
+                data = json_loads(resp)
+                hrefs = [v['links']['self']['href'] for v in data.values()
+                         if isinstance(v, dict) and 'links' in v]
+            except (ValueError, KeyError, TypeError, AttributeError):
+                data = None
+                hrefs = []
 
-        target_resource_type = self.query_resource_type(url)
+            if hrefs == [url] and data.get('stat') == 'ok':
+                return self._get_resource(url, resp, data)
 
-        if target_resource_type == RESOURCE_LIST:
-            return ResourceList(self.server_interface, url)
-        elif target_resource_type == RESOURCE:
-            rsc = Resource(self.server_interface, url)
-            # _load it before returning it
-            rsc._load()
-            return rsc
-        else:
-            return RootResource(self.server_interface, url)
+        return self._get_resource(url)
+
+    def get_expanded(self, link):
+        """ Returns the resource at link, using its expanded copy if any.
+
+        If this resource was retrieved with link in expand, the server
+        embedded the linked resource, or list of resources, in this one's
+        payload, and that is used without making another request.
+        Otherwise the resource is retrieved from the server.
+
+        Returns:
+            A Resource populated from the expanded copy, or a list of them
+            for an expanded list.  If link wasn't expanded, the loaded
+            Resource or ResourceList.
+        """
+        try:
+            expanded = self.get_field(link)
+        except InvalidKeyError:
+            expanded = None
+
+        if isinstance(expanded, dict):
+            try:
+                url = self.get_link(link)
+            except InvalidKeyError:
+                url = _get_self_url(expanded)
+
+            return _make_resource(self.server_interface, url, link, expanded)
+        elif (isinstance(expanded, list) and
+              all(isinstance(item, dict) for item in expanded)):
+            name = _singularize(link)
+            return [_make_resource(self.server_interface,
+                                   _get_self_url(item), name, item)
+                    for item in expanded]
+
+        return self._get_resource(self.get_link(link))
 
 
 class ResourceListBase(ResourceBase):
     """ An base object which specifically deals with lists of resources.
     """
-    def __init__(self, server_interface, url):
+    def __init__(self, server_interface, url, resource_string=None,
+                 data=None, expand=None, only_fields=None, only_links=None):
         super(ResourceListBase, self).__init__(server_interface)
         self.url = url
         self.resource_type = RESOURCE_LIST
+        self._set_query(expand, only_fields, only_links)
         # Set the _index for iteration to -1.  Each call to next() will first
         # increment the index then attempt to return the item
         self._index = -1
-        self._load()
 
-    def get(self, field_id):
+        # If the list has already been retrieved, populate it from that
+        # response rather than loading it again.
+        if data is None:
+            self._load()
+        else:
+            self._populate(resource_string, data)
+
+    def get(self, field_id, expand=None, only_fields=None, only_links=None):
         """ Gets the resource specified relative to this resource list.
 
         Gets and returns the child resource specified by field_id.  The type
         of resource returned is dependant on the field_id specified.
 
         Parameters:
-            field_id - the field id with which to get the child resource.  If
-                       the resource being retrieved is a resource list then
-                       field_id must be one of the items in self.get_links().
-                       Otherwise, the field_id should be the database 'id' of
-                       the child resource to retrieve.
+            field_id    - the field id with which to get the child resource.
+                          If the resource being retrieved is a resource list
+                          then field_id must be one of the items in
+                          self.get_links().  Otherwise, the field_id should be
+                          the database 'id' of the child resource to
+                          retrieve.
+            expand      - the links of the child to expand.  See
+                          _add_query().
+            only_fields - the only fields the child should include.
+            only_links  - the only links the child should include.
 
         Returns:
             The child resource specified by field_id, which could be either a
@@ -423,7 +653,8 @@ class ResourceListBase(ResourceBase):
         """
         if str(field_id).isdigit():
             child_url = self.url + str(field_id) + '/'
-            rsc = Resource(self.server_interface, child_url)
+            rsc = Resource(self.server_interface, child_url, expand,
+                           only_fields, only_links)
             rsc._load()
             return rsc
         else:
@@ -435,29 +666,64 @@ class ResourceListBase(ResourceBase):
                     # be a child resource whos id isn't numeric
                     try:
                         child_url = self.url + field_id + '/'
-                        rsc = Resource(self.server_interface, child_url)
+                        rsc = Resource(self.server_interface, child_url,
+                                       expand, only_fields, only_links)
                         rsc._load()
                         return rsc
                     except urllib2.HTTPError, e:
                         raise RequestFailedError(
                             'The resource child could not be retrieved.')
 
-                target_resource_type = self.query_resource_type(url)
-
-                if target_resource_type == RESOURCE_LIST:
-                    return ResourceList(self.server_interface, url)
-                elif target_resource_type == RESOURCE:
-                    rsc = Resource(self.server_interface, url)
-                    # _load it before returning it
-                    rsc._load()
-                    return rsc
-                else:
-                    return RootResource(self.server_interface, url)
+                return self._get_resource(url, expand=expand,
+                                          only_fields=only_fields,
+                                          only_links=only_links)
             else:
                 raise UnknownResourceNameError(
                     'The resource link could not be retrieved because '
                     'this resource does not contain the link specified.')
 
+    def get_many(self, field_ids, max_workers=DEFAULT_MAX_WORKERS,
+                 expand=None, only_fields=None, only_links=None):
+        """ Gets several resources relative to this resource list at once.
+
+        Each of field_ids is passed to get(), with up to max_workers of the
+        requests running concurrently, as the server interface's limiter
+        allows.  A failure to get one resource does not stop the others
+        from being retrieved.
+
+        Parameters:
+            field_ids   - the field ids of the resources to get.  See get().
+            max_workers - the maximum number of concurrent requests.
+            expand, only_fields, only_links
+                        - passed to get() for each resource.
+
+        Returns:
+            A (resources, errors) tuple.  resources is a list holding the
+            resource for each of field_ids, in the same order, or None where
+            the resource could not be retrieved.  errors maps each field id
+            which failed to the exception raised for it.
+        """
+        pool = ThreadPool(max_workers, self.server_interface.limiter)
+
+        try:
+            futures = [pool.submit(self.get, field_id, expand, only_fields,
+                                   only_links)
+                       for field_id in field_ids]
+        finally:
+            pool.shutdown(wait=False)
+
+        resources = []
+        errors = {}
+
+        for field_id, future in zip(field_ids, futures):
+            try:
+                resources.append(future.result())
+            except Exception, e:
+                resources.append(None)
+                errors[field_id] = e
+
+        return resources, errors
+
     # Methods which allow for the ResourceList to be Iterable.
     def __iter__(self):
         return self
@@ -472,7 +738,8 @@ class ResourceListBase(ResourceBase):
             self._index = -1
             raise StopIteration
         else:
-            return self.get(self.data[self.resource_name][self._index]['id'])
+            return self._get_child_resource(
+                self.data[self.resource_name][self._index])
 
     # Methods which allow for the ResourceList to behave like a Sequence.
     # That is, they allow the ResourceList to be indexed or sliced.
@@ -492,29 +759,58 @@ class ResourceListBase(ResourceBase):
             resources = self.get_field(self.resource_name)[position]
 
             for n in resources:
-                rsc = Resource(self.server_interface,
-                               n['links']['self']['href'])
-                rsc._load()
-                rscs.append(rsc)
+                rscs.append(self._get_child_resource(n))
         else:
-            rscs = Resource(self.server_interface,
-                self.get_field(self.resource_name)[position] \
-                ['links']['self']['href'])
-            rscs._load()
+            rscs = self._get_child_resource(
+                self.get_field(self.resource_name)[position])
 
         return rscs
 
+    def _get_child_resource(self, item):
+        """ Returns a child Resource populated from an item in this list.
+
+        The list payload already holds the full representation of each of
+        its children, so the child is populated from that rather than being
+        retrieved from the server.  If the list was retrieved with expanded
+        links or only some fields, so are its children.  Call refresh() on
+        the child to load it from the server.
+
+        Parameters:
+            item - the dict for the child in this resource list's data.
+        """
+        url = _get_self_url(item) or self.url + str(item['id']) + '/'
+        return _make_resource(self.server_interface, url,
+                              _singularize(self.resource_name), item,
+                              self._query)
+
 
 class ResourceList(ResourceListBase):
     """ Handles resource list type objects.
-    """
-    def __init__(self, server_interface, url):
-        super(ResourceList, self).__init__(server_interface, url)
 
-    def _load(self):
-        """ Loads the resource list from the server.
+    .. notes::
+        The server returns large lists one page at a time.  Iterating,
+        indexing and slicing the list follow the 'next' links to later pages
+        as they are needed, and len() is the total number of items across all
+        pages.  While the items of the last retrieved page are being iterated
+        over, the following page is retrieved in the background.
+
+        A list retrieved with expand, only_fields or only_links applies them
+        to each of its items, on every page.  See _add_query().
+    """
+    def __init__(self, server_interface, url, resource_string=None,
+                 data=None, expand=None, only_fields=None, only_links=None):
+        self._items = []
+        self._last_page_start = 0
+        self._next_page_url = None
+        self._next_page = None
+        super(ResourceList, self).__init__(server_interface, url,
+                                           resource_string, data, expand,
+                                           only_fields, only_links)
+
+    def _populate(self, resource_string, data):
+        """ Populates the resource list from an already retrieved response.
         """
-        super(ResourceListBase, self)._load()
+        super(ResourceList, self)._populate(resource_string, data)
         # Determine and set the resource list's resource type
         for elem in self.data:
             if elem not in ['stat', 'links', 'total_results', 'uri_templates']:
@@ -525,6 +821,83 @@ class ResourceList(ResourceListBase):
                 'The resource loaded as a resource list is not a resource '
                 'list.')
 
+        self._items = list(self.data.get(self.resource_name, []))
+        self._last_page_start = 0
+        self._next_page_url = _get_next_page_url(self.data)
+        self._next_page = None
+
+    def get_total_results(self):
+        """ Returns the number of items in the list across all pages.
+        """
+        return self.data['total_results']
+
+    def __next__(self):
+        self._index += 1
+
+        # Start retrieving the next page once iteration reaches the last
+        # page retrieved so far.
+        if self._index >= self._last_page_start:
+            self._prefetch_next_page()
+
+        self._ensure_items(self._index + 1)
+
+        if self._index >= len(self._items):
+            self._index = -1
+            raise StopIteration
+        else:
+            return self._get_child_resource(self._items[self._index])
+
+    def __len__(self):
+        return self.get_total_results()
+
+    def __getitem__(self, position):
+        if isinstance(position, slice):
+            indices = range(*position.indices(len(self)))
+
+            if indices:
+                self._ensure_items(max(indices) + 1)
+
+            return [self._get_child_resource(self._items[i])
+                    for i in indices if i < len(self._items)]
+        else:
+            if position < 0:
+                position += len(self)
+
+            if position >= 0:
+                self._ensure_items(position + 1)
+
+            if position < 0 or position >= len(self._items):
+                raise IndexError('resource list index out of range')
+
+            return self._get_child_resource(self._items[position])
+
+    def _ensure_items(self, count):
+        """ Retrieves pages until at least count items have been retrieved.
+
+        Stops early if there are no more pages.
+        """
+        while len(self._items) < count and self._next_page_url:
+            self._prefetch_next_page()
+            page = self._next_page
+            self._next_page = None
+
+            resource_string, data = page.result()
+            self._last_page_start = len(self._items)
+            self._items.extend(data.get(self.resource_name, []))
+            self._next_page_url = _get_next_page_url(data)
+
+    def _prefetch_next_page(self):
+        """ Starts retrieving the next page in the background.
+
+        The page isn't retrieved through the server interface's limiter.
+        The list is often iterated over by a call which already holds one
+        of the limiter's slots, and would wait for the page forever if the
+        page needed a slot of its own.
+        """
+        if self._next_page_url and self._next_page is None:
+            self._next_page = run_in_background(self._fetch,
+                                                self._next_page_url)
+
     def create(self):
         """ Creates a new instance of the resource list's child resource.
 
@@ -553,18 +926,108 @@ class ResourceList(ResourceListBase):
 class RootResource(ResourceListBase):
     """ Resource list specific to the root.
     """
+    # How to reach the resource for a URI template by walking links from
+    # the root, for servers which don't provide the template.  Each entry
+    # maps the template name to the root's link to the resource list and
+    # the template variable holding the child's id.
+    TEMPLATE_FALLBACKS = {
+        'review_request': ('review_requests', 'review_request_id'),
+    }
+
     def __init__(self, server_interface, url):
         super(RootResource, self).__init__(server_interface, url)
         if not re.search('(api/)$', self.url):
             raise InvalidResourceTypeError(
                 'The resource loaded as a RootResource is not a root.')
 
-    def _load(self):
-        """ Loads the resource list from the server.
+    def _populate(self, resource_string, data):
+        """ Populates the root from an already retrieved response.
         """
-        super(ResourceListBase, self)._load()
+        super(RootResource, self)._populate(resource_string, data)
         self.resource_name = 'root'
 
+    def get_uri_templates(self):
+        """ Returns the server's URI templates, keyed by name.
+
+        The templates come with the root itself, so like the root they're
+        cached on disk between runs.
+        """
+        try:
+            return self.data['uri_templates']
+        except KeyError:
+            raise InvalidKeyError(
+                'The server does not provide any URI templates.')
+
+    def expand_uri_template(self, name, **values):
+        """ Expands the URI template called name into a url.
+
+        Each {variable} in the template is replaced by the value passed for
+        it.  For example, expand_uri_template('review_request',
+        review_request_id=42) returns the url of review request 42.
+
+        Returns:
+            The expanded url.
+        """
+        try:
+            template = self.get_uri_templates()[name]
+        except KeyError:
+            raise InvalidKeyError(
+                'The server does not provide the URI template %s.' % name)
+
+        def expand(m):
+            try:
+                return urllib.quote(str(values[m.group(1)]))
+            except KeyError:
+                raise InvalidKeyError(
+                    'No value was given for %s in the URI template %s.' %
+                    (m.group(1), name))
+
+        return re.sub(r'{(\w+)}', expand, template)
+
+    def get_from_template(self, name, expand=None, only_fields=None,
+                          only_links=None, **values):
+        """ Gets the resource at the url from a URI template.
+
+        This loads the resource directly, with a single request, rather than
+        walking the links to it from the root.  expand, only_fields and
+        only_links are described in _add_query(), and the other keyword
+        arguments fill in the template.
+
+        Older servers don't provide URI templates.  For those, a template
+        listed in TEMPLATE_FALLBACKS is resolved by walking the links from
+        the root instead, which takes an extra request.
+
+        Returns:
+            The loaded resource, which could be a Resource or ResourceList.
+        """
+        try:
+            url = self.expand_uri_template(name, **values)
+        except InvalidKeyError:
+            if name not in self.TEMPLATE_FALLBACKS or \
+               self._has_uri_template(name):
+                raise
+
+            link, id_key = self.TEMPLATE_FALLBACKS[name]
+
+            try:
+                child_id = values[id_key]
+            except KeyError:
+                raise InvalidKeyError(
+                    'No value was given for %s in the URI template %s.' %
+                    (id_key, name))
+
+            return self.get(link).get(child_id, expand=expand,
+                                      only_fields=only_fields,
+                                      only_links=only_links)
+
+        return self._get_resource(url, expand=expand, only_fields=only_fields,
+                                  only_links=only_links)
+
+    def _has_uri_template(self, name):
+        """ Returns whether the server provides the URI template called name.
+        """
+        return name in self.data.get('uri_templates', {})
+
     def __next__(self):
         self._index += 1
 
@@ -600,6 +1063,7 @@ class ResourceSpecific(Resource):
         if isinstance(resource, Resource):
             super(ResourceSpecific, self).__init__(resource.server_interface,
                                            resource.url)
+            self._query = resource._query
             if resource._queryable:
                 self.resource_string = resource.resource_string
                 self.data = resource.data
@@ -685,7 +1149,60 @@ class RepositoryList(ResourceList):
     def __init__(self, resource_list):
         if isinstance(resource_list, ResourceList):
             super(RepositoryList, self).__init__(
-                resource_list.server_interface, resource_list.url)
+                resource_list.server_interface, resource_list.url,
+                resource_list.resource_string, resource_list.data)
+
+        self._repository_index = None
+        self._index_is_cached = False
+
+    def get_index(self, with_uuids=False, max_workers=DEFAULT_MAX_WORKERS):
+        """ Returns a RepositoryIndex of every repository in the list.
+
+        The index is kept in the server interface's on-disk metadata cache
+        along with the list itself, so it's only rebuilt once that expires.
+
+        Parameters:
+            with_uuids  - if true, the index will include the UUIDs of the
+                          Subversion repositories.  Their info is retrieved
+                          with up to max_workers concurrent requests, unless
+                          the cached index already has it.
+            max_workers - the maximum number of concurrent requests.
+        """
+        index_key = self.url + '#index'
+        cache = self.server_interface.metadata_cache
+
+        if self._repository_index is None:
+            cached = cache.get(index_key, 'repositories')
+
+            if cached:
+                self._repository_index = RepositoryIndex(cached[1])
+                self._index_is_cached = True
+            else:
+                self._ensure_items(self.get_total_results())
+                self._repository_index = RepositoryIndex(
+                    [dict(item) for item in self._items])
+                self._index_is_cached = False
+                cache.set(index_key,
+                          json_dumps(self._repository_index.repositories),
+                          'repositories')
+
+        if with_uuids:
+            repositories = [
+                repository
+                for repository in self._repository_index.repositories
+                if (repository.get('tool') == 'Subversion' and
+                    'info' not in repository)
+            ]
+
+            if repositories:
+                self._add_repository_info(repositories, max_workers)
+                self._repository_index = RepositoryIndex(
+                    self._repository_index.repositories)
+                cache.set(index_key,
+                          json_dumps(self._repository_index.repositories),
+                          'repositories')
+
+        return self._repository_index
 
     def get_repository_id(self, path):
         """ Finds the repository which matches the path.
@@ -695,18 +1212,84 @@ class RepositoryList(ResourceList):
 
         Parameters:
             path    The path of the repository to match.  This should be the
-                    upstream path of the repository.
+                    upstream path of the repository, or its mirror path.  It
+                    can also be a list of alternative paths.
 
         Returns:
             The ID of the repository from the list which matches the path
             specified.  If no match is found, then None is returned.
         """
-        for repo in self:
-            if repo.get_field('path') == path:
-                return repo.get_field('id')
+        repository = self._find(lambda index: index.get_by_path(path))
+
+        if repository:
+            return repository['id']
 
         return None
 
+    def get_repositories_by_uuid(self, uuid, max_workers=DEFAULT_MAX_WORKERS):
+        """ Finds the Subversion repositories with the given UUID.
+
+        Returns:
+            The payloads of the matching repositories, in the order the
+            server lists them.  If there are none, an empty list is
+            returned.
+        """
+        return self._find(lambda index: index.get_by_uuid(uuid),
+                          with_uuids=True, max_workers=max_workers)
+
+    def _find(self, lookup, with_uuids=False,
+              max_workers=DEFAULT_MAX_WORKERS):
+        """ Looks something up in the index, rebuilding it once on a miss.
+
+        A repository added to the server since the index was cached isn't
+        in the cached index, so if lookup finds nothing in it, the index is
+        rebuilt from the server and lookup is tried again.
+        """
+        result = lookup(self.get_index(with_uuids, max_workers))
+
+        if not result and self._index_is_cached:
+            self.refresh()
+            self._repository_index = None
+            result = lookup(self.get_index(with_uuids, max_workers))
+
+        return result
+
+    def _add_repository_info(self, repositories, max_workers):
+        """ Retrieves the info of each of repositories concurrently.
+
+        Each repository's info is stored in its 'info' key.  Repositories
+        whose info couldn't be retrieved, because the server failed or the
+        request did, are given an empty info, so that it isn't requested
+        again.
+        """
+        urls = []
+
+        for repository in repositories:
+            try:
+                urls.append(repository['links']['info']['href'])
+            except KeyError:
+                urls.append('%s%s/info/' % (self.url, repository['id']))
+
+        pool = ThreadPool(max_workers, self.server_interface.limiter)
+
+        try:
+            futures = pool.map(self._fetch, urls)
+        finally:
+            pool.shutdown(wait=False)
+
+        for repository, future in zip(repositories, futures):
+            try:
+                data = future.result()[1]
+            except (urllib2.URLError, RequestTimeoutError):
+                # A failure for one repository only leaves its info out.
+                # HTTPError is a kind of URLError.
+                data = {}
+
+            if data.get('stat') == 'ok':
+                repository['info'] = data['info']
+            else:
+                repository['info'] = {}
+
 
 # Auxillary methods not specific to any resource
 def _is_resource_list(data):
@@ -716,3 +1299,94 @@ def _is_resource_list(data):
     Otherwise, false is returned.
     """
     return 'total_results' in data
+
+
+def _add_query(url, expand=None, only_fields=None, only_links=None):
+    """ Returns url with the query arguments for a partial retrieval.
+
+    Parameters:
+        url         - the url of the resource.
+        expand      - the links whose resources the server should embed in
+                      the response, saving a request for each.
+        only_fields - the only fields the server should include.
+        only_links  - the only links the server should include.  An empty
+                      list leaves out every link.
+
+    Each can be a name or a list of names, and is left out of the query if
+    None.
+
+    Returns:
+        The url to retrieve.
+    """
+    args = []
+
+    for name, value in (('expand', expand),
+                        ('only-fields', only_fields),
+                        ('only-links', only_links)):
+        if value is not None:
+            if not isinstance(value, basestring):
+                value = ','.join(value)
+
+            args.append((name, value))
+
+    if not args:
+        return url
+
+    if '?' in url:
+        separator = '&'
+    else:
+        separator = '?'
+
+    return url + separator + urllib.urlencode(args).replace('%2C', ',')
+
+
+def _get_self_url(item):
+    """ Returns the url of the resource whose payload is item, or None.
+    """
+    try:
+        return item['links']['self']['href']
+    except (KeyError, TypeError):
+        return None
+
+
+def _make_resource(server_interface, url, name, item, query=None):
+    """ Returns a Resource populated from the payload of an embedded item.
+
+    Parameters:
+        server_interface - the server interface for the resource.
+        url              - the url of the resource.
+        name             - the name of the resource, such as
+                           'review_request'.
+        item             - the resource's payload.
+        query            - the query arguments the payload was retrieved
+                           with, as used by Resource.
+    """
+    rsc = Resource(server_interface, url, **(query or {}))
+    rsc._populate(None, {
+        'stat': 'ok',
+        name: item,
+    })
+    return rsc
+
+
+def _get_next_page_url(data):
+    """ Returns the url of the page after the one in data, or None.
+    """
+    try:
+        return data['links']['next']['href']
+    except (KeyError, TypeError):
+        return None
+
+
+def _singularize(name):
+    """ Returns the name of a child resource given its list's name.
+
+    For example, 'review_requests' becomes 'review_request' and
+    'repositories' becomes 'repository'.
+    """
+    if name.endswith('ies'):
+        return name[:-3] + 'y'
+    elif name.endswith('s'):
+        return name[:-1]
+    else:
+        return name
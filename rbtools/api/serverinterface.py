@@ -1,14 +1,22 @@
 import base64
-import cookielib
-import mimetools
 import os
 import re
+import socket
+import threading
 import urllib
 import urllib2
 from urlparse import urlparse
 
 from rbtools import get_package_version, get_version_string
+from rbtools.api.cache import MetadataCache, RequestMemo, ValidatorCache
+from rbtools.api.compression import CompressionHandler, \
+                                    MIN_COMPRESSED_BODY_SIZE, gzip_body
+from rbtools.api.concurrency import AdaptiveLimiter
+from rbtools.api.cookies import PersistentCookieJar
 from rbtools.api.errors import *
+from rbtools.api.multipart import MultipartBody
+from rbtools.api.policy import RequestPolicy
+from rbtools.api.transport import ConnectionPool, build_keep_alive_handlers
 from rbtools.commands.utils import *
 
 try:
@@ -54,6 +62,7 @@ class ReviewBoardHTTPPasswordMgr(urllib2.HTTPPasswordMgr):
         self.rb_url = reviewboard_url
         self.rb_user = None
         self.rb_pass = None
+        self._lock = threading.Lock()
 
         if password_inputer:
             if isinstance(password_inputer, ReviewBoardPasswordInputer):
@@ -66,15 +75,22 @@ class ReviewBoardHTTPPasswordMgr(urllib2.HTTPPasswordMgr):
 
     def find_user_password(self, realm, uri):
         if uri.startswith(self.rb_url):
-            if self.rb_user is None or self.rb_pass is None:
-                self.rb_user, self.rb_pass = \
-                    self.password_inputer.get_user_password(realm,
-                                                            urlparse(uri)[1])
+            # Several threads may need the password at once, but the user
+            # should only be asked for it once.
+            self._lock.acquire()
 
-            return self.rb_user, self.rb_pass
+            try:
+                if self.rb_user is None or self.rb_pass is None:
+                    self.rb_user, self.rb_pass = \
+                        self.password_inputer.get_user_password(
+                            realm, urlparse(uri)[1])
+
+                return self.rb_user, self.rb_pass
+            finally:
+                self._lock.release()
         else:
-            # If this is an auth request for some other domain (since HTTP
-            # handlers are global), fall back to standard password management.
+            # If this is an auth request for some other domain (such as
+            # after a redirect), fall back to standard password management.
             return urllib2.HTTPPasswordMgr.find_user_password(self, realm, uri)
 
 
@@ -84,7 +100,9 @@ class ServerInterface(object):
     A class which performs basic communication with a ReviewBoard server and
     tracks cookie information.
     """
-    def __init__(self, server_url, cookie_path_file=None, password_mgr=None):
+    def __init__(self, server_url, cookie_path_file=None, password_mgr=None,
+                 metadata_cache_file=None, request_policy=None,
+                 username=None):
         self.server_url = server_url
 
         if cookie_path_file:
@@ -103,30 +121,81 @@ class ServerInterface(object):
         else:
             self.password_mgr = ReviewBoardHTTPPasswordMgr(self.server_url)
 
-        self.cookie_jar = cookielib.MozillaCookieJar(self.cookie_file)
+        # Cookies are kept in memory, and only written back to the cookie
+        # file when they change.
+        self.cookie_jar = PersistentCookieJar(self.cookie_file)
+        self.validator_cache = ValidatorCache()
+
+        # Resources already retrieved during this run are remembered in
+        # memory for a short while, so they're only retrieved once.  Commands
+        # call close() when done, which forgets them.
+        self.request_memo = RequestMemo()
+
+        # Slow-changing resources, such as the root, are cached on disk so
+        # later runs can skip retrieving them.  By default the cache is kept
+        # in the user's home directory, and keyed by username.
+        self.metadata_cache = MetadataCache(metadata_cache_file,
+                                            username=username)
+
+        # Requests to the server share a pool of persistent connections, so
+        # that each request doesn't pay for a new TCP and TLS handshake.
+        self.connection_pool = ConnectionPool()
+
+        self.compression_handler = CompressionHandler()
+
+        # Timeouts, deadlines and retries for every request.
+        self.request_policy = request_policy or RequestPolicy()
 
-        if os.path.isfile(self.cookie_file):
-            self.cookie_jar.load()
+        # Bulk operations, which make many requests at once, share this
+        # limiter so that together they can't overload the server.
+        self.limiter = AdaptiveLimiter()
 
-        cookie_handler = urllib2.HTTPCookieProcessor(self.cookie_jar)
-        basic_auth_handler = urllib2.HTTPBasicAuthHandler(self.password_mgr)
-        digest_auth_handler = urllib2.HTTPDigestAuthHandler(self.password_mgr)
-        opener = urllib2.build_opener(cookie_handler,
-                                      basic_auth_handler,
-                                      digest_auth_handler)
-        opener.addheaders = [
-            ('User-agent', 'RBTools/' + get_package_version())
-        ]
-        urllib2.install_opener(opener)
+        # Each thread making requests gets its own opener, since the auth
+        # handlers keep per-request state.  Everything else the openers use,
+        # including the cookie jar, is shared and safe to use from several
+        # threads.  No opener is installed globally, so several
+        # ServerInterfaces can be used in one process without interfering.
+        self._local = threading.local()
+
+    def get_opener(self):
+        """ Returns this thread's opener for requests to the server.
+        """
+        opener = getattr(self._local, 'opener', None)
+
+        if opener is None:
+            handlers = build_keep_alive_handlers(self.connection_pool)
+            handlers += [
+                urllib2.HTTPCookieProcessor(self.cookie_jar),
+                urllib2.HTTPBasicAuthHandler(self.password_mgr),
+                urllib2.HTTPDigestAuthHandler(self.password_mgr),
+                self.compression_handler,
+            ]
+            opener = urllib2.build_opener(*handlers)
+            opener.addheaders = [
+                ('User-agent', 'RBTools/' + get_package_version())
+            ]
+            self._local.opener = opener
+
+        return opener
 
     def is_logged_in(self):
         return self.has_valid_cookie()
 
-    def _request(self, method, url, fields=None, files=None, accept='application/json'):
+    def close(self):
+        """ Closes any idle persistent connections to the server, writes
+        out any changed cookies, and forgets the resources retrieved so far.
+        """
+        self.connection_pool.close()
+        self.cookie_jar.flush()
+        self.request_memo.clear()
+
+    def _request(self, method, url, fields=None, files=None,
+                 accept='application/json', headers=None, deadline=None):
         """ Makes an HTTP request.
 
         Encodes the input fields and files and performs an HTTP request to the
-        specified url using the specified method.  Any cookies set are stored.
+        specified url using the specified method.  Any cookies set are kept
+        in the cookie jar, which writes them out once they change.
 
         Parameteres:
             method      - the HTTP method to be used.  Accepts GET, POST,
@@ -139,16 +208,45 @@ class ServerInterface(object):
                           filename:value and content:value structure
             accept      - what file types the client will accept, including
                           priorities.
+            headers     - any additional headers to send with the request.
+            deadline    - how long, in seconds, the request may take in
+                          total, including any retries.  Defaults to the
+                          request policy's deadline.
 
         Returns:
             The response from the server.  For more information view the
             ReviewBoard WebAPI Documentation.
         """
-        content_type, body = self._encode_multipart_formdata(fields, files)
-        headers = {
-            'Content-Type': content_type,
-            'Content-Length': str(len(body))
-        }
+        return self._open(method, url, fields, files, accept, headers,
+                          deadline, read=True)
+
+    def _open(self, method, url, fields=None, files=None,
+              accept='application/json', headers=None, deadline=None,
+              read=False):
+        """ Makes an HTTP request and returns the open response.
+
+        This takes the same parameters as _request(), but returns the
+        response object rather than its body, so that callers can look at
+        the response headers.  If read is true, the body is read and
+        returned instead, as part of the request, so that a failure while
+        reading it is retried like any other.
+        """
+        headers = dict(headers or {})
+        body = None
+        compressed_body = None
+
+        # Only send a body when there is one to send.  A stray body on a
+        # GET or DELETE would be left unread on the persistent connection.
+        if method in ('POST', 'PUT'):
+            content_type, body = self._encode_multipart_formdata(fields,
+                                                                 files)
+            headers['Content-Type'] = content_type
+            headers['Content-Length'] = str(len(body))
+
+            # Compress large bodies if the server has said it accepts them.
+            if (self.compression_handler.server_accepts_gzip and
+                len(body) >= MIN_COMPRESSED_BODY_SIZE):
+                compressed_body, compressed_length = gzip_body(body)
 
         if accept:
             headers['Accept'] = accept
@@ -156,67 +254,122 @@ class ServerInterface(object):
         if not self._valid_method(method):
             raise InvalidRequestMethod('An invalid HTTP method was used.')
 
-        r = RequestWithMethod(method, url, body, headers)
-        resource = urllib2.urlopen(r)
-        self.cookie_jar.save(self.cookie_file)
-        return resource.read()
+        if method != 'GET':
+            # Anything but a GET may change the resource, so stop trusting
+            # the cached copies of it.
+            self.validator_cache.invalidate(url)
+            self.metadata_cache.invalidate(url)
+            self.request_memo.invalidate(url)
+
+        if compressed_body:
+            compressed_headers = dict(headers)
+            compressed_headers['Content-Encoding'] = 'gzip'
+            compressed_headers['Content-Length'] = str(compressed_length)
 
-    def get(self, url, accept=None):
+            try:
+                return self._send(method, url, compressed_body,
+                                  compressed_headers, deadline, read)
+            except urllib2.HTTPError, e:
+                if e.code != 415:
+                    raise
+
+                # The server didn't accept the compressed body after all.
+                # Send it uncompressed, and keep doing so from now on.
+                self.compression_handler.reject_gzip()
+                body.seek(0)
+
+        return self._send(method, url, body, headers, deadline, read)
+
+    def _send(self, method, url, body, headers, deadline, read):
+        """ Sends a request according to the request policy.
+        """
+        def attempt(timeout):
+            if timeout is None:
+                timeout = socket._GLOBAL_DEFAULT_TIMEOUT
+
+            r = RequestWithMethod(method, url, body, headers)
+            response = self.get_opener().open(r, timeout=timeout)
+
+            if read:
+                return response.read()
+
+            return response
+
+        return self.request_policy.call(method, attempt, deadline)
+
+    def get(self, url, accept=None, deadline=None):
         """ Make an HTTP GET on the specified url returning the response.
         """
-        return self._request('GET', url, accept=accept)
+        return self._request('GET', url, accept=accept, deadline=deadline)
+
+    def get_stream(self, url, accept=None, deadline=None):
+        """ Make an HTTP GET on the specified url without reading the body.
+
+        Returns:
+            The open response, whose body can be read in pieces with read().
+            The caller should close it when done.
+        """
+        return self._open('GET', url, accept=accept, deadline=deadline)
+
+    def get_conditional(self, url, cached=None, accept=None, deadline=None):
+        """ Make a conditional HTTP GET on the specified url.
+
+        If cached is a CachedResponse, its validators are sent along with the
+        request so that the server can skip sending an unchanged body.
+
+        Returns:
+            A (body, info) tuple, where info holds the response headers.  If
+            the server responded with 304 Not Modified, body is None.
+        """
+        headers = None
+
+        if cached:
+            headers = cached.get_request_headers()
+
+        try:
+            resource = self._open('GET', url, accept=accept, headers=headers,
+                                  deadline=deadline)
+        except urllib2.HTTPError, e:
+            if e.code == 304:
+                return None, e.info()
+            else:
+                raise
 
-    def delete(self, url, accept=None):
+        return resource.read(), resource.info()
+
+    def delete(self, url, accept=None, deadline=None):
         """ Make an HTTP DELETE on the specified url returning the response.
         """
-        return self._request('DELETE', url, accept=accept)
+        return self._request('DELETE', url, accept=accept, deadline=deadline)
 
-    def post(self, url, fields, files=None, accept=None):
+    def post(self, url, fields, files=None, accept=None, deadline=None):
         """ Make an HTTP POST on the specified url returning the response.
         """
-        return self._request('POST', url, fields, files, accept)
+        return self._request('POST', url, fields, files, accept,
+                             deadline=deadline)
 
-    def put(self, url, fields, files=None, accept=None):
+    def put(self, url, fields, files=None, accept=None, deadline=None):
         """ Make an HTTP PUT on the specified url returning the response.
         """
-        return self._request('PUT', url, fields, files, accept)
+        return self._request('PUT', url, fields, files, accept,
+                             deadline=deadline)
 
     def _encode_multipart_formdata(self, fields=None, files=None):
         """ Encodes data for use in an HTTP request.
 
+        The body is returned as a MultipartBody, which is streamed to the
+        server as the request is sent rather than being built in memory.
+
         Paramaters:
             fields - the fields to be encoded.  This should be a dict in a
                      key:value format
             files  - the files to be encoded.  This should be a dict in a
-                     key:dict, filename:value and content:value format
+                     key:dict format, where each dict has a filename key and
+                     either a content key (a string, file object or iterable
+                     of strings) or a path key (the path to a local file).
         """
-        BOUNDARY = mimetools.choose_boundary()
-        content = ""
-
-        fields = fields or {}
-        files = files or {}
-
-        for key in fields:
-            content += "--" + BOUNDARY + "\r\n"
-            content += "Content-Disposition: form-data; name=\"%s\"\r\n" % key
-            content += "\r\n"
-            content += fields[key] + "\r\n"
-
-        for key in files:
-            filename = files[key]['filename']
-            value = files[key]['content']
-            content += "--" + BOUNDARY + "\r\n"
-            content += "Content-Disposition: form-data; name=\"%s\"; " % key
-            content += "filename=\"%s\"\r\n" % filename
-            content += "\r\n"
-            content += value + "\r\n"
-
-        content += "--" + BOUNDARY + "--\r\n"
-        content += "\r\n"
-
-        content_type = "multipart/form-data; boundary=%s" % BOUNDARY
-
-        return content_type, content
+        body = MultipartBody(fields, files)
+        return body.content_type, body
 
     def _valid_method(self, method):
         """ Checks if the method is a valid HTTP request for an RB server.
@@ -234,27 +387,13 @@ class ServerInterface(object):
     def has_valid_cookie(self):
         """ Checks if a valid cookie already exists for to the RB server.
 
-        Returns true if the ServerInterface can find and load a cookie for the
-        server that has not expired.
+        Returns true if the ServerInterface holds a cookie for the server that
+        has not expired.  The cookie file was loaded when the ServerInterface
+        was created, so this doesn't touch the disk.
         """
         parsed_url = urlparse(self.server_url)
         host = parsed_url[1]
         host = host.split(":")[0]
         path = parsed_url[2] or '/'
 
-        try:
-            self.cookie_jar.load(self.cookie_file, ignore_expires=True)
-
-            try:
-                cookie = self.cookie_jar._cookies[host][path]['rbsessionid']
-
-                if not cookie.is_expired():
-                    return True
-            except KeyError, e:
-                # Cookie file loaded, but no cookie for this server
-                pass
-        except IOError, e:
-            # Couldn't load cookie file
-            pass
-
-        return False
+        return self.cookie_jar.has_valid_cookie(host, path, 'rbsessionid')
@@ -0,0 +1,260 @@
+import errno
+import httplib
+import socket
+import threading
+import urllib2
+
+
+DEFAULT_MAX_IDLE_PER_HOST = 8
+
+# Errors on a pooled connection which mean the server closed it while it
+# was idle, before reading the request.
+STALE_CONNECTION_ERRNOS = (errno.ECONNRESET, errno.EPIPE)
+
+
+class ConnectionPool(object):
+    """ A pool of persistent HTTP connections.
+
+    Idle connections are kept per (connection class, host) key so that
+    subsequent requests to the same server can reuse an already established
+    TCP (and TLS) connection instead of opening a new one for every request.
+    """
+    def __init__(self, max_idle_per_host=DEFAULT_MAX_IDLE_PER_HOST):
+        self.max_idle_per_host = max_idle_per_host
+        self._idle = {}
+        self._lock = threading.Lock()
+
+    def acquire(self, key):
+        """ Returns an idle connection for key, or None if there is none.
+        """
+        self._lock.acquire()
+
+        try:
+            connections = self._idle.get(key)
+
+            if connections:
+                return connections.pop()
+
+            return None
+        finally:
+            self._lock.release()
+
+    def release(self, key, connection):
+        """ Returns a connection to the pool so that it can be reused.
+
+        If the pool already holds max_idle_per_host idle connections for the
+        key, the connection is closed instead.
+        """
+        self._lock.acquire()
+
+        try:
+            connections = self._idle.setdefault(key, [])
+
+            if len(connections) < self.max_idle_per_host:
+                connections.append(connection)
+                return
+        finally:
+            self._lock.release()
+
+        connection.close()
+
+    def close(self):
+        """ Closes every idle connection held by the pool.
+        """
+        self._lock.acquire()
+
+        try:
+            idle = self._idle
+            self._idle = {}
+        finally:
+            self._lock.release()
+
+        for connections in idle.values():
+            for connection in connections:
+                connection.close()
+
+
+class PooledResponse(object):
+    """ Wraps an httplib response whose connection belongs to a pool.
+
+    Once the body of the response has been read completely, the connection
+    is handed back to the pool.  If the response is closed before then, or
+    the server asked for the connection to be closed, it is discarded.
+    """
+    def __init__(self, response, pool, key, connection):
+        self._response = response
+        self._pool = pool
+        self._key = key
+        self._connection = connection
+
+        if self._body_consumed():
+            self._finish(True)
+
+    def recv(self, amt=None):
+        if amt is None:
+            data = self._response.read()
+        else:
+            data = self._response.read(amt)
+
+        if self._body_consumed():
+            self._finish(True)
+
+        return data
+
+    read = recv
+
+    def close(self):
+        self._finish(self._body_consumed())
+
+    def _body_consumed(self):
+        return self._response.isclosed() or self._response.length == 0
+
+    def _finish(self, reuse):
+        if self._connection is None:
+            return
+
+        connection = self._connection
+        self._connection = None
+        self._response.close()
+
+        if reuse and not self._response.will_close:
+            self._pool.release(self._key, connection)
+        else:
+            connection.close()
+
+
+class KeepAliveHandlerMixin(object):
+    """ Opens urllib2 requests over pooled, persistent connections.
+
+    This replaces AbstractHTTPHandler.do_open, which always sends
+    "Connection: close" and opens a new connection for every request.
+    Requests which need to go through a proxy tunnel are passed on to the
+    default implementation.
+    """
+    def _keep_alive_open(self, http_class, req, **http_conn_args):
+        host = req.get_host()
+
+        if not host:
+            raise urllib2.URLError('no host given')
+
+        if req._tunnel_host:
+            return self.do_open(http_class, req, **http_conn_args)
+
+        headers = dict(req.unredirected_hdrs)
+        headers.update(dict((k, v) for k, v in req.headers.items()
+                            if k not in headers))
+        headers['Connection'] = 'keep-alive'
+        headers = dict(
+            (name.title(), val) for name, val in headers.items())
+
+        key = (http_class, host)
+        connection = self.pool.acquire(key)
+
+        if connection is not None:
+            try:
+                return self._send(connection, key, req, headers)
+            except (socket.error, httplib.HTTPException), e:
+                connection.close()
+
+                if not _is_stale_connection_error(e):
+                    # The server may have acted on the request, so it must
+                    # not be sent again.
+                    raise urllib2.URLError(e)
+
+                # The server closed the idle connection without answering.
+                # Fall through and send the request on a fresh one.
+
+        connection = http_class(host, timeout=req.timeout, **http_conn_args)
+        connection.set_debuglevel(self._debuglevel)
+
+        try:
+            return self._send(connection, key, req, headers)
+        except (socket.error, httplib.HTTPException), e:
+            connection.close()
+            raise urllib2.URLError(e)
+
+    def _send(self, connection, key, req, headers):
+        if connection.sock is not None and \
+           req.timeout is not socket._GLOBAL_DEFAULT_TIMEOUT:
+            # A pooled connection keeps the timeout of the request it was
+            # opened for.
+            connection.sock.settimeout(req.timeout)
+
+        if hasattr(req.data, 'seek'):
+            # A streamed body may already have been read by an earlier
+            # attempt at this request.
+            req.data.seek(0)
+
+        connection.request(req.get_method(), req.get_selector(), req.data,
+                           headers)
+        r = connection.getresponse(buffering=True)
+
+        # socket._fileobject provides readline() and friends on top of
+        # PooledResponse.recv().
+        fp = socket._fileobject(PooledResponse(r, self.pool, key, connection),
+                                close=True)
+        resp = urllib2.addinfourl(fp, r.msg, req.get_full_url())
+        resp.code = r.status
+        resp.msg = r.reason
+        return resp
+
+
+class KeepAliveHTTPHandler(KeepAliveHandlerMixin, urllib2.HTTPHandler):
+    """ An HTTP handler which reuses connections from a ConnectionPool.
+    """
+    def __init__(self, pool, debuglevel=0):
+        urllib2.HTTPHandler.__init__(self, debuglevel)
+        self.pool = pool
+
+    def http_open(self, req):
+        return self._keep_alive_open(httplib.HTTPConnection, req)
+
+
+if hasattr(urllib2, 'HTTPSHandler'):
+    class KeepAliveHTTPSHandler(KeepAliveHandlerMixin, urllib2.HTTPSHandler):
+        """ An HTTPS handler which reuses connections from a ConnectionPool.
+
+        Reusing the connection also reuses its TLS session, so the handshake
+        is only performed once per pooled connection.
+        """
+        def __init__(self, pool, debuglevel=0):
+            urllib2.HTTPSHandler.__init__(self, debuglevel)
+            self.pool = pool
+
+        def https_open(self, req):
+            context = getattr(self, '_context', None)
+
+            if context is not None:
+                return self._keep_alive_open(httplib.HTTPSConnection, req,
+                                             context=context)
+            else:
+                return self._keep_alive_open(httplib.HTTPSConnection, req)
+else:
+    KeepAliveHTTPSHandler = None
+
+
+def build_keep_alive_handlers(pool):
+    """ Returns the urllib2 handlers needed to pool connections in pool.
+    """
+    handlers = [KeepAliveHTTPHandler(pool)]
+
+    if KeepAliveHTTPSHandler:
+        handlers.append(KeepAliveHTTPSHandler(pool))
+
+    return handlers
+
+
+def _is_stale_connection_error(e):
+    """ Returns true if e shows that the server closed a pooled connection
+    before answering the request sent on it.
+
+    A timeout never counts, since the server may still be working on the
+    request.
+    """
+    if isinstance(e, socket.timeout):
+        return False
+
+    if isinstance(e, httplib.BadStatusLine):
+        return True
+
+    return isinstance(e, socket.error) and e.errno in STALE_CONNECTION_ERRNOS
@@ -1,6 +1,6 @@
 import re
 
-from rbtools.api.resource import Resource, RootResource
+from rbtools.api.resource import RepositoryList, Resource, RootResource
 from rbtools.api.serverinterface import ServerInterface
 from rbtools.clients.client import Client, Repository
 from rbtools.api.utilities import RBUtilities
@@ -243,43 +243,26 @@ class SVNRepository(Repository):
         repositories use the same path, you'll get back self, otherwise you'll
         get a different SvnRepository object (with a different path).
         """    
-        root = RootResource( server, server.server_url + '/api')
-        repo_list = root.get('repositories')
+        root = RootResource(server, server.server_url + 'api/')
+        repositories = RepositoryList(root.get('repositories'))
 
-        for repository in repo_list:
-
-            if repository.get_field('tool') != 'Subversion':
-                continue
-
-            info = self._get_repository_info(server, repository)
-
-            if not info or self.uuid != info['uuid']:
-                continue
+        # The index holds the info of every Subversion repository, fetched
+        # concurrently and cached on disk, so matching the UUID doesn't take
+        # a request per repository.
+        index = repositories.get_index(with_uuids=True)
 
+        for repository in index.get_by_uuid(self.uuid):
+            info = repository['info']
             repos_base_path = info['url'][len(info['root_url']):]
             relpath = self._get_relative_path(self.base_path, repos_base_path)
 
             if relpath:
-                return SvnRepository(info['url'], relpath, self.uuid)
+                return SVNRepository(info['url'], relpath, self.uuid)
 
         # We didn't find a matching repository on the server. We'll just return
         # self and hope for the best.
         return self
 
-    def _get_repository_info(self, server, repository):
-
-        try:
-            return server.get_repository_info(repository['id'])
-        except APIError, e:
-            # If the server couldn't fetch the repository info, it will return
-            # code 210. Ignore those.
-            # Other more serious errors should still be raised, though.
-
-            if e.error_code == 210:
-                return None
-
-            raise e
-
     def _get_relative_path(self, path, root):
         pathdirs = self._split_on_slash(path)
         rootdirs = self._split_on_slash(root)
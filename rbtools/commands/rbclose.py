@@ -2,6 +2,7 @@ import os
 import sys
 import urllib2
 
+from rbtools.api.concurrency import ThreadPool
 from rbtools.api.resource import Resource, RootResource, ReviewRequest
 from rbtools.api.serverinterface import ServerInterface
 from rbtools.api.settings import Settings
@@ -20,6 +21,16 @@ def close_type(option_type):
         return DISCARDED
 
 
+def close_review_request(root, resource_id, option_type):
+    review_request = ReviewRequest(root.get_from_template(
+        'review_request', review_request_id=resource_id))
+
+    if option_type == SUBMITTED_OPTION:
+        review_request.submit()
+    else:
+        review_request.discard()
+
+
 def main():
     valid = False
 
@@ -27,33 +38,54 @@ def main():
         settings = Settings(config_file='rb_scripts.dat')
         cookie = settings.get_cookie_file()
         server_url = settings.get_server_url()
-        resource_id = sys.argv[2]
+        resource_ids = sys.argv[2:]
 
-        if resource_id.isdigit():
+        if [i for i in resource_ids if i.isdigit()] == resource_ids:
             if sys.argv[1] == SUBMITTED_OPTION \
                 or sys.argv[1] == DISCARDED_OPTION:
                 valid = True
                 server = ServerInterface(server_url, cookie)
+                root = RootResource(server, server_url + 'api/')
+
+                # Several review requests are closed at once, as quickly as
+                # the server's limiter allows.  A failure to close one
+                # doesn't stop the others, and every failure is reported.
+                pool = ThreadPool(limiter=server.limiter)
 
                 try:
-                    root = RootResource(server, server_url + 'api/')
-                    review_requests = root.get('review_requests')
-                    review_request = \
-                        ReviewRequest(review_requests.get(resource_id))
-
-                    if sys.argv[1] == SUBMITTED_OPTION:
-                        review_request.submit()
-                    else:
-                        review_request.discard()
-
-                    print 'Successfully %s review request #%s' % \
-                        (close_type(sys.argv[1]), resource_id)
-                except urllib2.HTTPError, e:
-                    print 'Close failed..  Make sure the resource exists on ' \
-                          'the server and try again.'
+                    futures = [
+                        pool.submit(close_review_request, root, resource_id,
+                                    sys.argv[1])
+                        for resource_id in resource_ids
+                    ]
+                finally:
+                    pool.shutdown(wait=False)
+
+                errors = {}
+
+                for resource_id, future in zip(resource_ids, futures):
+                    try:
+                        future.result()
+                        print 'Successfully %s review request #%s' % \
+                            (close_type(sys.argv[1]), resource_id)
+                    except urllib2.HTTPError, e:
+                        errors[resource_id] = e
+                        print 'Close of review request #%s failed..  Make ' \
+                              'sure the resource exists on the server and ' \
+                              'try again.' % resource_id
+                    except Exception, e:
+                        errors[resource_id] = e
+                        print 'Close of review request #%s failed: %s' % \
+                            (resource_id, e)
+
+                server.close()
+
+                if errors:
+                    sys.exit(1)
 
     if not valid:
-        print "usage: rb close [-s|-d] <review_request_id>"
+        print "usage: rb close [-s|-d] <review_request_id> " \
+              "[<review_request_id> ...]"
 
 
 if __name__ == '__main__':
@@ -1,8 +1,10 @@
 import os
 import re
+import socket
 import sys
-from urllib2 import HTTPError
+from urllib2 import HTTPError, URLError
 
+from rbtools.api.errors import RequestTimeoutError
 from rbtools.api.settings import Settings
 from rbtools.api.resource import Resource, \
                                 RootResource, \
@@ -26,6 +28,38 @@ FILE = 'files'
 def main():
     diff(sys.argv[1:])
 
+def download_diff(diff, diff_file, mime_type):
+    """streams the diff file from the server to diff_file
+
+    The diff is written out as it is received, so it never needs to be
+    held in memory all at once.
+    """
+    # HTTPError, URLError and socket errors are all IOErrors, so they have
+    # to be caught before the error for a file which can't be written.
+    try:
+        size, elapsed = diff.download_file(diff_file, mime_type)
+    except HTTPError, e:
+        print 'the server could not send the diff (HTTP %d).' % e.code
+        sys.exit(1)
+    except URLError, e:
+        print 'the diff could not be downloaded: %s' % e.reason
+        sys.exit(1)
+    except socket.error, e:
+        print 'the connection was lost while downloading the diff: %s' % e
+        sys.exit(1)
+    except IOError:
+        print 'could not open "' + diff_file + '" for writing.'
+        sys.exit(1)
+    except RequestTimeoutError, e:
+        print 'the server did not respond in time: %s' % e
+        sys.exit(1)
+
+    if elapsed > 0:
+        print 'wrote %d bytes to %s (%.1f KB/s)' % \
+            (size, diff_file, size / elapsed / 1024)
+    else:
+        print 'wrote %d bytes to %s' % (size, diff_file)
+
 def diff(args):
     valid = False
     resource_map = {GET: 'diffs', VIEW: 'diffs'}
@@ -107,10 +141,12 @@ def diff(args):
                 #find the review
                 if len(args) > 1 and args[1].isdigit():
                     id = args[1]
-                    review_requests = root.get('review_requests')
-                    
+
                     try:
-                        request = ReviewRequest(review_requests.get(id))
+                        # Only the link to the diffs is needed.
+                        request = ReviewRequest(root.get_from_template(
+                            'review_request', review_request_id=id,
+                            only_fields='id', only_links=resource_name))
                     except HTTPError:
                         print 'Unknown review request id: ' + id
                         exit()
@@ -130,7 +166,14 @@ def diff(args):
                                   else str(args[2])
                     if diff_id.isdigit():
                         #single diff
-                        diff = DiffResource(diffs.get(diff_id))
+                        only_fields = None
+
+                        if command == VIEW and len(args) > 3 and \
+                           args[3] != 'all':
+                            only_fields = args[3]
+
+                        diff = DiffResource(diffs.get(diff_id,
+                                                      only_fields=only_fields))
 
                         if command == VIEW:
                             #VIEW will display all fields unless
@@ -150,18 +193,8 @@ def diff(args):
                                 diff_file = \
                                     settings.get_setting('server_diff')
 
-                            sd = diff.get_file( \
-                                    settings.get_setting('diff_mime'))
-
-                            file = open(diff_file, 'w')
-
-                            if file < 0:
-                                print 'could not open "' + diff_file \
-                                                + '" for writing.'
-                                exit()
-
-                            file.write(sd)
-                            file.close()
+                            download_diff(diff, diff_file,
+                                          settings.get_setting('diff_mime'))
                     elif diff_id == 'all':
                         #deal with each dif, one at a time
                         ids = diffs.get_fields()
@@ -189,15 +222,8 @@ def diff(args):
                                         settings.get_setting('server_diff')
                                 diff_file = str(diff_id) + '_' + diff_file
 
-                                sd = diff.get_file( \
+                                download_diff(diff, diff_file,
                                     settings.get_setting('diff_mime'))
-
-                                file = open(diff_file, 'w')
-
-                                if file < 0:
-                                    print 'could not open "' + diff_file \
-                                                    + '" for writing.'
-                                    exit()
                     else:
                         print diff_id + ' is not a valid diff ID'
                 else:
@@ -42,13 +42,20 @@ def main():
 
             if len(sys.argv) > 2 and sys.argv[2]:
                 resource_id = sys.argv[2]
-                resource = resource_list.get(resource_id)
+                only_fields = None
+
+                # Only retrieve the fields that will be printed.
+                if len(sys.argv) > 3 and sys.argv[3]:
+                    only_fields = sys.argv[3].split(',')
+
+                resource = resource_list.get(resource_id,
+                                             only_fields=only_fields)
                 print resource
             else:
                 print resource_list
 
     if not valid:
-        print "usage: rb info -resource_name [resource_id]"
+        print "usage: rb info -resource_name [resource_id [field,...]]"
         print ""
         print "resource_names:"
         for n in RESOURCE_NAMES:
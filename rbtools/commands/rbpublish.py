@@ -1,11 +1,20 @@
 import os
 import sys
 
+from rbtools.api.concurrency import ThreadPool
 from rbtools.api.resource import Resource, RootResource, ReviewRequestDraft
 from rbtools.api.serverinterface import ServerInterface
 from rbtools.api.settings import Settings
 
 
+def publish_review_request(root, resource_id):
+    review_request = root.get_from_template(
+        'review_request', review_request_id=resource_id)
+    review_request_draft = \
+        ReviewRequestDraft(review_request.get_or_create('draft'))
+    review_request_draft.publish()
+
+
 def main():
     valid = False
 
@@ -13,20 +22,43 @@ def main():
         settings = Settings(config_file='rb_scripts.dat')
         cookie = settings.get_cookie_file()
         server_url = settings.get_server_url()
-        resource_id = sys.argv[1]
+        resource_ids = sys.argv[1:]
 
-        if resource_id.isdigit():
+        if [i for i in resource_ids if i.isdigit()] == resource_ids:
             valid = True
             server = ServerInterface(server_url, cookie)
             root = RootResource(server, server_url + 'api/')
-            review_requests = root.get('review_requests')
-            review_request = review_requests.get(resource_id)
-            review_request_draft = \
-                ReviewRequestDraft(review_request.get_or_create('draft'))
-            review_request_draft.publish()
+
+            # Several review requests are published at once, as quickly as
+            # the server's limiter allows.  A failure to publish one doesn't
+            # stop the others, and every failure is reported.
+            pool = ThreadPool(limiter=server.limiter)
+
+            try:
+                futures = [
+                    pool.submit(publish_review_request, root, resource_id)
+                    for resource_id in resource_ids
+                ]
+            finally:
+                pool.shutdown(wait=False)
+
+            errors = {}
+
+            for resource_id, future in zip(resource_ids, futures):
+                try:
+                    future.result()
+                except Exception, e:
+                    errors[resource_id] = e
+                    print 'Publish of review request #%s failed: %s' % \
+                        (resource_id, e)
+
+            server.close()
+
+            if errors:
+                sys.exit(1)
 
     if not valid:
-        print "usage: rb publish <review_request_id>"
+        print "usage: rb publish <review_request_id> [<review_request_id> ...]"
 
 
 if __name__ == '__main__':
@@ -3,6 +3,7 @@ import re
 import sys
 import urllib2
 
+from rbtools.api.errors import RequestTimeoutError
 from rbtools.api.resource import Resource, RootResource, ReviewRequestDraft
 from rbtools.api.serverinterface import ServerInterface
 from rbtools.api.settings import Settings
@@ -36,17 +37,16 @@ def main():
                     valid = True
                     server = ServerInterface(server_url, cookie)
                     root = RootResource(server, server_url + 'api/')
-                    review_requests = root.get('review_requests')
-                    review_request = review_requests.get(resource_id)
+                    review_request = root.get_from_template(
+                        'review_request', review_request_id=resource_id)
                     m = re.match(SCREENSHOT_OPTION, file_type)
 
                     try:
                         if m:
                             # Screenshot
-                            ss_file = open('%s' % file_name, 'r')
                             ss_data = {
                                 'filename': os.path.split(file_name)[1],
-                                'content': ss_file.read()
+                                'path': file_name
                             }
 
                             sss = review_request.get_or_create('screenshots')
@@ -64,12 +64,10 @@ def main():
                             ss.save()
                         else:
                             # Diff
-                            diff_file = open(file_name, 'r')
                             diff_data = {
                                 'filename': file_name,
-                                'content': diff_file.read()
+                                'path': file_name
                             }
-                            diff_file.close()
                             diffs = review_request.get_or_create('diffs')
                             resource_diff = diffs.create()
                             resource_diff.update_file('path', diff_data)
@@ -82,12 +80,19 @@ def main():
                         print "Request complete.  See: %s" % review_request.url
                     except urllib2.HTTPError, e:
                         if e.code == 500:
-                            print "There was an internal server error."
-                            print "Please try your request again."
+                            # Requests which are safe to repeat have already
+                            # been retried, so this one wasn't.
+                            print "There was an internal server error " \
+                                  "while uploading the file:"
+                            print e.read()
+                            sys.exit(1)
                         else:
                             print "The request failed."
                             print e.read()
                             raise e
+                    except RequestTimeoutError, e:
+                        print "The server did not respond in time: %s" % e
+                        sys.exit(1)
 
     if not valid:
         print "usage: rb upload -file_type:file_name review_request_id " \
@@ -1,17 +1,17 @@
 #!/usr/bin/env python
-import cookielib
 import difflib
 import getpass
 import marshal
-import mimetools
 import ntpath
 import os
 import re
+import shutil
 import socket
-import stat
 import subprocess
 import sys
 import tempfile
+import threading
+import time
 import urllib
 import urllib2
 from optparse import OptionParser
@@ -27,9 +27,9 @@ except ImportError:
 try:
     # Specifically import json_loads, to work around some issues with
     # installations containing incompatible modules named "json".
-    from json import loads as json_loads
+    from json import dumps as json_dumps, loads as json_loads
 except ImportError:
-    from simplejson import loads as json_loads
+    from simplejson import dumps as json_dumps, loads as json_loads
 
 # This specific import is necessary to handle the paths for
 # cygwin enabled machines.
@@ -40,6 +40,16 @@ else:
     import posixpath as cpath
 
 from rbtools import get_package_version, get_version_string
+from rbtools.api.cache import MetadataCache
+from rbtools.api.compression import CompressionHandler, \
+                                    MIN_COMPRESSED_BODY_SIZE, gzip_body
+from rbtools.api.concurrency import AdaptiveLimiter, ThreadPool
+from rbtools.api.cookies import PersistentCookieJar
+from rbtools.api.errors import RequestTimeoutError
+from rbtools.api.fileutils import replace_file
+from rbtools.api.multipart import MultipartBody, RewindBodyProcessor
+from rbtools.api.policy import RequestPolicy
+from rbtools.api.repositoryindex import RepositoryIndex
 
 
 ###
@@ -118,6 +128,22 @@ ADD_REPOSITORY_DOCS_URL = \
     'http://www.reviewboard.org/docs/manual/dev/admin/management/repositories/'
 GNU_DIFF_WIN32_URL = 'http://gnuwin32.sourceforge.net/packages/diffutils.htm'
 
+# How long, in seconds, a request to the server may take in total,
+# including any retries.  How long each attempt may take, and how failures
+# are retried, is decided by rbtools.api.policy.RequestPolicy.
+REQUEST_DEADLINE = 5 * 60
+
+# How many file revisions are fetched by each p4 print process.
+P4_PRINT_BATCH_SIZE = 200
+
+# The p4 errors which only mean a changelist doesn't exist, or has no files
+# opened in it.  Any other error from those commands is a real failure.
+P4_NO_SUCH_CHANGE_ERRORS = [r'^Change \S+ unknown']
+P4_NOT_OPENED_ERRORS = [r'file\(s\) not opened']
+
+# How large, in bytes, the local cache of Perforce file revisions may grow.
+P4_REVISION_CACHE_SIZE = 256 * 1024 * 1024
+
 
 class APIError(Exception):
     def __init__(self, http_status, error_code, rsp=None, *args, **kwargs):
@@ -189,17 +215,10 @@ class SvnRepositoryInfo(RepositoryInfo):
         repositories use the same path, you'll get back self, otherwise you'll
         get a different SvnRepositoryInfo object (with a different path).
         """
-        repositories = server.get_repositories()
-
-        for repository in repositories:
-            if repository['tool'] != 'Subversion':
-                continue
-
-            info = self._get_repository_info(server, repository)
-
-            if not info or self.uuid != info['uuid']:
-                continue
+        index = server.get_repository_index(with_uuids=True)
 
+        for repository in index.get_by_uuid(self.uuid):
+            info = repository['info']
             repos_base_path = info['url'][len(info['root_url']):]
             relpath = self._get_relative_path(self.base_path, repos_base_path)
             if relpath:
@@ -209,18 +228,6 @@ class SvnRepositoryInfo(RepositoryInfo):
         # self and hope for the best.
         return self
 
-    def _get_repository_info(self, server, repository):
-        try:
-            return server.get_repository_info(repository['id'])
-        except APIError, e:
-            # If the server couldn't fetch the repository info, it will return
-            # code 210. Ignore those.
-            # Other more serious errors should still be raised, though.
-            if e.error_code == 210:
-                return None
-
-            raise e
-
     def _get_relative_path(self, path, root):
         pathdirs = self._split_on_slash(path)
         rootdirs = self._split_on_slash(root)
@@ -267,27 +274,48 @@ class ReviewBoardHTTPPasswordMgr(urllib2.HTTPPasswordMgr):
         self.rb_url  = reviewboard_url
         self.rb_user = None
         self.rb_pass = None
+        self._lock   = threading.Lock()
 
     def find_user_password(self, realm, uri):
         if uri.startswith(self.rb_url):
-            if self.rb_user is None or self.rb_pass is None:
-                if options.diff_filename == '-':
-                    die('HTTP authentication is required, but cannot be '
-                        'used with --diff-filename=-')
-
-                print "==> HTTP Authentication Required"
-                print 'Enter username and password for "%s" at %s' % \
-                    (realm, urlparse(uri)[1])
-                self.rb_user = raw_input('Username: ')
-                self.rb_pass = getpass.getpass('Password: ')
-
-            return self.rb_user, self.rb_pass
+            # Only prompt once, even if several threads need the password.
+            self._lock.acquire()
+
+            try:
+                if self.rb_user is None or self.rb_pass is None:
+                    if options.diff_filename == '-':
+                        die('HTTP authentication is required, but cannot be '
+                            'used with --diff-filename=-')
+
+                    print "==> HTTP Authentication Required"
+                    print 'Enter username and password for "%s" at %s' % \
+                        (realm, urlparse(uri)[1])
+                    self.rb_user = raw_input('Username: ')
+                    self.rb_pass = getpass.getpass('Password: ')
+
+                return self.rb_user, self.rb_pass
+            finally:
+                self._lock.release()
         else:
-            # If this is an auth request for some other domain (since HTTP
-            # handlers are global), fall back to standard password management.
+            # If this is an auth request for some other domain (such as after
+            # a redirect), fall back to standard password management.
             return urllib2.HTTPPasswordMgr.find_user_password(self, realm, uri)
 
 
+def get_content_size(content):
+    """
+    Returns the size of diff content, which is either a string or a file.
+    """
+    if isinstance(content, basestring):
+        return len(content)
+
+    start = content.tell()
+    content.seek(0, os.SEEK_END)
+    size = content.tell()
+    content.seek(start)
+    return size
+
+
 class ReviewBoardServer(object):
     """
     An instance of a Review Board server.
@@ -298,20 +326,54 @@ class ReviewBoardServer(object):
             self.url += '/'
         self._info = info
         self._server_info = None
+        self._supports_draft_set_multiple = True
+        self._repository_index = None
         self.cookie_file = cookie_file
-        self.cookie_jar  = cookielib.MozillaCookieJar(self.cookie_file)
-
-        # Set up the HTTP libraries to support all of the features we need.
-        cookie_handler      = urllib2.HTTPCookieProcessor(self.cookie_jar)
-        password_mgr        = ReviewBoardHTTPPasswordMgr(self.url)
-        basic_auth_handler  = urllib2.HTTPBasicAuthHandler(password_mgr)
-        digest_auth_handler = urllib2.HTTPDigestAuthHandler(password_mgr)
-
-        opener = urllib2.build_opener(cookie_handler,
-                                      basic_auth_handler,
-                                      digest_auth_handler)
-        opener.addheaders = [('User-agent', 'RBTools/' + get_package_version())]
-        urllib2.install_opener(opener)
+        # post-review is short-lived, so changed cookies are only written
+        # out when it exits.
+        self.cookie_jar  = PersistentCookieJar(self.cookie_file,
+                                               flush_delay=None)
+
+        # Slow-changing data, such as the list of repositories, is cached
+        # on disk in the user's home directory so later runs can reuse it.
+        self.metadata_cache = MetadataCache(
+            username=getattr(options, 'username', None))
+
+        self.password_mgr = ReviewBoardHTTPPasswordMgr(self.url)
+        self.request_policy = RequestPolicy()
+
+        # Bulk operations share this limiter, so that together they can't
+        # overload the server.
+        self.limiter = AdaptiveLimiter()
+        self.compression_handler = CompressionHandler()
+
+        # Each thread gets its own opener (see get_opener), and none is
+        # installed globally, so that this server's cookies and credentials
+        # are never used for any other server.
+        self._local = threading.local()
+
+    def get_opener(self):
+        """
+        Returns this thread's opener for requests to the server.  The auth
+        handlers keep per-request state, so threads can't share an opener,
+        but they do share the cookie jar and password manager.
+        """
+        opener = getattr(self._local, 'opener', None)
+
+        if opener is None:
+            # Set up the HTTP libraries to support all of the features we
+            # need.
+            opener = urllib2.build_opener(
+                urllib2.HTTPCookieProcessor(self.cookie_jar),
+                urllib2.HTTPBasicAuthHandler(self.password_mgr),
+                urllib2.HTTPDigestAuthHandler(self.password_mgr),
+                RewindBodyProcessor(),
+                self.compression_handler)
+            opener.addheaders = [('User-agent',
+                                  'RBTools/' + get_package_version())]
+            self._local.opener = opener
+
+        return opener
 
     def login(self, force=False):
         """
@@ -355,39 +417,35 @@ class ReviewBoardServer(object):
 
     def has_valid_cookie(self):
         """
-        Load the user's cookie file and see if they have a valid
-        'rbsessionid' cookie for the current Review Board server.  Returns
-        true if so and false otherwise.
+        See if the user's cookie file, which was loaded on startup, has a
+        valid 'rbsessionid' cookie for the current Review Board server.
+        Returns true if so and false otherwise.
         """
-        try:
-            parsed_url = urlparse(self.url)
-            host = parsed_url[1]
-            path = parsed_url[2] or '/'
+        parsed_url = urlparse(self.url)
+        host = parsed_url[1]
+        path = parsed_url[2] or '/'
 
-            # Cookie files don't store port numbers, unfortunately, so
-            # get rid of the port number if it's present.
-            host = host.split(":")[0]
+        # Cookie files don't store port numbers, unfortunately, so
+        # get rid of the port number if it's present.
+        host = host.split(":")[0]
 
-            # Cookie files also append .local to bare hostnames
-            if '.' not in host:
-                host += '.local'
+        # Cookie files also append .local to bare hostnames
+        if '.' not in host:
+            host += '.local'
 
-            debug("Looking for '%s %s' cookie in %s" % \
-                  (host, path, self.cookie_file))
-            self.cookie_jar.load(self.cookie_file, ignore_expires=True)
+        debug("Looking for '%s %s' cookie in %s" % \
+              (host, path, self.cookie_file))
 
-            try:
-                cookie = self.cookie_jar._cookies[host][path]['rbsessionid']
+        try:
+            cookie = self.cookie_jar._cookies[host][path]['rbsessionid']
 
-                if not cookie.is_expired():
-                    debug("Loaded valid cookie -- no login required")
-                    return True
+            if not cookie.is_expired():
+                debug("Loaded valid cookie -- no login required")
+                return True
 
-                debug("Cookie file loaded, but cookie has expired")
-            except KeyError:
-                debug("Cookie file loaded, but no cookie for this server")
-        except IOError, error:
-            debug("Couldn't load cookie file: %s" % error)
+            debug("Cookie file loaded, but cookie has expired")
+        except KeyError:
+            debug("Cookie file loaded, but no cookie for this server")
 
         return False
 
@@ -404,15 +462,13 @@ class ReviewBoardServer(object):
         # If repository_path is a list, find a name in the list that's
         # registered on the server.
         if isinstance(self.info.path, list):
-            repositories = self.get_repositories()
-
-            debug("Repositories on Server: %s" % repositories)
             debug("Server Aliases: %s" % self.info.path)
 
-            for repository in repositories:
-                if repository['path'] in self.info.path:
-                    self.info.path = repository['path']
-                    break
+            repository = \
+                self.get_repository_index().get_by_path(self.info.path)
+
+            if repository:
+                self.info.path = repository['path']
 
         try:
             debug("Attempting to create review request on %s for %s" %
@@ -474,6 +530,39 @@ class ReviewBoardServer(object):
             field: value,
         })
 
+    def set_review_request_fields(self, review_request, fields):
+        """
+        Sets several fields in a review request at once.
+
+        fields is a list of (field, value) tuples.  They're sent together in
+        a single draft update.  If the server turns that down, each field is
+        set with its own request instead, as servers which only understand
+        one field at a time require.
+        """
+        if not fields:
+            return
+
+        if len(fields) > 1 and self._supports_draft_set_multiple:
+            rid = review_request['id']
+
+            debug("Attempting to set fields %s for review request '%s'" %
+                  (', '.join([field for field, value in fields]), rid))
+
+            try:
+                self.api_post('api/json/reviewrequests/%s/draft/set/' % rid,
+                               dict(fields))
+                return
+            except APIError, e:
+                if e.error_code == 103: # Not logged in
+                    raise e
+
+                debug('Setting the fields together failed (%s), so setting '
+                      'them one at a time' % e)
+                self._supports_draft_set_multiple = False
+
+        for field, value in fields:
+            self.set_review_request_field(review_request, field, value)
+
     def get_review_request(self, rid):
         """
         Returns the review request with the specified ID.
@@ -495,6 +584,81 @@ class ReviewBoardServer(object):
         rsp = self.api_get('/api/json/repositories/%s/info/' % rid)
         return rsp['info']
 
+    def get_repository_index(self, with_uuids=False):
+        """
+        Returns a RepositoryIndex of the repositories on this server.
+
+        The index is kept in the metadata cache, and reused by later runs
+        until the cache's time to live for repository lists runs out.  If
+        with_uuids is set, the info of any Subversion repositories not
+        already in the index is fetched, several at a time, so they can be
+        looked up by UUID.
+        """
+        if self._repository_index is None:
+            cached = self.metadata_cache.get(
+                self._get_repository_index_key(), 'repositories')
+
+            if cached:
+                debug("Using the cached list of repositories in %s" %
+                      self.metadata_cache.path)
+                repositories = cached[1]
+            else:
+                repositories = self.get_repositories()
+                debug("Repositories on Server: %s" % repositories)
+                self._save_repository_index(repositories)
+
+            self._repository_index = RepositoryIndex(repositories)
+
+        if with_uuids:
+            repositories = [
+                repository
+                for repository in self._repository_index.repositories
+                if repository['tool'] == 'Subversion' and
+                   'info' not in repository
+            ]
+
+            if repositories:
+                pool = ThreadPool(limiter=self.limiter)
+
+                try:
+                    futures = pool.map(self._get_repository_info_or_none,
+                                       repositories)
+                finally:
+                    pool.shutdown(wait=False)
+
+                # Any error is raised once every request has finished.
+                for future in futures:
+                    future.exception()
+
+                for repository, future in zip(repositories, futures):
+                    repository['info'] = future.result() or {}
+
+                self._repository_index = \
+                    RepositoryIndex(self._repository_index.repositories)
+                self._save_repository_index(
+                    self._repository_index.repositories)
+
+        return self._repository_index
+
+    def _get_repository_info_or_none(self, repository):
+        try:
+            return self.get_repository_info(repository['id'])
+        except APIError, e:
+            # If the server couldn't fetch the repository info, it will return
+            # code 210. Ignore those.
+            # Other more serious errors should still be raised, though.
+            if e.error_code == 210:
+                return None
+
+            raise e
+
+    def _get_repository_index_key(self):
+        return self._make_url('/api/json/repositories/') + '#index'
+
+    def _save_repository_index(self, repositories):
+        self.metadata_cache.set(self._get_repository_index_key(),
+                                json_dumps(repositories), 'repositories')
+
     def save_draft(self, review_request):
         """
         Saves a draft of a review request.
@@ -507,10 +671,11 @@ class ReviewBoardServer(object):
         """
         Uploads a diff to a Review Board server.
         """
-        debug("Uploading diff, size: %d" % len(diff_content))
+        debug("Uploading diff, size: %d" % get_content_size(diff_content))
 
         if parent_diff_content:
-            debug("Uploading parent diff, size: %d" % len(parent_diff_content))
+            debug("Uploading parent diff, size: %d" %
+                  get_content_size(parent_diff_content))
 
         fields = {}
         files = {}
@@ -586,18 +751,16 @@ class ReviewBoardServer(object):
 
     def http_get(self, path):
         """
-        Performs an HTTP GET on the specified path, storing any cookies that
-        were set.
+        Performs an HTTP GET on the specified path.  Any cookies that were
+        set are written out at exit.
         """
         debug('HTTP GETting %s' % path)
 
         url = self._make_url(path)
-        rsp = urllib2.urlopen(url).read()
-        try:
-            self.cookie_jar.save(self.cookie_file)
-        except IOError, e:
-            debug('Failed to write cookie file: %s' % e)
-        return rsp
+
+        # GETs don't change anything on the server, so the request policy
+        # retries them if the server or connection fails.
+        return self._send('GET', url)
 
     def _make_url(self, path):
         """Given a path on the server returns a full http:// style url"""
@@ -622,8 +785,8 @@ class ReviewBoardServer(object):
 
     def http_post(self, path, fields, files=None):
         """
-        Performs an HTTP POST on the specified path, storing any cookies that
-        were set.
+        Performs an HTTP POST on the specified path.  Any cookies that were
+        set are written out at exit.
         """
         if fields:
             debug_fields = fields.copy()
@@ -641,14 +804,40 @@ class ReviewBoardServer(object):
             'Content-Length': str(len(body))
         }
 
-        try:
-            r = urllib2.Request(url, body, headers)
-            data = urllib2.urlopen(r).read()
+        if (self.compression_handler.server_accepts_gzip and
+            len(body) >= MIN_COMPRESSED_BODY_SIZE):
+            compressed_body, compressed_length = gzip_body(body)
+
+            compressed_headers = headers.copy()
+            compressed_headers['Content-Encoding'] = 'gzip'
+            compressed_headers['Content-Length'] = str(compressed_length)
+
+            debug('Compressed the request body from %s to %s bytes' %
+                  (headers['Content-Length'],
+                   compressed_headers['Content-Length']))
+
             try:
-                self.cookie_jar.save(self.cookie_file)
-            except IOError, e:
-                debug('Failed to write cookie file: %s' % e)
-            return data
+                return self._do_http_post(url, compressed_body,
+                                          compressed_headers)
+            except urllib2.HTTPError, e:
+                if e.code != 415:
+                    raise e
+
+                # The server turned down the compressed body, so fall back
+                # to sending it uncompressed from now on.
+                debug('Server rejected the compressed request body')
+                self.compression_handler.reject_gzip()
+                body.seek(0)
+
+        return self._do_http_post(url, body, headers)
+
+    def _do_http_post(self, url, body, headers):
+        """
+        Performs an HTTP POST of an encoded body to url.  Any cookies that
+        were set are written out at exit.
+        """
+        try:
+            return self._send('POST', url, body, headers)
         except urllib2.HTTPError, e:
             # Re-raise so callers can interpret it.
             raise e
@@ -661,6 +850,25 @@ class ReviewBoardServer(object):
             die("Unable to access %s. The host path may be invalid\n%s" % \
                 (url, e))
 
+    def _send(self, method, url, body=None, headers=None):
+        """
+        Sends a request according to the request policy, and returns the
+        body of the response.  Dies if the request doesn't succeed before
+        REQUEST_DEADLINE.
+        """
+        def attempt(timeout):
+            if timeout is None:
+                timeout = socket._GLOBAL_DEFAULT_TIMEOUT
+
+            r = urllib2.Request(url, body, headers or {})
+            return self.get_opener().open(r, timeout=timeout).read()
+
+        try:
+            return self.request_policy.call(method, attempt,
+                                            REQUEST_DEADLINE)
+        except RequestTimeoutError, e:
+            die("Timed out waiting for %s to respond" % url)
+
     def api_post(self, path, fields=None, files=None):
         """
         Performs an API call using HTTP POST at the specified path.
@@ -673,34 +881,12 @@ class ReviewBoardServer(object):
     def _encode_multipart_formdata(self, fields, files):
         """
         Encodes data for use in an HTTP POST.
-        """
-        BOUNDARY = mimetools.choose_boundary()
-        content = ""
 
-        fields = fields or {}
-        files = files or {}
-
-        for key in fields:
-            content += "--" + BOUNDARY + "\r\n"
-            content += "Content-Disposition: form-data; name=\"%s\"\r\n" % key
-            content += "\r\n"
-            content += fields[key] + "\r\n"
-
-        for key in files:
-            filename = files[key]['filename']
-            value = files[key]['content']
-            content += "--" + BOUNDARY + "\r\n"
-            content += "Content-Disposition: form-data; name=\"%s\"; " % key
-            content += "filename=\"%s\"\r\n" % filename
-            content += "\r\n"
-            content += value + "\r\n"
-
-        content += "--" + BOUNDARY + "--\r\n"
-        content += "\r\n"
-
-        content_type = "multipart/form-data; boundary=%s" % BOUNDARY
-
-        return content_type, content
+        The body is returned as a MultipartBody, which is streamed to the
+        server as the request is sent.
+        """
+        body = MultipartBody(fields, files)
+        return body.content_type, body
 
 
 class SCMClient(object):
@@ -1406,22 +1592,211 @@ class SVNClient(SCMClient):
         return [s.split('\n')[0], '\n']
 
 
+class RevisionCache(object):
+    """
+    A local cache of the contents of file revisions, such as Perforce's
+    //depot/path#rev, which never change once submitted.
+
+    Each revision is kept in its own file, named after a hash of its depot
+    path, revision and content digest.  Including the digest means that a
+    revision which was obliterated and submitted again with new contents is
+    never mistaken for the old one.  Files are written to a temporary file
+    which is then renamed into place, so several processes can share the
+    cache.  Reading a revision marks it as recently used, and prune()
+    removes the least recently used revisions once the cache is larger
+    than max_size bytes.
+    """
+    def __init__(self, path, max_size=P4_REVISION_CACHE_SIZE):
+        self.path = path
+        self.max_size = max_size
+
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+    def get(self, depot_path, digest):
+        """
+        Returns the cached contents of depot_path, a "path#rev", with the
+        given digest, or None.
+        """
+        filename = self._get_filename(depot_path, digest)
+
+        try:
+            f = open(filename, 'rb')
+
+            try:
+                data = f.read()
+            finally:
+                f.close()
+
+            os.utime(filename, None)
+        except (IOError, OSError):
+            # Another process may have just pruned it.
+            return None
+
+        return data
+
+    def set(self, depot_path, digest, data):
+        """
+        Caches the contents of depot_path, a "path#rev", with the given
+        digest.
+        """
+        def write(path):
+            f = open(path, 'wb')
+
+            try:
+                f.write(data)
+            finally:
+                f.close()
+
+        try:
+            replace_file(self._get_filename(depot_path, digest), write)
+        except (IOError, OSError):
+            # Caching is only an optimization.
+            pass
+
+    def prune(self):
+        """
+        Removes the least recently used revisions until the cache is no
+        larger than max_size bytes.
+        """
+        entries = []
+        size = 0
+
+        for name in os.listdir(self.path):
+            filename = os.path.join(self.path, name)
+
+            try:
+                st = os.stat(filename)
+            except OSError:
+                continue
+
+            entries.append((st.st_mtime, st.st_size, filename))
+            size += st.st_size
+
+        entries.sort()
+
+        while entries and size > self.max_size:
+            mtime, file_size, filename = entries.pop(0)
+
+            try:
+                os.unlink(filename)
+            except OSError:
+                pass
+
+            size -= file_size
+
+    def _get_filename(self, depot_path, digest):
+        return os.path.join(self.path,
+                            md5('%s\0%s' % (depot_path, digest)).hexdigest())
+
+
+class P4Session(object):
+    """
+    Runs p4 commands, reading their output as marshalled Python records
+    (p4 -G) rather than parsing text meant for people.
+
+    Records are read from p4 as they're needed, so a large output, such as
+    the contents of many files from p4 print, is never held in memory all
+    at once.  A command can be given any number of arguments in an argument
+    file, and p4 then runs it for each of them within the one process.
+    """
+    def run(self, command, args=None, ignore_errors=False,
+            expected_errors=None):
+        """
+        Runs a p4 command and returns a list of all its records.  See
+        iter_records.
+        """
+        return list(self.iter_records(command, args, ignore_errors,
+                                      expected_errors))
+
+    def iter_records(self, command, args=None, ignore_errors=False,
+                     expected_errors=None):
+        """
+        Runs a p4 command, yielding its records as they're read.
+
+        command - A list of strings of the command to execute.
+        args - An optional list of further arguments for the command.  They
+            are passed in an argument file with -x, so there can be any
+            number of them, and the command is run once for each.
+        ignore_errors - If True, error records are yielded like any other.
+            Otherwise, once all the records have been read, any errors are
+            printed and the program exits.
+        expected_errors - An optional list of regular expressions.  Error
+            records whose message matches one of them are skipped, rather
+            than being treated as errors.
+        """
+        args_filename = None
+
+        if args:
+            args_filename = make_tempfile()
+            f = open(args_filename, 'w')
+            f.write(''.join(['%s\n' % arg for arg in args]))
+            f.close()
+            command = ['-x', args_filename] + command
+
+        command = ['p4', '-G'] + command
+        debug(subprocess.list2cmdline(command))
+
+        p = subprocess.Popen(command, stdout=subprocess.PIPE)
+        errors = []
+        skipped_errors = False
+
+        try:
+            while True:
+                try:
+                    record = marshal.load(p.stdout)
+                except EOFError:
+                    break
+
+                if record.get('code') == 'error' and not ignore_errors:
+                    message = record.get('data', '')
+
+                    if [pattern for pattern in expected_errors or []
+                        if re.search(pattern, message, re.I)]:
+                        skipped_errors = True
+                    else:
+                        errors.append(record)
+                else:
+                    yield record
+        finally:
+            # If the caller stops reading early, this stops p4 as well.
+            p.stdout.close()
+            rc = p.wait()
+
+            if args_filename:
+                os.unlink(args_filename)
+
+        # p4 exits with an error status after any error, including the
+        # expected ones.
+        if (rc and not ignore_errors and not skipped_errors) or errors:
+            for record in errors:
+                if 'data' in record:
+                    print record['data']
+
+            die('Failed to execute command: %s\n' % (command,))
+
+
 class PerforceClient(SCMClient):
     """
     A wrapper around the p4 Perforce tool that fetches repository information
     and generates compatible diffs.
     """
+    def __init__(self):
+        self.p4 = P4Session()
+
     def get_repository_info(self):
         if not check_install('p4 help'):
             return None
 
-        data = execute(["p4", "info"], ignore_errors=True)
+        p4_info = {}
 
-        m = re.search(r'^Server address: (.+)$', data, re.M)
-        if not m:
+        for record in self.p4.iter_records(['info'], ignore_errors=True):
+            p4_info.update(record)
+
+        if not p4_info.get('serverAddress'):
             return None
 
-        repository_path = m.group(1).strip()
+        repository_path = p4_info['serverAddress'].strip()
 
         try:
             hostname, port = repository_path.split(":")
@@ -1438,8 +1813,8 @@ class PerforceClient(SCMClient):
         except (socket.gaierror, socket.herror):
             pass
 
-        m = re.search(r'^Server version: [^ ]*/([0-9]+)\.([0-9]+)/[0-9]+ .*$',
-                      data, re.M)
+        m = re.search(r'^[^ ]*/([0-9]+)\.([0-9]+)/[0-9]+ .*$',
+                      p4_info['serverVersion'])
         self.p4d_version = int(m.group(1)), int(m.group(2))
 
         return RepositoryInfo(path=repository_path, supports_changesets=True)
@@ -1467,20 +1842,19 @@ class PerforceClient(SCMClient):
         should not be used unencoded in urls.
         """
 
-        counters_text = execute(["p4", "counters"])
+        counters = dict([(record['counter'], record['value'])
+                         for record in self.p4.iter_records(['counters'])
+                         if 'counter' in record])
 
         # Try for a "reviewboard.url" counter first.
-        m = re.search(r'^reviewboard.url = (\S+)', counters_text, re.M)
-
-        if m:
-            return m.group(1)
+        if counters.get('reviewboard.url'):
+            return counters['reviewboard.url']
 
         # Next try for a counter of the form:
         # reviewboard_url.http:||reviewboard.example.com
-        m2 = re.search(r'^reviewboard.url\.(\S+)', counters_text, re.M)
-
-        if m2:
-            return m2.group(1).replace('|', '/')
+        for name in counters:
+            if name.startswith('reviewboard.url.'):
+                return name[len('reviewboard.url.'):].replace('|', '/')
 
         return None
 
@@ -1547,11 +1921,7 @@ class PerforceClient(SCMClient):
                                       r'(?P<revision1>[#@][^,]+)?' +
                                       r'(?P<revision2>,[#@][^,]+)?$')
 
-        empty_filename = make_tempfile()
-        tmp_diff_from_filename = make_tempfile()
-        tmp_diff_to_filename = make_tempfile()
-
-        diff_lines = []
+        diff_files = []
 
         for path in args:
             m = r_revision_range.match(path)
@@ -1596,21 +1966,15 @@ class PerforceClient(SCMClient):
                         except KeyError:
                             files[record['depotFile']] = [None, record]
 
-            old_file = new_file = empty_filename
-            changetype_short = None
-
             for depot_path, (first_record, second_record) in files.items():
-                old_file = new_file = empty_filename
+                old_depot_path = new_depot_path = None
+
                 if first_record is None:
-                    self._write_file(depot_path + '#' + second_record['rev'],
-                                     tmp_diff_to_filename)
-                    new_file = tmp_diff_to_filename
+                    new_depot_path = depot_path + '#' + second_record['rev']
                     changetype_short = 'A'
                     base_revision = 0
                 elif second_record is None:
-                    self._write_file(depot_path + '#' + first_record['rev'],
-                                     tmp_diff_from_filename)
-                    old_file = tmp_diff_from_filename
+                    old_depot_path = depot_path + '#' + first_record['rev']
                     changetype_short = 'D'
                     base_revision = int(first_record['rev'])
                 elif first_record['rev'] == second_record['rev']:
@@ -1619,56 +1983,51 @@ class PerforceClient(SCMClient):
                     # diffs quite a bit.
                     continue
                 else:
-                    self._write_file(depot_path + '#' + first_record['rev'],
-                                     tmp_diff_from_filename)
-                    self._write_file(depot_path + '#' + second_record['rev'],
-                                     tmp_diff_to_filename)
-                    new_file = tmp_diff_to_filename
-                    old_file = tmp_diff_from_filename
+                    old_depot_path = depot_path + '#' + first_record['rev']
+                    new_depot_path = depot_path + '#' + second_record['rev']
                     changetype_short = 'M'
                     base_revision = int(first_record['rev'])
 
-                dl = self._do_diff(old_file, new_file, depot_path,
-                                   base_revision, changetype_short,
-                                   ignore_unmodified=True)
-                diff_lines += dl
-
-        os.unlink(empty_filename)
-        os.unlink(tmp_diff_from_filename)
-        os.unlink(tmp_diff_to_filename)
+                diff_files.append((depot_path, base_revision,
+                                   changetype_short, old_depot_path,
+                                   new_depot_path, None))
+
+        # Files with different revisions can still have the same contents,
+        # such as when one was integrated from another branch.  The digests
+        # of every revision are looked up with a single p4 fstat, and files
+        # whose contents match on both sides are skipped without being
+        # fetched.
+        digests = {}
+
+        if diff_files:
+            depot_paths = []
+
+            for file_info in diff_files:
+                depot_paths += [path for path in file_info[3:5] if path]
+
+            digests = self._get_digests(depot_paths)
+            diff_files = [
+                file_info
+                for file_info in diff_files
+                if not (file_info[3] and file_info[4] and
+                        file_info[3] in digests and
+                        digests[file_info[3]] == digests.get(file_info[4]))
+            ]
+
+        diff_lines = self._diff_files(diff_files, ignore_unmodified=True,
+                                      digests=digests)
         return (''.join(diff_lines), None)
 
-    def _run_p4(self, command):
+    def _run_p4(self, command, args=None):
         """Execute a perforce command using the python marshal API.
 
         - command: A list of strings of the command to execute.
+        - args: An optional list of further arguments for the command.  See
+          P4Session.iter_records.
 
-        The return type depends on the command being run.
+        Returns a list of the records output by the command.
         """
-        command = ['p4', '-G'] + command
-        p = subprocess.Popen(command, stdout=subprocess.PIPE)
-        result = []
-        has_error = False
-
-        while 1:
-            try:
-                data = marshal.load(p.stdout)
-            except EOFError:
-                break
-            else:
-                result.append(data)
-                if data.get('code', None) == 'error':
-                    has_error = True
-
-        rc = p.wait()
-
-        if rc or has_error:
-            for record in result:
-                if 'data' in record:
-                    print record['data']
-            die('Failed to execute command: %s\n' % (command,))
-
-        return result
+        return self.p4.run(command, args)
 
     """
     Return a "sanitized" change number for submission to the Review Board
@@ -1688,14 +2047,27 @@ class PerforceClient(SCMClient):
             v = self.p4d_version
 
             if v[0] < 2002 or (v[0] == "2002" and v[1] < 2):
-                description = execute(["p4", "describe", "-s", changenum],
-                                      split_lines=True)
+                change = self._describe_change(changenum)
 
-                if '*pending*' in description[0]:
+                if change.get('status') == 'pending':
                     return None
 
         return changenum
 
+    def _describe_change(self, changenum):
+        """
+        Returns the record from p4 describe for a changelist, or an empty
+        dict if there's no such changelist.  Any other error is printed, and
+        the program exits.
+        """
+        for record in self.p4.iter_records(
+            ['describe', '-s', changenum],
+            expected_errors=P4_NO_SUCH_CHANGE_ERRORS):
+            if 'change' in record:
+                return record
+
+        return {}
+
     def _changenum_diff(self, changenum):
         """
         Process a diff for a particular change number.  This handles both
@@ -1711,20 +2083,17 @@ class PerforceClient(SCMClient):
 
         debug("Generating diff for changenum %s" % changenum)
 
-        description = []
+        change = {}
 
         if changenum == "default":
             cl_is_pending = True
         else:
-            description = execute(["p4", "describe", "-s", changenum],
-                                  split_lines=True)
+            change = self._describe_change(changenum)
 
-            if re.search("no such changelist", description[0]):
+            if not change:
                 die("CLN %s does not exist." % changenum)
 
-            # Some P4 wrappers are addding an extra line before the description
-            if '*pending*' in description[0] or '*pending*' in description[1]:
-                cl_is_pending = True
+            cl_is_pending = change.get('status') == 'pending'
 
         v = self.p4d_version
 
@@ -1733,150 +2102,290 @@ class PerforceClient(SCMClient):
             # Pre-2002.2 doesn't give file list in pending changelists,
             # or we don't have a description for a default changeset,
             # so we have to get it a different way.
-            info = execute(["p4", "opened", "-c", str(changenum)],
-                           split_lines=True)
-
-            if len(info) == 1 and info[0].startswith("File(s) not opened on this client."):
-                die("Couldn't find any affected files for this change.")
-
-            for line in info:
-                data = line.split(" ")
-                description.append("... %s %s" % (data[0], data[2]))
-
+            changed_files = [
+                (record['depotFile'], record['rev'], record['action'])
+                for record in self.p4.iter_records(
+                    ['opened', '-c', str(changenum)],
+                    expected_errors=P4_NOT_OPENED_ERRORS)
+                if 'depotFile' in record
+            ]
         else:
-            # Get the file list
-            for line_num, line in enumerate(description):
-                if 'Affected files ...' in line:
-                    break
-            else:
-                # Got to the end of all the description lines and didn't find
-                # what we were looking for.
-                die("Couldn't find any affected files for this change.")
+            # The describe record numbers each file's fields, as depotFile0,
+            # rev0, action0, depotFile1 and so on.
+            changed_files = []
 
-            description = description[line_num+2:]
+            while 'depotFile%d' % len(changed_files) in change:
+                i = len(changed_files)
+                changed_files.append((change['depotFile%d' % i],
+                                      change['rev%d' % i],
+                                      change['action%d' % i]))
 
-        diff_lines = []
+        if not changed_files:
+            die("Couldn't find any affected files for this change.")
 
-        empty_filename = make_tempfile()
-        tmp_diff_from_filename = make_tempfile()
-        tmp_diff_to_filename = make_tempfile()
+        if cl_is_pending:
+            # The new versions of the files are in the client.
+            local_paths = self._get_local_paths(
+                [depot_path for depot_path, rev, changetype in changed_files
+                 if changetype not in ['delete', 'move/delete']])
 
-        for line in description:
-            line = line.strip()
-            if not line:
-                continue
-
-            m = re.search(r'\.\.\. ([^#]+)#(\d+) '
-                          r'(add|edit|delete|integrate|branch|move/add'
-                          r'|move/delete)',
-                          line)
-            if not m:
-                die("Unsupported line from p4 opened: %s" % line)
+        diff_files = []
 
-            depot_path = m.group(1)
-            base_revision = int(m.group(2))
+        for depot_path, base_revision, changetype in changed_files:
+            base_revision = int(base_revision)
             if not cl_is_pending:
                 # If the changelist is pending our base revision is the one that's
                 # currently in the depot. If we're not pending the base revision is
                 # actually the revision prior to this one
                 base_revision -= 1
 
-            changetype = m.group(3)
-
             debug('Processing %s of %s' % (changetype, depot_path))
 
-            old_file = new_file = empty_filename
-            old_depot_path = new_depot_path = None
+            old_depot_path = new_depot_path = new_local_path = None
             changetype_short = None
 
             if changetype in ['edit', 'integrate']:
                 # A big assumption
                 new_revision = base_revision + 1
 
-                # We have an old file, get p4 to take this old version from the
-                # depot and put it into a plain old temp file for us
+                # We have an old file, which p4 will fetch from the depot.
                 old_depot_path = "%s#%s" % (depot_path, base_revision)
-                self._write_file(old_depot_path, tmp_diff_from_filename)
-                old_file = tmp_diff_from_filename
 
-                # Also print out the new file into a tmpfile
+                # The new file is either in the client or the depot.
                 if cl_is_pending:
-                    new_file = self._depot_to_local(depot_path)
+                    new_local_path = local_paths[depot_path]
                 else:
                     new_depot_path = "%s#%s" %(depot_path, new_revision)
-                    self._write_file(new_depot_path, tmp_diff_to_filename)
-                    new_file = tmp_diff_to_filename
 
                 changetype_short = "M"
             elif changetype in ['add', 'branch', 'move/add']:
-                # We have a new file, get p4 to put this new file into a pretty
-                # temp file for us. No old file to worry about here.
+                # We have a new file. No old file to worry about here.
                 if cl_is_pending:
-                    new_file = self._depot_to_local(depot_path)
+                    new_local_path = local_paths[depot_path]
                 else:
-                    self._write_file(depot_path, tmp_diff_to_filename)
-                    new_file = tmp_diff_to_filename
+                    new_depot_path = "%s#%s" % (depot_path, base_revision + 1)
                 changetype_short = "A"
             elif changetype in ['delete', 'move/delete']:
-                # We've deleted a file, get p4 to put the deleted file into  a temp
-                # file for us. The new file remains the empty file.
+                # We've deleted a file, so there's only the old file to
+                # fetch. The new file remains the empty file.
                 old_depot_path = "%s#%s" % (depot_path, base_revision)
-                self._write_file(old_depot_path, tmp_diff_from_filename)
-                old_file = tmp_diff_from_filename
                 changetype_short = "D"
             else:
                 die("Unknown change type '%s' for %s" % (changetype, depot_path))
 
-            dl = self._do_diff(old_file, new_file, depot_path, base_revision, changetype_short)
-            diff_lines += dl
+            diff_files.append((depot_path, base_revision, changetype_short,
+                               old_depot_path, new_depot_path,
+                               new_local_path))
 
-        os.unlink(empty_filename)
-        os.unlink(tmp_diff_from_filename)
-        os.unlink(tmp_diff_to_filename)
+        diff_lines = self._diff_files(diff_files)
         return (''.join(diff_lines), None)
 
-    def _do_diff(self, old_file, new_file, depot_path, base_revision,
-                 changetype_short, ignore_unmodified=False):
+    def _diff_files(self, files, ignore_unmodified=False, digests=None):
+        """
+        Produces the diffs for a list of files.  The revisions to diff are
+        fetched from Perforce in batches of P4_PRINT_BATCH_SIZE, with one p4
+        process for each batch, rather than one for each revision, and are
+        diffed in memory.
+
+        files - A list of (depot_path, base_revision, changetype_short,
+            old_depot_path, new_depot_path, new_local_path) tuples.
+            old_depot_path and new_depot_path are the "path#rev" revisions
+            to diff, or None for an empty file.  If new_local_path is set,
+            the new file is read from that path in the client instead.
+        ignore_unmodified - If True, unchanged files are left out.
+        digests - A dict of the digests of the revisions, if they've already
+            been looked up.  See _print_files.
+
+        Returns a list of strings of diff lines.
         """
-        Do the work of producing a diff for Perforce.
+        diff_lines = []
+
+        for i in range(0, len(files), P4_PRINT_BATCH_SIZE):
+            batch = files[i:i + P4_PRINT_BATCH_SIZE]
+            depot_paths = []
+
+            for file_info in batch:
+                depot_paths += [path for path in file_info[3:5] if path]
+
+            contents = self._print_files(depot_paths, digests)
+
+            for (depot_path, base_revision, changetype_short, old_depot_path,
+                 new_depot_path, new_local_path) in batch:
+                old_data = new_data = ''
+                new_mtime = None
+
+                if old_depot_path:
+                    old_data = contents[old_depot_path]
+
+                if new_depot_path:
+                    new_data = contents[new_depot_path]
+                elif new_local_path:
+                    f = open(new_local_path, 'rb')
+
+                    try:
+                        new_data = f.read()
+                    finally:
+                        f.close()
 
-        old_file - The absolute path to the "old" file.
-        new_file - The absolute path to the "new" file.
+                    new_mtime = os.path.getmtime(new_local_path)
+
+                diff_lines += self._do_diff(old_data, new_data, depot_path,
+                                            base_revision, changetype_short,
+                                            ignore_unmodified, new_mtime)
+
+        cache = self._get_revision_cache()
+
+        if cache:
+            cache.prune()
+
+        return diff_lines
+
+    def _print_files(self, depot_paths, digests=None):
+        """
+        Fetches the contents of several file revisions from Perforce.
+
+        Revisions already in the local revision cache are read from there,
+        after checking their digests with a single p4 fstat.  The rest are
+        fetched with a single p4 print, and cached.  The marshalled output
+        of p4 print holds a stat record for each revision, followed by
+        records holding its contents in pieces.
+
+        depot_paths - A list of "path#rev" depot paths.
+        digests - A dict of the digests of the revisions, if they've already
+            been looked up.  Any which are missing are looked up.
+
+        Returns a dict mapping each of depot_paths to its contents.
+        """
+        if not depot_paths:
+            return {}
+
+        cache = self._get_revision_cache()
+        digests = dict(digests or {})
+        contents = {}
+
+        if cache:
+            unknown = [depot_path for depot_path in depot_paths
+                       if depot_path not in digests]
+
+            if unknown:
+                digests.update(self._get_digests(unknown))
+
+            for depot_path in depot_paths:
+                if depot_path in digests:
+                    data = cache.get(depot_path, digests[depot_path])
+
+                    if data is not None:
+                        contents[depot_path] = data
+
+        missing = [depot_path for depot_path in depot_paths
+                   if depot_path not in contents]
+
+        if not missing:
+            return contents
+
+        debug('Fetching %d of %d revisions from Perforce' %
+              (len(missing), len(depot_paths)))
+
+        printed = {}
+        chunks = None
+
+        for record in self.p4.iter_records(['print'], missing):
+            if record.get('code') == 'stat':
+                chunks = printed.setdefault('%s#%s' % (record['depotFile'],
+                                                       record['rev']), [])
+            elif chunks is not None and 'data' in record:
+                chunks.append(record['data'])
+
+        for depot_path in missing:
+            if depot_path not in printed:
+                die('Unable to fetch %s from Perforce.' % depot_path)
+
+            contents[depot_path] = ''.join(printed[depot_path])
+
+            if cache and depot_path in digests:
+                cache.set(depot_path, digests[depot_path],
+                          contents[depot_path])
+
+        return contents
+
+    def _get_digests(self, depot_paths):
+        """
+        Looks up the digests of the contents of several file revisions with
+        a single p4 fstat.
+
+        depot_paths - A list of "path#rev" depot paths.
+
+        Returns a dict mapping depot paths to their digests.  Revisions
+        which have no digest, such as deleted ones, are left out.
+        """
+        digests = {}
+
+        for record in self.p4.iter_records(['fstat', '-Ol'], depot_paths):
+            if 'digest' in record and 'headRev' in record:
+                digests['%s#%s' % (record['depotFile'],
+                                   record['headRev'])] = record['digest']
+
+        return digests
+
+    def _get_revision_cache(self):
+        """
+        Returns the local RevisionCache of Perforce file revisions, or None
+        if it can't be used.
+        """
+        if not hasattr(self, '_revision_cache'):
+            try:
+                self._revision_cache = RevisionCache(
+                    os.path.join(get_home_path(), '.post-review-p4-cache'))
+            except (IOError, OSError), e:
+                debug('Unable to use the Perforce revision cache: %s' % e)
+                self._revision_cache = None
+
+        return self._revision_cache
+
+    def _do_diff(self, old_data, new_data, depot_path, base_revision,
+                 changetype_short, ignore_unmodified=False, new_mtime=None):
+        """
+        Do the work of producing a diff for Perforce.  The diff is made in
+        memory with difflib, rather than by writing out the files and
+        running diff on them.
+
+        old_data - The contents of the "old" file.
+        new_data - The contents of the "new" file.
         depot_path - The depot path in Perforce for this file.
         base_revision - The base perforce revision number of the old file as
             an integer.
         changetype_short - The change type as a single character string.
         ignore_unmodified - If True, will return an empty list if the file
             is not changed.
+        new_mtime - The modification time of the "new" file, if it's in the
+            client.  Defaults to the current time.
 
         Returns a list of strings of diff lines.
         """
-        if hasattr(os, 'uname') and os.uname()[0] == 'SunOS':
-            diff_cmd = ["gdiff", "-urNp", old_file, new_file]
-        else:
-            diff_cmd = ["diff", "-urNp", old_file, new_file]
-        # Diff returns "1" if differences were found.
-        dl = execute(diff_cmd, extra_ignore_errors=(1,2),
-                     translate_newlines=False)
-
-        # If the input file has ^M characters at end of line, lets ignore them.
-        dl = dl.replace('\r\r\n', '\r\n')
-        dl = dl.splitlines(True)
-
         cwd = os.getcwd()
         if depot_path.startswith(cwd):
             local_path = depot_path[len(cwd) + 1:]
         else:
             local_path = depot_path
 
-        # Special handling for the output of the diff tool on binary files:
-        #     diff outputs "Files a and b differ"
-        # and the code below expects the output to start with
-        #     "Binary files "
-        if len(dl) == 1 and \
-           dl[0].startswith('Files %s and %s differ' %
-                            (old_file, new_file)):
-            dl = ['Binary files %s and %s differ\n' % (old_file, new_file)]
+        # A file is treated as binary if it has any NUL bytes, as diff does.
+        # Binary files aren't diffed, just reported as different.
+        if '\0' in old_data or '\0' in new_data:
+            if old_data == new_data:
+                dl = []
+            else:
+                dl = ['Binary files %s#%s and %s differ\n' %
+                      (depot_path, base_revision, local_path)]
+        else:
+            # Text files may have Windows line endings on one side only,
+            # depending on the client, so they're compared without them.
+            # Only \n ends a line, as it does for diff and patch.  A lone \r
+            # is part of the line it's in.
+            old_lines = re.findall(r'[^\n]*\n|[^\n]+$',
+                                   old_data.replace('\r\n', '\n'))
+            new_lines = re.findall(r'[^\n]*\n|[^\n]+$',
+                                   new_data.replace('\r\n', '\n'))
+            dl = list(difflib.unified_diff(old_lines, new_lines))[2:]
 
         if dl == [] or dl[0].startswith("Binary files "):
             if dl == []:
@@ -1889,72 +2398,59 @@ class PerforceClient(SCMClient):
             dl.insert(0, "==== %s#%s ==%s== %s ====\n" % \
                 (depot_path, base_revision, changetype_short, local_path))
             dl.append('\n')
-        elif len(dl) > 1:
-            m = re.search(r'(\d\d\d\d-\d\d-\d\d \d\d:\d\d:\d\d)', dl[1])
-            if m:
-                timestamp = m.group(1)
-            else:
-                # Thu Sep  3 11:24:48 2007
-                m = re.search(r'(\w+)\s+(\w+)\s+(\d+)\s+(\d\d:\d\d:\d\d)\s+(\d\d\d\d)', dl[1])
-                if not m:
-                    die("Unable to parse diff header: %s" % dl[1])
-
-                month_map = {
-                    "Jan": "01",
-                    "Feb": "02",
-                    "Mar": "03",
-                    "Apr": "04",
-                    "May": "05",
-                    "Jun": "06",
-                    "Jul": "07",
-                    "Aug": "08",
-                    "Sep": "09",
-                    "Oct": "10",
-                    "Nov": "11",
-                    "Dec": "12",
-                }
-                month = month_map[m.group(2)]
-                day = m.group(3)
-                timestamp = m.group(4)
-                year = m.group(5)
-
-                timestamp = "%s-%s-%s %s" % (year, month, day, timestamp)
-
-            dl[0] = "--- %s\t%s#%s\n" % (local_path, depot_path, base_revision)
-            dl[1] = "+++ %s\t%s\n" % (local_path, timestamp)
-
-            # Not everybody has files that end in a newline (ugh). This ensures
-            # that the resulting diff file isn't broken.
-            if dl[-1][-1] != '\n':
-                dl.append('\n')
         else:
-            die("ERROR, no valid diffs: %s" % dl[0])
+            if new_mtime is None:
+                new_mtime = time.time()
+
+            timestamp = time.strftime('%Y-%m-%d %H:%M:%S',
+                                      time.localtime(new_mtime))
+
+            header = [
+                "--- %s\t%s#%s\n" % (local_path, depot_path, base_revision),
+                "+++ %s\t%s\n" % (local_path, timestamp),
+            ]
+
+            # Not everybody has files that end in a newline (ugh). Mark the
+            # last line of such files the way diff does, so that the
+            # resulting diff file isn't broken.
+            for line in dl:
+                header.append(line)
+
+                if not line.endswith('\n'):
+                    header.append('\n\\ No newline at end of file\n')
+
+            dl = header
 
         return dl
 
-    def _write_file(self, depot_path, tmpfile):
+    def _get_local_paths(self, depot_paths):
         """
-        Grabs a file from Perforce and writes it to a temp file. p4 print sets
-        the file readonly and that causes a later call to unlink fail. So we
-        make the file read/write.
+        Given paths in the depot, returns a dict mapping each of them to the
+        path on the local filesystem to the same file, using a single p4
+        where.  If there are multiple results for a path, take only the last
+        result.
         """
-        debug('Writing "%s" to "%s"' % (depot_path, tmpfile))
-        execute(["p4", "print", "-o", tmpfile, "-q", depot_path])
-        os.chmod(tmpfile, stat.S_IREAD | stat.S_IWRITE)
+        local_paths = {}
 
-    def _depot_to_local(self, depot_path):
-        """
-        Given a path in the depot return the path on the local filesystem to
-        the same file.  If there are multiple results, take only the last
-        result from the where command.
-        """
-        where_output = self._run_p4(['where', depot_path])
+        if not depot_paths:
+            return local_paths
 
-        try:
-            return where_output[-1]['path']
-        except:
-            # XXX: This breaks on filenames with spaces.
-            return where_output[-1]['data'].split(' ')[2].strip()
+        for record in self.p4.iter_records(['where'], depot_paths):
+            if 'unmap' in record:
+                continue
+
+            if 'path' in record:
+                local_paths[record['depotFile']] = record['path']
+            elif 'data' in record:
+                # XXX: This breaks on filenames with spaces.
+                data = record['data'].split(' ')
+                local_paths[data[0]] = data[2].strip()
+
+        for depot_path in depot_paths:
+            if depot_path not in local_paths:
+                die("Couldn't find %s in the client." % depot_path)
+
+        return local_paths
 
 
 class MercurialClient(SCMClient):
@@ -2690,37 +3186,34 @@ def tempt_fate(server, tool, changenum, diff_content=None,
         else:
             review_request = server.new_review_request(changenum, submit_as)
 
+        fields = []
+
         if options.target_groups:
-            server.set_review_request_field(review_request, 'target_groups',
-                                            options.target_groups)
+            fields.append(('target_groups', options.target_groups))
 
         if options.target_people:
-            server.set_review_request_field(review_request, 'target_people',
-                                            options.target_people)
+            fields.append(('target_people', options.target_people))
 
         if options.summary:
-            server.set_review_request_field(review_request, 'summary',
-                                            options.summary)
+            fields.append(('summary', options.summary))
 
         if options.branch:
-            server.set_review_request_field(review_request, 'branch',
-                                            options.branch)
+            fields.append(('branch', options.branch))
 
         if options.bugs_closed:     # append to existing list
             options.bugs_closed = options.bugs_closed.strip(", ")
             bug_set = set(re.split("[, ]+", options.bugs_closed)) | \
                       set(review_request['bugs_closed'])
             options.bugs_closed = ",".join(bug_set)
-            server.set_review_request_field(review_request, 'bugs_closed',
-                                            options.bugs_closed)
+            fields.append(('bugs_closed', options.bugs_closed))
 
         if options.description:
-            server.set_review_request_field(review_request, 'description',
-                                            options.description)
+            fields.append(('description', options.description))
 
         if options.testing_done:
-            server.set_review_request_field(review_request, 'testing_done',
-                                            options.testing_done)
+            fields.append(('testing_done', options.testing_done))
+
+        server.set_review_request_fields(review_request, fields)
     except APIError, e:
         if e.error_code == 103: # Not logged in
             retries = retries - 1
@@ -2988,15 +3481,21 @@ def determine_client():
     return (repository_info, tool)
 
 
-def main():
-    origcwd = os.path.abspath(os.getcwd())
-
+def get_home_path():
+    """
+    Returns the directory where the user's configuration and caches are kept.
+    """
     if 'APPDATA' in os.environ:
-        homepath = os.environ['APPDATA']
+        return os.environ['APPDATA']
     elif 'HOME' in os.environ:
-        homepath = os.environ["HOME"]
+        return os.environ["HOME"]
     else:
-        homepath = ''
+        return ''
+
+
+def main():
+    origcwd = os.path.abspath(os.getcwd())
+    homepath = get_home_path()
 
     # Load the config and cookie files
     globals()['user_config'] = \
@@ -3036,27 +3535,34 @@ def main():
     elif options.diff_filename:
         parent_diff = None
 
+        # The diff is streamed from the file when it's uploaded, rather than
+        # being read into memory.
         if options.diff_filename == '-':
-            diff = sys.stdin.read()
+            diff = tempfile.TemporaryFile()
+            shutil.copyfileobj(sys.stdin, diff)
+            diff.seek(0)
         else:
             try:
-                fp = open(os.path.join(origcwd, options.diff_filename), 'r')
-                diff = fp.read()
-                fp.close()
+                diff = open(os.path.join(origcwd, options.diff_filename), 'rb')
             except IOError, e:
                 die("Unable to open diff filename: %s" % e)
     else:
         diff, parent_diff = tool.diff(args)
 
-    if len(diff) == 0:
+    if get_content_size(diff) == 0:
         die("There don't seem to be any diffs!")
 
     if isinstance(tool, PerforceClient) and changenum is not None:
         changenum = tool.sanitize_changenum(changenum)
 
     if options.output_diff_only:
-        # The comma here isn't a typo, but rather suppresses the extra newline
-        print diff,
+        if isinstance(diff, basestring):
+            # The comma here isn't a typo, but rather suppresses the extra
+            # newline
+            print diff,
+        else:
+            shutil.copyfileobj(diff, sys.stdout)
+
         sys.exit(0)
 
     # Let's begin.
@@ -1,11 +1,19 @@
+import errno
+import httplib
+import marshal
 import os
 import re
 import shutil
+import socket
 import sys
 import tempfile
+import threading
 import time
 import unittest
 import urllib2
+import zlib
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
 from random import randint
 from textwrap import dedent
 
@@ -21,9 +29,21 @@ except ImportError:
 
 import nose
 
+from rbtools.api.asyncinterface import AsyncServerInterface
+from rbtools.api.cache import MetadataCache, RequestMemo, ValidatorCache
+from rbtools.api.concurrency import AdaptiveLimiter, ThreadPool
+from rbtools.api.errors import InvalidKeyError, RequestTimeoutError
+from rbtools.api.multipart import MultipartBody
+from rbtools.api.policy import RequestPolicy
+from rbtools.api.resource import RepositoryList, Resource, ResourceList, \
+                                 RootResource
+from rbtools.api.serverinterface import ServerInterface
+from rbtools.api.transport import _is_stale_connection_error
+from rbtools.commands import rbpublish
 from rbtools.postreview import execute, load_config_file
 from rbtools.postreview import APIError, GitClient, MercurialClient, \
-                               RepositoryInfo, ReviewBoardServer
+                               P4Session, PerforceClient, RepositoryInfo, \
+                               ReviewBoardServer, RevisionCache
 import rbtools.postreview
 
 
@@ -82,12 +102,105 @@ class MockHttpUnitTest(unittest.TestCase):
             return self.http_response
 
 
+class TestApiRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        self.server.requests.append((self.command, self.path,
+                                     self.client_address,
+                                     dict(self.headers.items())))
+        response = self.server.responses.get(self.path, (404, {}, ''))
+
+        if isinstance(response, list):
+            # A sequence of responses, the last of which is repeated.
+            if len(response) > 1:
+                response = response.pop(0)
+            else:
+                response = response[0]
+
+        status, headers, body = response
+
+        if ('ETag' in headers and
+            self.headers.get('If-None-Match') == headers['ETag']):
+            status, body = 304, ''
+
+        self.send_response(status)
+
+        for name, value in headers.items():
+            self.send_header(name, value)
+
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    do_DELETE = do_GET
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        self.server.bodies.append(self.rfile.read(length))
+        self.do_GET()
+
+    do_PUT = do_POST
+
+    def log_message(self, *args):
+        pass
+
+
+class TestApiServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class LocalServerUnitTest(unittest.TestCase):
+    """Runs a local HTTP/1.1 server for testing rbtools.api.
+
+    Responses are registered in self.responses, keyed by path, as
+    (status, headers, body) tuples, or lists of them to be returned in
+    turn.  Every request made is recorded in
+    self.requests as a (method, path, client_address, headers) tuple.
+    """
+    def setUp(self):
+        self.httpd = TestApiServer(('127.0.0.1', 0), TestApiRequestHandler)
+        self.httpd.responses = self.responses = {}
+        self.httpd.requests = self.requests = []
+        self.httpd.bodies = self.bodies = []
+        self.server_url = 'http://127.0.0.1:%s/' % self.httpd.server_port
+
+        self.thread = threading.Thread(target=self.httpd.serve_forever)
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+        self.tmpdir = _get_tmpdir()
+        self.server = self.make_server_interface()
+
+    def tearDown(self):
+        self.server.close()
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        shutil.rmtree(self.tmpdir)
+
+    def make_server_interface(self, cookie_file='cookies', **kwargs):
+        """Returns a ServerInterface for the test server, keeping its
+        cookies and metadata cache in the temporary directory."""
+        kwargs.setdefault('metadata_cache_file',
+                          os.path.join(self.tmpdir, 'metadata'))
+        return ServerInterface(self.server_url,
+                               os.path.join(self.tmpdir, cookie_file),
+                               **kwargs)
+
+    def add_json_response(self, path, rsp, status=200, headers=None):
+        headers = dict(headers or {})
+        headers['Content-Type'] = 'application/json'
+        self.responses[path] = (status, headers, json.dumps(rsp))
+
+
 class OptionsStub(object):
     def __init__(self):
         self.debug = True
         self.guess_summary = False
         self.guess_description = False
         self.tracking = None
+        self.p4_client = None
+        self.p4_port = None
 
 
 class GitClientTests(unittest.TestCase):
@@ -764,6 +877,336 @@ class MercurialSubversionClientTests(MercurialTestBase):
         self.assertEqual(EXPECTED_HG_SVN_DIFF_1, self.client.diff(None)[0])
 
 
+class FakeP4Session(object):
+    """Answers p4 commands with canned marshalled records.
+
+    responses maps each p4 command name to a list of records, or to a
+    function which is passed the command and its arguments and returns
+    them.  Every command run is recorded in calls as a (command, args)
+    tuple.
+    """
+    def __init__(self, responses):
+        self.responses = responses
+        self.calls = []
+
+    def run(self, command, args=None, ignore_errors=False,
+            expected_errors=None):
+        return list(self.iter_records(command, args, ignore_errors,
+                                      expected_errors))
+
+    def iter_records(self, command, args=None, ignore_errors=False,
+                     expected_errors=None):
+        self.calls.append((command, args))
+        response = self.responses[command[0]]
+
+        if callable(response):
+            response = response(command, args)
+
+        return iter(response)
+
+
+class FakeP4Process(object):
+    """Stands in for a p4 -G process writing out the given records."""
+    def __init__(self, records, returncode):
+        self.stdout = tempfile.TemporaryFile()
+
+        for record in records:
+            marshal.dump(record, self.stdout)
+
+        self.stdout.seek(0)
+        self.returncode = returncode
+
+    def wait(self):
+        return self.returncode
+
+
+class PerforceClientTests(unittest.TestCase):
+    FILES = {
+        '//depot/foo#2': 'a\nb\n',
+        '//depot/foo#3': 'a\nc\n',
+        '//depot/bar#1': 'new\n',
+        '//depot/baz#2': 'readded\n',
+        '//depot/baz#5': 'head\n',
+    }
+
+    def setUp(self):
+        self.client = PerforceClient()
+        self.client.p4d_version = (2010, 1)
+        self.client._revision_cache = None
+        self.saved_check_install = rbtools.postreview.check_install
+        self.saved_popen = rbtools.postreview.subprocess.Popen
+        rbtools.postreview.options = OptionsStub()
+
+    def tearDown(self):
+        rbtools.postreview.check_install = self.saved_check_install
+        rbtools.postreview.subprocess.Popen = self.saved_popen
+
+    def _print(self, command, args):
+        # p4 print sends each file's contents in pieces after its stat
+        # record.
+        records = []
+
+        for depot_path in args:
+            path, rev = depot_path.split('#')
+            data = self.FILES[depot_path]
+            records.append({'code': 'stat', 'depotFile': path, 'rev': rev})
+            records.append({'code': 'text', 'data': data[:2]})
+            records.append({'code': 'text', 'data': data[2:]})
+
+        return records
+
+    def test_get_repository_info(self):
+        """Testing PerforceClient.get_repository_info reads p4 info"""
+        rbtools.postreview.check_install = lambda command: True
+        self.client.p4 = FakeP4Session({
+            'info': [{
+                'code': 'stat',
+                'serverAddress': '127.0.0.1:1666',
+                'serverVersion': 'P4D/LINUX26X86_64/2009.2/238357 '
+                                 '(2010/03/15)',
+            }],
+        })
+
+        info = self.client.get_repository_info()
+
+        self.assertTrue(info.supports_changesets)
+        self.assertEqual(self.client.p4d_version, (2009, 2))
+
+    def test_scan_for_server_counter(self):
+        """Testing PerforceClient.scan_for_server_counter with a url in the
+        counter name"""
+        self.client.p4 = FakeP4Session({
+            'counters': [
+                {'code': 'stat', 'counter': 'change', 'value': '42'},
+                {'code': 'stat',
+                 'counter': 'reviewboard.url.http:||rb.example.com',
+                 'value': '1'},
+            ],
+        })
+
+        self.assertEqual(self.client.scan_for_server_counter(None),
+                         'http://rb.example.com')
+
+    def test_changenum_diff_submitted(self):
+        """Testing PerforceClient diffs a submitted changelist from its
+        numbered describe fields"""
+        self.client.p4 = FakeP4Session({
+            'describe': [{
+                'code': 'stat',
+                'change': '5',
+                'status': 'submitted',
+                'depotFile0': '//depot/foo',
+                'rev0': '3',
+                'action0': 'edit',
+                'depotFile1': '//depot/bar',
+                'rev1': '1',
+                'action1': 'add',
+            }],
+            'print': self._print,
+        })
+
+        diff, parent_diff = self.client.diff(['5'])
+
+        self.assertTrue('--- //depot/foo\t//depot/foo#2\n' in diff)
+        self.assertTrue('-b\n+c\n' in diff)
+        self.assertTrue('--- //depot/bar\t//depot/bar#0\n' in diff)
+        self.assertTrue('+new\n' in diff)
+        self.assertEqual(self.client.p4.calls[1],
+                         (['print'], ['//depot/foo#2', '//depot/foo#3',
+                                      '//depot/bar#1']))
+
+    def test_changenum_diff_batches(self):
+        """Testing PerforceClient fetches revisions in batches, and adds in
+        submitted changes at the changelist's revision"""
+        self.client.p4 = FakeP4Session({
+            'describe': [{
+                'code': 'stat',
+                'change': '7',
+                'status': 'submitted',
+                'depotFile0': '//depot/foo',
+                'rev0': '3',
+                'action0': 'edit',
+                'depotFile1': '//depot/bar',
+                'rev1': '1',
+                'action1': 'add',
+                'depotFile2': '//depot/baz',
+                'rev2': '2',
+                'action2': 'add',
+            }],
+            'print': self._print,
+        })
+        saved_batch_size = rbtools.postreview.P4_PRINT_BATCH_SIZE
+        rbtools.postreview.P4_PRINT_BATCH_SIZE = 2
+
+        try:
+            diff, parent_diff = self.client.diff(['7'])
+        finally:
+            rbtools.postreview.P4_PRINT_BATCH_SIZE = saved_batch_size
+
+        self.assertEqual([args for command, args in self.client.p4.calls
+                          if command == ['print']],
+                         [['//depot/foo#2', '//depot/foo#3', '//depot/bar#1'],
+                          ['//depot/baz#2']])
+        self.assertTrue('-b\n+c\n' in diff)
+        self.assertTrue('+new\n' in diff)
+        self.assertTrue('--- //depot/baz\t//depot/baz#1\n' in diff)
+        self.assertTrue('+readded\n' in diff)
+        self.assertFalse('head' in diff)
+
+    def test_path_diff_skips_matching_digests(self):
+        """Testing PerforceClient path diffs skip revisions whose digests
+        match without fetching them"""
+        revisions = {
+            '//depot/...#2': [('//depot/foo', '2'), ('//depot/baz', '4')],
+            '//depot/...#3': [('//depot/foo', '3'), ('//depot/baz', '5')],
+        }
+        self.client.p4 = FakeP4Session({
+            'files': lambda command, args: [
+                {'code': 'stat', 'depotFile': path, 'rev': rev,
+                 'action': 'edit'}
+                for path, rev in revisions[command[1]]
+            ],
+            'print': self._print,
+        })
+        self.client._get_digests = lambda depot_paths: {
+            '//depot/foo#2': 'A1',
+            '//depot/foo#3': 'B2',
+            '//depot/baz#4': 'C3',
+            '//depot/baz#5': 'C3',
+        }
+
+        diff, parent_diff = self.client.diff(['//depot/...#2,#3'])
+
+        self.assertEqual([args for command, args in self.client.p4.calls
+                          if command == ['print']],
+                         [['//depot/foo#2', '//depot/foo#3']])
+        self.assertTrue('--- //depot/foo\t//depot/foo#2\n' in diff)
+        self.assertTrue('-b\n+c\n' in diff)
+        self.assertFalse('//depot/baz' in diff)
+
+    def test_changenum_diff_pending(self):
+        """Testing PerforceClient diffs a pending changelist against the
+        client, with one p4 where for all the files"""
+        tmpdir = _get_tmpdir()
+        local_paths = {}
+
+        for name, data in [('foo', 'a\nc\n'), ('bar', 'new\n')]:
+            local_paths['//depot/' + name] = os.path.join(tmpdir, name)
+            f = open(local_paths['//depot/' + name], 'w')
+            f.write(data)
+            f.close()
+
+        self.client.p4 = FakeP4Session({
+            'describe': [{
+                'code': 'stat',
+                'change': '6',
+                'status': 'pending',
+                'depotFile0': '//depot/foo',
+                'rev0': '2',
+                'action0': 'edit',
+                'depotFile1': '//depot/bar',
+                'rev1': '1',
+                'action1': 'add',
+            }],
+            'where': lambda command, args: [
+                {'code': 'stat', 'depotFile': depot_path,
+                 'path': local_paths[depot_path]}
+                for depot_path in args
+            ],
+            'print': self._print,
+        })
+
+        try:
+            diff, parent_diff = self.client.diff(['6'])
+        finally:
+            shutil.rmtree(tmpdir)
+
+        self.assertTrue('--- //depot/foo\t//depot/foo#2\n' in diff)
+        self.assertTrue('-b\n+c\n' in diff)
+        self.assertTrue('+new\n' in diff)
+        self.assertEqual([args for command, args in self.client.p4.calls
+                          if command == ['where']],
+                         [['//depot/foo', '//depot/bar']])
+
+    def test_describe_change_errors(self):
+        """Testing PerforceClient._describe_change only ignores unknown
+        changelists"""
+        self.client.p4 = P4Session()
+        rbtools.postreview.subprocess.Popen = \
+            lambda command, stdout: FakeP4Process([{
+                'code': 'error',
+                'data': 'Change 99 unknown.\n',
+                'severity': 3,
+            }], 1)
+
+        self.assertEqual(self.client._describe_change('99'), {})
+
+        rbtools.postreview.subprocess.Popen = \
+            lambda command, stdout: FakeP4Process([{
+                'code': 'error',
+                'data': 'Perforce password (P4PASSWD) invalid or unset.\n',
+                'severity': 3,
+            }], 1)
+
+        self.assertRaises(SystemExit, self.client._describe_change, '99')
+
+    def test_do_diff(self):
+        """Testing PerforceClient._do_diff"""
+        dl = self.client._do_diff('a\r\nb\r\n', 'a\nc', '//depot/foo', 2,
+                                  'M', new_mtime=0)
+
+        self.assertEqual(dl[0], '--- //depot/foo\t//depot/foo#2\n')
+        self.assertTrue(dl[1].startswith('+++ //depot/foo\t19'))
+        self.assertEqual(''.join(dl[2:]),
+                         '@@ -1,2 +1,2 @@\n'
+                         ' a\n'
+                         '-b\n'
+                         '+c\n'
+                         '\\ No newline at end of file\n')
+
+    def test_do_diff_embedded_cr(self):
+        """Testing PerforceClient._do_diff with a carriage return in a line"""
+        dl = self.client._do_diff('a\rb\nc\n', 'a\rb\nd\n', '//depot/foo', 2,
+                                  'M')
+
+        self.assertEqual(''.join(dl[2:]),
+                         '@@ -1,2 +1,2 @@\n'
+                         ' a\rb\n'
+                         '-c\n'
+                         '+d\n')
+
+    def test_do_diff_binary(self):
+        """Testing PerforceClient._do_diff with binary files"""
+        self.assertEqual(
+            self.client._do_diff('\0a', '\0b', '//depot/foo', 2, 'M'),
+            ['==== //depot/foo#2 ==M== //depot/foo ====\n',
+             'Binary files //depot/foo#2 and //depot/foo differ\n',
+             '\n'])
+
+
+class RevisionCacheTests(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = _get_tmpdir()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_get_and_prune(self):
+        """Testing RevisionCache keeps the most recently used revisions"""
+        cache = RevisionCache(os.path.join(self.tmpdir, 'cache'), 10)
+        cache.set('//depot/foo#1', 'abc', 'x' * 6)
+        cache.set('//depot/foo#2', 'def', 'y' * 6)
+
+        self.assertEqual(cache.get('//depot/foo#1', 'abc'), 'x' * 6)
+        self.assertEqual(cache.get('//depot/foo#1', 'def'), None)
+
+        os.utime(cache._get_filename('//depot/foo#2', 'def'), (0, 0))
+        cache.prune()
+
+        self.assertEqual(cache.get('//depot/foo#1', 'abc'), 'x' * 6)
+        self.assertEqual(cache.get('//depot/foo#2', 'def'), None)
+
+
 class ApiTests(MockHttpUnitTest):
     SAMPLE_ERROR_STR = json.dumps({
         'stat': 'fail',
@@ -835,10 +1278,949 @@ class ApiTests(MockHttpUnitTest):
             self.assertEqual(str(e),
                              'This is a test failure (HTTP 400, API Error 100)')
 
+    def test_set_review_request_fields_single_request(self):
+        """Testing ReviewBoardServer.set_review_request_fields sends one
+        draft update"""
+        posts = []
+        ReviewBoardServer.http_post = \
+            lambda server, path, fields, files=None: \
+                posts.append(fields) or '{"stat": "ok"}'
+
+        self.server.set_review_request_fields({'id': 1}, [
+            ('summary', 'Summary'),
+            ('branch', 'trunk'),
+        ])
+
+        self.assertEqual(posts, [{'summary': 'Summary', 'branch': 'trunk'}])
+
+    def test_set_review_request_fields_fallback(self):
+        """Testing ReviewBoardServer.set_review_request_fields falls back to
+        one request per field"""
+        posts = []
+
+        def http_post(server, path, fields, files=None):
+            posts.append(fields)
+
+            if len(fields) > 1:
+                return self.SAMPLE_ERROR_STR
+
+            return '{"stat": "ok"}'
+
+        ReviewBoardServer.http_post = http_post
+
+        self.server.set_review_request_fields({'id': 1}, [
+            ('summary', 'Summary'),
+            ('branch', 'trunk'),
+        ])
+
+        self.assertEqual(posts, [
+            {'summary': 'Summary', 'branch': 'trunk'},
+            {'summary': 'Summary'},
+            {'branch': 'trunk'},
+        ])
+
+    def test_repository_index_cached(self):
+        """Testing ReviewBoardServer.get_repository_index caches the
+        repositories in the metadata cache"""
+        tmpdir = _get_tmpdir()
+        cookie_file = os.path.join(tmpdir, 'cookies')
+        saved_home = os.environ.get('HOME')
+        os.environ['HOME'] = tmpdir
+        gets = []
+
+        def http_get(server, path):
+            gets.append(path)
+            return json.dumps({
+                'stat': 'ok',
+                'repositories': [
+                    {'id': 1, 'path': '/repo', 'tool': 'Git'},
+                ],
+            })
+
+        ReviewBoardServer.http_get = http_get
+
+        try:
+            for i in range(2):
+                server = ReviewBoardServer('http://localhost:8080/',
+                                           RepositoryInfo(), cookie_file)
+                index = server.get_repository_index()
+                self.assertEqual(index.get_by_path('/repo')['id'], 1)
+
+            self.assertEqual(gets, ['/api/json/repositories/'])
+            self.assertEqual(server.metadata_cache.path,
+                             os.path.join(tmpdir, '.rbtools-cache',
+                                          'metadata'))
+            self.assertTrue(os.path.isfile(server.metadata_cache.path))
+        finally:
+            if saved_home is None:
+                del os.environ['HOME']
+            else:
+                os.environ['HOME'] = saved_home
+
+            shutil.rmtree(tmpdir)
+
+    def test_repository_index_with_uuids(self):
+        """Testing ReviewBoardServer.get_repository_index fetches Subversion
+        repository info through the limiter"""
+        tmpdir = _get_tmpdir()
+        limited = []
+
+        def http_get(server, path):
+            if path.endswith('/info/'):
+                return json.dumps({
+                    'stat': 'ok',
+                    'info': {'uuid': 'uuid-%s' % path.split('/')[-3]},
+                })
+
+            return json.dumps({
+                'stat': 'ok',
+                'repositories': [
+                    {'id': 1, 'path': '/svn1', 'tool': 'Subversion'},
+                    {'id': 2, 'path': '/git', 'tool': 'Git'},
+                    {'id': 3, 'path': '/svn3', 'tool': 'Subversion'},
+                ],
+            })
+
+        class RecordingLimiter(object):
+            def call(self, func, *args, **kwargs):
+                limited.append(args)
+                return func(*args, **kwargs)
+
+        ReviewBoardServer.http_get = http_get
+        self.server.metadata_cache = \
+            MetadataCache(os.path.join(tmpdir, 'metadata'))
+        self.server.limiter = RecordingLimiter()
+
+        try:
+            index = self.server.get_repository_index(with_uuids=True)
+        finally:
+            shutil.rmtree(tmpdir)
+
+        self.assertEqual(index.get_by_uuid('uuid-3')[0]['path'], '/svn3')
+        self.assertEqual(index.get_by_uuid('uuid-1')[0]['path'], '/svn1')
+        self.assertEqual(len(limited), 2)
+
     def _make_http_error(self, url, code, body):
         return urllib2.HTTPError(url, code, body, {}, StringIO(body))
 
 
+class ServerInterfaceTests(LocalServerUnitTest):
+    def test_keep_alive_reuses_connection(self):
+        """Testing ServerInterface reuses a single persistent connection"""
+        self.add_json_response('/api/', {'stat': 'ok'})
+
+        for i in range(3):
+            self.assertEqual(json.loads(self.server.get(self.server_url +
+                                                        'api/')),
+                             {'stat': 'ok'})
+
+        self.assertEqual(len(self.requests), 3)
+        self.assertEqual(len(set([r[2] for r in self.requests])), 1)
+
+    def test_keep_alive_resends_only_unanswered(self):
+        """Testing pooled connections are only resent to after a close"""
+        self.assertTrue(_is_stale_connection_error(
+            httplib.BadStatusLine("''")))
+        self.assertTrue(_is_stale_connection_error(
+            socket.error(errno.ECONNRESET, 'Connection reset by peer')))
+        self.assertFalse(_is_stale_connection_error(
+            socket.timeout('timed out')))
+        self.assertFalse(_is_stale_connection_error(
+            httplib.IncompleteRead('')))
+
+    def test_compressed_transfers(self):
+        """Testing ServerInterface decompresses responses and compresses
+        uploads once the server accepts them"""
+        compressor = zlib.compressobj(9, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        body = compressor.compress('{"stat": "ok"}') + compressor.flush()
+        self.responses['/api/'] = (200, {
+            'Content-Type': 'application/json',
+            'Content-Encoding': 'gzip',
+            'Accept-Encoding': 'gzip',
+        }, body)
+
+        self.assertEqual(self.server.get(self.server_url + 'api/'),
+                         '{"stat": "ok"}')
+        self.assertTrue('gzip' in self.requests[0][3]['accept-encoding'])
+
+        diff = 'x' * 100000
+        self.server.post(self.server_url + 'api/', {}, {
+            'path': {'filename': 'diff', 'content': diff},
+        })
+
+        self.assertEqual(self.requests[1][3]['content-encoding'], 'gzip')
+        self.assertTrue(len(self.bodies[0]) < len(diff))
+        self.assertTrue(diff in zlib.decompress(self.bodies[0],
+                                                16 + zlib.MAX_WBITS))
+
+    def test_post_review_request_policy(self):
+        """Testing ReviewBoardServer retries failed GETs but not POSTs
+        through the request policy"""
+        rbtools.postreview.options = OptionsStub()
+        server = ReviewBoardServer(self.server_url, RepositoryInfo(), None)
+        server.request_policy = RequestPolicy(backoff=0)
+        self.responses['/api/'] = [
+            (503, {}, ''),
+            (200, {}, '{"stat": "ok"}'),
+        ]
+
+        self.assertEqual(server.http_get('api/'), '{"stat": "ok"}')
+        self.assertEqual(len(self.requests), 2)
+
+        self.responses['/api/'] = [
+            (500, {}, ''),
+            (200, {}, '{"stat": "ok"}'),
+        ]
+
+        try:
+            server.http_post('api/', {'a': 'b'})
+            self.fail('The POST was retried')
+        except urllib2.HTTPError, e:
+            self.assertEqual(e.code, 500)
+
+        self.assertEqual(len(self.requests), 3)
+
+    def test_post_review_compressed_transfers(self):
+        """Testing ReviewBoardServer uses the shared compression support"""
+        rbtools.postreview.options = OptionsStub()
+        compressor = zlib.compressobj(9, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        body = compressor.compress('{"stat": "ok"}') + compressor.flush()
+        self.responses['/api/'] = (200, {
+            'Content-Type': 'application/json',
+            'Content-Encoding': 'gzip',
+            'Accept-Encoding': 'gzip',
+        }, body)
+
+        server = ReviewBoardServer(self.server_url, RepositoryInfo(), None)
+        self.assertEqual(server.http_get('api/'), '{"stat": "ok"}')
+
+        diff = 'x' * 100000
+        server.http_post('api/', {}, {
+            'path': {'filename': 'diff', 'content': diff},
+        })
+
+        self.assertEqual(self.requests[1][3]['content-encoding'], 'gzip')
+        self.assertTrue(diff in zlib.decompress(self.bodies[0],
+                                                16 + zlib.MAX_WBITS))
+
+    def test_cookies_written_only_when_changed(self):
+        """Testing ServerInterface only writes the cookie file when a
+        cookie changes"""
+        cookie_file = os.path.join(self.tmpdir, 'cookies')
+        self.responses['/api/'] = (200, {
+            'Set-Cookie': 'rbsessionid=abc123; Max-Age=3600; Path=/',
+        }, '')
+
+        self.assertFalse(self.server.has_valid_cookie())
+        self.server.get(self.server_url + 'api/')
+        self.assertTrue(self.server.has_valid_cookie())
+        self.assertFalse(os.path.exists(cookie_file))
+
+        self.assertTrue(self.server.cookie_jar.flush())
+        self.assertTrue('abc123' in open(cookie_file).read())
+
+        # The server repeating the same cookie doesn't dirty the jar.
+        self.server.get(self.server_url + 'api/')
+        self.assertFalse(self.server.cookie_jar.flush())
+
+        # A jar loaded from the cookie file has nothing new to write.
+        server = self.make_server_interface()
+        self.assertTrue(server.has_valid_cookie())
+        self.assertFalse(server.cookie_jar.dirty)
+        self.assertEqual(server.cookie_jar._timer, None)
+        self.assertFalse(server.cookie_jar.flush())
+        server.close()
+
+    def test_unreadable_cookie_file(self):
+        """Testing ServerInterface starts with no cookies if the cookie file
+        can't be read"""
+        cookie_file = os.path.join(self.tmpdir, 'bad-cookies')
+        f = open(cookie_file, 'w')
+        f.write('not a cookie file\n')
+        f.close()
+
+        server = self.make_server_interface('bad-cookies')
+        self.assertFalse(server.has_valid_cookie())
+        server.close()
+
+    def test_retries_idempotent_requests(self):
+        """Testing ServerInterface retries failed GETs but not POSTs"""
+        self.server.request_policy = RequestPolicy(backoff=0)
+        self.responses['/api/'] = [
+            (503, {}, ''),
+            (200, {}, '{"stat": "ok"}'),
+        ]
+
+        self.assertEqual(self.server.get(self.server_url + 'api/'),
+                         '{"stat": "ok"}')
+        self.assertEqual(len(self.requests), 2)
+
+        self.responses['/api/'] = [
+            (500, {}, ''),
+            (200, {}, '{"stat": "ok"}'),
+        ]
+
+        try:
+            self.server.post(self.server_url + 'api/', {'a': 'b'})
+            self.fail('The POST was retried')
+        except urllib2.HTTPError, e:
+            self.assertEqual(e.code, 500)
+
+        self.assertEqual(len(self.requests), 3)
+
+    def test_separate_cookie_jars(self):
+        """Testing ServerInterfaces in one process keep their own cookies"""
+        self.responses['/api/'] = (200, {
+            'Set-Cookie': 'rbsessionid=abc123; Max-Age=3600; Path=/',
+        }, '')
+        other = self.make_server_interface('other-cookies')
+
+        self.server.get(self.server_url + 'api/')
+        other.close()
+
+        self.assertTrue(self.server.has_valid_cookie())
+        self.assertFalse(other.has_valid_cookie())
+        self.assertFalse('cookie' in self.requests[0][3])
+
+
+class RequestMemoTests(unittest.TestCase):
+    def test_ttl_and_size(self):
+        """Testing RequestMemo forgets old resources and limits its size"""
+        fetches = []
+
+        def fetch(url):
+            fetches.append(url)
+            return url
+
+        memo = RequestMemo(ttl=60, max_size=2)
+        memo.get('a', fetch, 'a')
+        memo.get('a', fetch, 'a')
+        self.assertEqual(fetches, ['a'])
+
+        memo._entries['a'] = (memo._entries['a'][0], time.time() - 61)
+        memo.get('a', fetch, 'a')
+        self.assertEqual(fetches, ['a', 'a'])
+
+        memo.get('b', fetch, 'b')
+        memo.get('c', fetch, 'c')
+        self.assertEqual(sorted(memo._entries.keys()), ['b', 'c'])
+
+
+class ValidatorCacheTests(unittest.TestCase):
+    def test_size(self):
+        """Testing ValidatorCache forgets the least recently used response"""
+        cache = ValidatorCache(max_size=2)
+        cache.set('a', '{}', {}, etag='"a"')
+        cache.set('b', '{}', {}, etag='"b"')
+        self.assertEqual(cache.get('a').etag, '"a"')
+
+        cache.set('c', '{}', {}, last_modified='Sun, 18 Oct 2026 00:00:00')
+        self.assertEqual(cache.get('b'), None)
+        self.assertEqual(cache.get('a').etag, '"a"')
+        self.assertEqual(cache.get('c').last_modified,
+                         'Sun, 18 Oct 2026 00:00:00')
+
+
+class MetadataCacheTests(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = _get_tmpdir()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_keyed_by_username(self):
+        """Testing MetadataCache keeps each user's resources apart"""
+        path = os.path.join(self.tmpdir, 'cache', 'metadata')
+        url = 'http://rb.example.com/api/repositories/'
+        alice = MetadataCache(path, username='alice')
+        alice.set(url, '{"stat": "ok"}')
+
+        self.assertEqual(alice.get(url)[1], {'stat': 'ok'})
+        self.assertEqual(MetadataCache(path, username='bob').get(url), None)
+        self.assertEqual(MetadataCache(path, username='alice').get(url)[1],
+                         {'stat': 'ok'})
+
+        bob = MetadataCache(path, username='bob')
+        bob.set(url, '{"stat": "ok"}')
+        bob.invalidate(url)
+        self.assertEqual(MetadataCache(path, username='alice').get(url),
+                         None)
+
+
+class AdaptiveLimiterTests(unittest.TestCase):
+    def test_limit_adapts(self):
+        """Testing AdaptiveLimiter growing and cutting its limit"""
+        limiter = AdaptiveLimiter(max_concurrency=4, initial_concurrency=2)
+
+        for i in range(10):
+            limiter.release(limiter.acquire())
+
+        self.assertEqual(limiter.limit, 4)
+
+        error = urllib2.HTTPError('http://localhost/', 503, 'Unavailable',
+                                  None, None)
+
+        def overloaded():
+            raise error
+
+        self.assertRaises(urllib2.HTTPError, limiter.call, overloaded)
+        self.assertEqual(limiter.limit, 2)
+
+
+class MultipartBodyTests(unittest.TestCase):
+    EXPECTED_BODY = (
+        '--BOUNDARY\r\n'
+        'Content-Disposition: form-data; name="basedir"\r\n'
+        '\r\n'
+        '/trunk\r\n'
+        '--BOUNDARY\r\n'
+        'Content-Disposition: form-data; name="path"; filename="diff"\r\n'
+        '\r\n'
+        'diff content\r\n'
+        '--BOUNDARY--\r\n'
+        '\r\n')
+
+    def _make_body(self, content):
+        return MultipartBody({'basedir': '/trunk'},
+                             {'path': {'filename': 'diff',
+                                       'content': content}},
+                             boundary='BOUNDARY')
+
+    def test_string_content(self):
+        """Testing MultipartBody with string content"""
+        body = self._make_body('diff content')
+
+        self.assertEqual(len(body), len(self.EXPECTED_BODY))
+        self.assertEqual(body.read(), self.EXPECTED_BODY)
+
+    def test_file_content_chunked(self):
+        """Testing MultipartBody streams file content in chunks"""
+        fp = tempfile.TemporaryFile()
+        fp.write('diff content')
+        fp.seek(0)
+        body = self._make_body(fp)
+        chunks = []
+
+        while True:
+            chunk = body.read(7)
+
+            if not chunk:
+                break
+
+            self.assertTrue(len(chunk) <= 7)
+            chunks.append(chunk)
+
+        self.assertEqual(len(body), len(self.EXPECTED_BODY))
+        self.assertEqual(''.join(chunks), self.EXPECTED_BODY)
+
+        body.seek(0)
+        self.assertEqual(body.read(), self.EXPECTED_BODY)
+
+    def test_generator_content(self):
+        """Testing MultipartBody with generator content"""
+        body = self._make_body(chunk for chunk in ['diff ', 'content'])
+
+        self.assertEqual(len(body), len(self.EXPECTED_BODY))
+        self.assertEqual(body.read(), self.EXPECTED_BODY)
+
+
+class ResourceTests(LocalServerUnitTest):
+    SAMPLE_REVIEW_REQUEST = {
+        'stat': 'ok',
+        'review_request': {
+            'id': 1,
+            'summary': 'Test review request',
+            'links': {
+                'self': {
+                    'href': '/api/review-requests/1/',
+                    'method': 'GET',
+                },
+            },
+        },
+    }
+
+    def setUp(self):
+        super(ResourceTests, self).setUp()
+
+        self.add_json_response('/api/', {
+            'stat': 'ok',
+            'links': {
+                'review_requests': {
+                    'href': self.server_url + 'api/review-requests/',
+                    'method': 'GET',
+                },
+            },
+            'uri_templates': {
+                'review_request': self.server_url +
+                                  'api/review-requests/{review_request_id}/',
+            },
+        })
+        self.add_json_response('/api/review-requests/', {
+            'stat': 'ok',
+            'total_results': 1,
+            'review_requests': [
+                self.SAMPLE_REVIEW_REQUEST['review_request'],
+            ],
+            'links': {},
+        })
+
+    def test_get_link_single_request(self):
+        """Testing ResourceListBase.get retrieves a link only once"""
+        root = RootResource(self.server, self.server_url + 'api/')
+        review_requests = root.get('review_requests')
+
+        self.assertTrue(isinstance(review_requests, ResourceList))
+        self.assertEqual(review_requests.resource_name, 'review_requests')
+        self.assertEqual([r[1] for r in self.requests],
+                         ['/api/', '/api/review-requests/'])
+
+    def test_get_from_template(self):
+        """Testing RootResource.get_from_template loads a resource directly"""
+        self.add_json_response('/api/review-requests/1/',
+                               self.SAMPLE_REVIEW_REQUEST)
+
+        root = RootResource(self.server, self.server_url + 'api/')
+        rsc = root.get_from_template('review_request', review_request_id=1)
+
+        self.assertEqual(rsc.get_field('summary'), 'Test review request')
+        self.assertEqual([r[1] for r in self.requests],
+                         ['/api/', '/api/review-requests/1/'])
+
+    def test_get_from_template_without_templates(self):
+        """Testing RootResource.get_from_template on servers without URI
+        templates
+        """
+        self.add_json_response('/api/', {
+            'stat': 'ok',
+            'links': {
+                'review_requests': {
+                    'href': self.server_url + 'api/review-requests/',
+                    'method': 'GET',
+                },
+            },
+        })
+        self.add_json_response('/api/review-requests/1/',
+                               self.SAMPLE_REVIEW_REQUEST)
+
+        root = RootResource(self.server, self.server_url + 'api/')
+        rsc = root.get_from_template('review_request', review_request_id=1)
+
+        self.assertEqual(rsc.get_field('summary'), 'Test review request')
+        self.assertEqual([r[1] for r in self.requests],
+                         ['/api/', '/api/review-requests/',
+                          '/api/review-requests/1/'])
+        self.assertRaises(InvalidKeyError, root.get_from_template,
+                          'review', review_request_id=1, review_id=1)
+
+    def test_expand_and_only_fields(self):
+        """Testing ResourceListBase.get with expand and only_fields"""
+        self.add_json_response(
+            '/api/review-requests/1/?expand=draft&only-fields=id,draft', {
+                'stat': 'ok',
+                'review_request': {
+                    'id': 1,
+                    'draft': {
+                        'id': 2,
+                        'summary': 'Draft summary',
+                    },
+                    'links': {
+                        'draft': {
+                            'href': self.server_url +
+                                    'api/review-requests/1/draft/',
+                            'method': 'GET',
+                        },
+                    },
+                },
+            })
+
+        root = RootResource(self.server, self.server_url + 'api/')
+        rsc = root.get('review_requests').get(
+            1, expand='draft', only_fields=['id', 'draft'])
+        draft = rsc.get_expanded('draft')
+
+        self.assertEqual(rsc.get_field('id'), 1)
+        self.assertEqual(draft.get_field('summary'), 'Draft summary')
+        self.assertEqual(draft.url,
+                         self.server_url + 'api/review-requests/1/draft/')
+        self.assertEqual(rsc.url, self.server_url + 'api/review-requests/1/')
+        self.assertEqual(len(self.requests), 3)
+
+    def test_repository_index(self):
+        """Testing RepositoryList.get_index looks up repositories by path
+        and UUID, and is cached on disk"""
+        self.add_json_response('/api/repositories/', {
+            'stat': 'ok',
+            'total_results': 2,
+            'repositories': [
+                {
+                    'id': 1,
+                    'path': 'git://example.com/repo.git',
+                    'mirror_path': 'http://example.com/repo.git',
+                    'tool': 'Git',
+                },
+                {
+                    'id': 2,
+                    'path': 'file:///svn/repo',
+                    'tool': 'Subversion',
+                },
+            ],
+            'links': {},
+        })
+        self.add_json_response('/api/repositories/2/info/', {
+            'stat': 'ok',
+            'info': {
+                'uuid': '1234',
+                'url': 'file:///svn/repo',
+                'root_url': 'file:///svn/repo',
+            },
+        })
+        url = self.server_url + 'api/repositories/'
+
+        repositories = RepositoryList(ResourceList(self.server, url))
+        index = repositories.get_index(with_uuids=True)
+
+        self.assertEqual(repositories.get_repository_id(
+            'http://example.com/repo.git'), 1)
+        self.assertEqual(repositories.get_repository_id(
+            ['svn://other', 'file:///svn/repo']), 2)
+        self.assertEqual([r['id'] for r in index.get_by_uuid('1234')], [2])
+        self.assertEqual(len(self.requests), 2)
+
+        server = self.make_server_interface()
+        repositories = RepositoryList(ResourceList(server, url))
+        index = repositories.get_index(with_uuids=True)
+        server.close()
+
+        self.assertEqual([r['id'] for r in index.get_by_uuid('1234')], [2])
+        self.assertEqual(len(self.requests), 2)
+
+    def test_repository_index_rebuilt_on_miss(self):
+        """Testing RepositoryList rebuilds a cached index which is missing
+        the repository looked up"""
+        repositories = [
+            {'id': 1, 'path': '/svn1', 'tool': 'Subversion'},
+        ]
+        self.add_json_response('/api/repositories/', {
+            'stat': 'ok',
+            'total_results': 1,
+            'repositories': repositories,
+            'links': {},
+        })
+        url = self.server_url + 'api/repositories/'
+
+        server = self.make_server_interface()
+        RepositoryList(ResourceList(server, url)).get_index()
+        server.close()
+
+        repositories.append({'id': 2, 'path': '/svn2', 'tool': 'Subversion'})
+        self.add_json_response('/api/repositories/', {
+            'stat': 'ok',
+            'total_results': 2,
+            'repositories': repositories,
+            'links': {},
+        })
+
+        server = self.make_server_interface()
+        repository_list = RepositoryList(ResourceList(server, url))
+        self.assertEqual(repository_list.get_repository_id('/svn2'), 2)
+        self.assertEqual(repository_list.get_repository_id('/none'), None)
+        server.close()
+
+        self.assertEqual(
+            [r[1] for r in self.requests].count('/api/repositories/'), 2)
+
+    def test_repository_index_info_failure(self):
+        """Testing RepositoryList.get_index leaves out only the info of a
+        repository whose request fails"""
+        self.add_json_response('/api/repositories/', {
+            'stat': 'ok',
+            'total_results': 2,
+            'repositories': [
+                {'id': 1, 'path': '/svn1', 'tool': 'Subversion'},
+                {'id': 2, 'path': '/svn2', 'tool': 'Subversion'},
+            ],
+            'links': {},
+        })
+        self.add_json_response('/api/repositories/2/info/', {
+            'stat': 'ok',
+            'info': {'uuid': '1234'},
+        })
+        repositories = RepositoryList(
+            ResourceList(self.server, self.server_url + 'api/repositories/'))
+        fetch = repositories._fetch
+
+        def _fetch(url):
+            if url.endswith('/1/info/'):
+                raise RequestTimeoutError(url)
+
+            return fetch(url)
+
+        repositories._fetch = _fetch
+        index = repositories.get_index(with_uuids=True)
+
+        self.assertEqual([r['id'] for r in index.get_by_uuid('1234')], [2])
+        self.assertEqual(index.repositories[0]['info'], {})
+
+    def test_iterate_populates_from_list(self):
+        """Testing ResourceList iteration populates children from the list"""
+        review_requests = ResourceList(
+            self.server, self.server_url + 'api/review-requests/')
+        children = list(review_requests)
+
+        self.assertEqual(len(children), 1)
+        self.assertEqual(children[0].resource_name, 'review_request')
+        self.assertEqual(children[0].url, '/api/review-requests/1/')
+        self.assertEqual(children[0].get_field('summary'),
+                         'Test review request')
+        self.assertEqual(review_requests[0].get_field('id'), 1)
+        self.assertEqual(len(self.requests), 1)
+
+    def test_iterate_follows_next_pages(self):
+        """Testing ResourceList iteration follows pages of the list"""
+        for page in range(3):
+            rsp = {
+                'stat': 'ok',
+                'total_results': 5,
+                'repositories': [
+                    {'id': i, 'links': {}}
+                    for i in range(page * 2, min(page * 2 + 2, 5))
+                ],
+                'links': {},
+            }
+
+            if page < 2:
+                rsp['links']['next'] = {
+                    'href': self.server_url +
+                            'api/repositories/?start=%d' % (page * 2 + 2),
+                }
+
+            if page == 0:
+                self.add_json_response('/api/repositories/', rsp)
+            else:
+                self.add_json_response(
+                    '/api/repositories/?start=%d' % (page * 2), rsp)
+
+        repositories = ResourceList(self.server,
+                                    self.server_url + 'api/repositories/')
+
+        self.assertEqual(len(repositories), 5)
+        self.assertEqual([r.get_field('id') for r in repositories],
+                         range(5))
+        self.assertEqual(repositories[-1].get_field('id'), 4)
+        self.assertEqual([r.get_field('id') for r in repositories[1:4]],
+                         [1, 2, 3])
+        self.assertEqual(len(self.requests), 3)
+
+    def test_iterate_pages_within_limiter(self):
+        """Testing ResourceList iteration within a limiter with a limit of 1"""
+        self.test_iterate_follows_next_pages()
+        self.server.request_memo.clear()
+        limiter = AdaptiveLimiter(max_concurrency=1)
+        pool = ThreadPool(1, limiter)
+
+        def get_ids():
+            repositories = ResourceList(
+                self.server, self.server_url + 'api/repositories/')
+            return limiter.call(lambda: [r.get_field('id')
+                                         for r in repositories])
+
+        future = pool.submit(get_ids)
+        pool.shutdown(wait=False)
+
+        self.assertEqual(future.result(10), range(5))
+
+    def test_get_many(self):
+        """Testing ResourceListBase.get_many collects per-item errors"""
+        self.add_json_response('/api/review-requests/1/',
+                               self.SAMPLE_REVIEW_REQUEST)
+        review_requests = ResourceList(
+            self.server, self.server_url + 'api/review-requests/')
+        resources, errors = review_requests.get_many([1, 2], max_workers=2)
+
+        self.assertEqual(len(resources), 2)
+        self.assertEqual(resources[0].get_field('id'), 1)
+        self.assertEqual(resources[1], None)
+        self.assertEqual(errors.keys(), [2])
+        self.assertEqual(errors[2].code, 404)
+
+    def test_async_get(self):
+        """Testing AsyncServerInterface resolves resources via futures"""
+        self.add_json_response('/api/review-requests/1/',
+                               self.SAMPLE_REVIEW_REQUEST)
+        async_server = AsyncServerInterface(self.server, max_workers=2)
+        results = []
+        called = threading.Event()
+
+        def callback(f):
+            results.append(f.result().get_field('summary'))
+            called.set()
+
+        try:
+            root = async_server.get_root(self.server_url + 'api/').result()
+            review_requests = root.get('review_requests').result()
+            future = review_requests.get(1)
+            future.add_done_callback(callback)
+            review_request = future.result()
+
+            # result() can return before the callback has run on the
+            # worker thread.
+            called.wait(5)
+        finally:
+            async_server.close()
+
+        self.assertEqual(review_request.get_field('id'), 1)
+        self.assertEqual(results, ['Test review request'])
+        self.assertEqual(len(review_requests), 1)
+
+    def test_download_file(self):
+        """Testing Resource.download_file streams the file in chunks"""
+        self.responses['/api/review-requests/1/diffs/1/'] = \
+            (200, {'Content-Type': 'text/x-patch'}, 'x' * 1000)
+        rsc = Resource(self.server,
+                       self.server_url + 'api/review-requests/1/diffs/1/')
+        fp = StringIO()
+        progress = []
+
+        size, elapsed = rsc.download_file(
+            fp, 'text/x-patch', chunk_size=300,
+            progress=lambda written, elapsed: progress.append(written))
+
+        self.assertEqual(size, 1000)
+        self.assertEqual(fp.getvalue(), 'x' * 1000)
+        self.assertEqual(progress, [300, 600, 900, 1000])
+        self.assertEqual(self.requests[0][3]['accept'], 'text/x-patch')
+
+    def test_download_file_failure(self):
+        """Testing Resource.download_file removes a partial file when the
+        download fails"""
+        class FailingResponse(object):
+            def __init__(self):
+                self.chunks = ['x' * 300]
+
+            def read(self, size):
+                if self.chunks:
+                    return self.chunks.pop()
+
+                raise socket.timeout('timed out')
+
+            def close(self):
+                pass
+
+        self.server.get_stream = lambda url, accept: FailingResponse()
+        rsc = Resource(self.server,
+                       self.server_url + 'api/review-requests/1/diffs/1/')
+        destination = os.path.join(self.tmpdir, 'diff')
+
+        self.assertRaises(socket.timeout, rsc.download_file, destination)
+        self.assertFalse(os.path.exists(destination))
+
+    def test_refresh_conditional_get(self):
+        """Testing Resource.refresh reuses the cached data on a 304"""
+        self.add_json_response('/api/review-requests/1/',
+                               self.SAMPLE_REVIEW_REQUEST,
+                               headers={'ETag': '"abc"'})
+
+        rsc = Resource(self.server,
+                       self.server_url + 'api/review-requests/1/')
+        rsc._load()
+        data = rsc.data
+        rsc.refresh()
+
+        self.assertEqual(len(self.requests), 2)
+        self.assertEqual(self.requests[1][3].get('if-none-match'), '"abc"')
+        self.assertTrue(rsc.data is data)
+        self.assertEqual(rsc.get_field('summary'), 'Test review request')
+
+    def test_request_memo(self):
+        """Testing resources are retrieved once per run until changed"""
+        self.add_json_response('/api/review-requests/1/',
+                               self.SAMPLE_REVIEW_REQUEST)
+        review_requests = RootResource(
+            self.server, self.server_url + 'api/').get('review_requests')
+        rscs, errors = review_requests.get_many([1, 1, 1])
+
+        self.assertEqual(errors, {})
+        self.assertEqual(rscs[0].get_field('summary'), 'Test review request')
+        self.assertEqual([r[1] for r in self.requests],
+                         ['/api/', '/api/review-requests/',
+                          '/api/review-requests/1/'])
+
+        # Changing the review request means it's retrieved again.
+        rscs[0].update_field('summary', 'Changed')
+        rscs[0].save()
+        review_requests.get(1)
+        review_requests.get(1)
+        self.assertEqual([r[1] for r in self.requests][3:],
+                         ['/api/review-requests/1/',
+                          '/api/review-requests/1/'])
+
+    def test_root_metadata_cached_on_disk(self):
+        """Testing RootResource is reused from the on-disk metadata cache"""
+        root = RootResource(self.server, self.server_url + 'api/')
+
+        server = self.make_server_interface()
+        cached_root = RootResource(server, self.server_url + 'api/')
+
+        self.assertEqual(cached_root.get_links(), root.get_links())
+        self.assertEqual(len(self.requests), 1)
+
+        cached_root.refresh()
+        server.close()
+        self.assertEqual(len(self.requests), 2)
+
+
+
+class PublishCommandTests(unittest.TestCase):
+    def setUp(self):
+        self.saved = (sys.argv, rbpublish.Settings,
+                      rbpublish.ServerInterface, rbpublish.RootResource,
+                      rbpublish.publish_review_request)
+
+    def tearDown(self):
+        (sys.argv, rbpublish.Settings, rbpublish.ServerInterface,
+         rbpublish.RootResource,
+         rbpublish.publish_review_request) = self.saved
+
+    def test_reports_every_failure(self):
+        """Testing rb publish publishes every review request, and exits
+        with an error if any failed"""
+        published = []
+
+        class FakeSettings(object):
+            def __init__(self, config_file):
+                pass
+
+            def get_cookie_file(self):
+                return None
+
+            def get_server_url(self):
+                return 'http://localhost:8080/'
+
+        class FakeServerInterface(object):
+            limiter = None
+
+            def __init__(self, server_url, cookie):
+                pass
+
+            def close(self):
+                pass
+
+        def publish_review_request(root, resource_id):
+            if resource_id != '2':
+                raise urllib2.URLError('failed')
+
+            published.append(resource_id)
+
+        sys.argv = ['rb-publish', '1', '2', '3']
+        rbpublish.Settings = FakeSettings
+        rbpublish.ServerInterface = FakeServerInterface
+        rbpublish.RootResource = lambda server, url: None
+        rbpublish.publish_review_request = publish_review_request
+
+        self.assertRaises(SystemExit, rbpublish.main)
+        self.assertEqual(published, ['2'])
+
+
 FOO = """\
 ARMA virumque cano, Troiae qui primus ab oris
 Italiam, fato profugus, Laviniaque venit